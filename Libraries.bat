@@ -2,4 +2,5 @@ pip install numpy
 pip install tensorflow
 pip install opencv-python
 pip install PyQt6
-pip install pyqt5-tools
\ No newline at end of file
+pip install pyqt5-tools
+pip install scipy
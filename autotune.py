@@ -0,0 +1,190 @@
+"""
+Automatic tuning of the PID controller parameters
+Searches the controller parameters in parallel processes against the
+simulated PTZ head, or against recorded target trajectories, and writes
+the best set to the config file the controller loads at startup
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.simulator import PTZPlant, Simulation, step_trajectory, sine_trajectory, recorded_trajectory
+from utils.VISCA_controller import controller, DEFAULT_CONFIG
+
+
+WIDTH = 640
+HEIGHT = 480
+SHAPES = len(controller(WIDTH, HEIGHT, send=lambda packet: None, config_file=None).shape_list)
+
+#(low, high) for continuous parameters, list of choices for discrete ones
+SEARCH_SPACE = {
+    'p_gain': (0.05, 1.0),
+    'p_slope': (0.1, 5.0),
+    'p_shape': list(range(SHAPES)),
+    'i_gain': (0.0, 0.01),
+    'd_gain': (0.0, 0.002),
+    'd_noise_reduction': (0.5, 8.0),
+    'length': list(range(2, 9)),
+    'x_threshold': (0.0, 0.3),
+    'y_threshold': (0.0, 0.3),
+    'z_p_gain': (0.05, 1.0),
+    'z_p_slope': (0.1, 5.0),
+    'z_p_shape': list(range(SHAPES)),
+    'z_i_gain': (0.0, 0.01),
+    'z_d_gain': (0.0, 0.002),
+    'z_d_noise_reduction': (0.5, 8.0),
+    'z_length': list(range(2, 9)),
+    'z_threshold': (0.0, 0.3),
+    'prediction': (0.0, 1.5),
+    'feed_forward': (0.0, 1.0),
+}
+
+#objective weights
+SETTLING_WEIGHT = 1.0
+OVERSHOOT_WEIGHT = 1.0
+ERROR_WEIGHT = 1.0
+COMMAND_WEIGHT = 0.2
+
+
+def scenarios(recordings, duration, latency):
+    """
+    Target trajectories the parameters are scored on
+    :param recordings: CSV files of time, pan and tilt columns
+    :param duration: seconds per scenario
+    :param latency: pipeline latency in seconds
+    :return: list of (name, trajectory function, arguments, duration, latency),
+    trajectories are built in the worker processes
+    """
+    runs = [('step', step_trajectory, (12.0, 6.0), duration, latency),
+            ('step_back', step_trajectory, (-8.0, -4.0), duration, latency),
+            ('walk', sine_trajectory, (15.0, 6.0), 2 * duration, latency)]
+    for path in recordings:
+        times, pans, tilts = np.loadtxt(path, delimiter=',', unpack=True)
+        runs.append((path, recorded_trajectory, (times - times[0], pans, tilts),
+                     float(times[-1] - times[0]), latency))
+    return runs
+
+
+def evaluate(parameters, runs, predictive = True):
+    """
+    Scores one parameter set, lower is better
+    :param parameters: dict of controller parameters
+    :param runs: scenarios from scenarios()
+    :param predictive: give the controller the target velocity and latency
+    :return: objective and list of metrics per scenario
+    """
+    objective = 0.0
+    results = []
+    for name, trajectory, arguments, duration, latency in runs:
+        plant = PTZPlant(delay=0.02, jitter=0.01, seed=0)
+        camera_controller = controller(WIDTH, HEIGHT, send=plant.send, clock=plant.clock, config_file=None)
+        camera_controller.set_parameters(parameters)
+        metrics = Simulation(trajectory(*arguments), plant=plant, camera_controller=camera_controller,
+                             width=WIDTH, height=HEIGHT, latency=latency, predictive=predictive).run(duration)
+        #unsettled axes count as the whole run
+        settling = sum(duration if metrics[axis + '_settling_time'] is None else metrics[axis + '_settling_time']
+                       for axis in ('x', 'y', 'z')) / duration
+        overshoot = sum(metrics[axis + '_overshoot'] for axis in ('x', 'y', 'z'))
+        error = sum(metrics[axis + '_rms_error'] for axis in ('x', 'y', 'z')) / WIDTH
+        objective += (SETTLING_WEIGHT * settling + OVERSHOOT_WEIGHT * overshoot
+                      + ERROR_WEIGHT * error + COMMAND_WEIGHT * metrics['command_rate'] / 30)
+        results.append(dict(metrics, scenario=name))
+    return objective, results
+
+
+def sample(random, center = None, scale = 1.0):
+    """
+    Draws a parameter set
+    :param random: numpy random generator
+    :param center: parameter set to perturb, None samples uniformly
+    :param scale: size of the perturbation as a fraction of each range
+    :return: dict of parameters
+    """
+    parameters = {}
+    for name, space in SEARCH_SPACE.items():
+        if isinstance(space, list):
+            if center is None or random.random() < scale:
+                parameters[name] = int(random.choice(space))
+            else:
+                parameters[name] = center[name]
+        else:
+            low, high = space
+            if center is None:
+                value = random.uniform(low, high)
+            else:
+                value = center[name] + random.normal(0, scale * (high - low))
+            parameters[name] = float(min(high, max(low, value)))
+    return parameters
+
+
+def tune(trials, workers, runs, start, seed = 0):
+    """
+    Random search followed by refinement around the best sets
+    :param trials: number of parameter sets to score
+    :param workers: number of processes
+    :param runs: scenarios from scenarios()
+    :param start: parameter set to start from
+    :param seed: random seed
+    :return: best objective, metrics and parameters
+    """
+    random = np.random.default_rng(seed)
+    batch = max(1, 2 * workers)
+    best = [(*evaluate(start, runs), start)]
+    print("starting objective {:.4f}".format(best[0][0]))
+    with ProcessPoolExecutor(workers) as pool:
+        done = 0
+        while done < trials:
+            count = min(batch, trials - done)
+            #explore for the first half, then refine around the best sets
+            scale = 1.0 - done / trials
+            if done < trials // 2:
+                candidates = [sample(random) for _ in range(count)]
+            else:
+                candidates = [sample(random, best[random.integers(min(3, len(best)))][2], 0.2 * scale)
+                              for _ in range(count)]
+            scores = pool.map(evaluate, candidates, [runs] * count)
+            for parameters, (objective, results) in zip(candidates, scores):
+                best.append((objective, results, parameters))
+            best.sort(key=lambda item: item[0])
+            best = best[:10]
+            done += count
+            print("{}/{} trials, best objective {:.4f}".format(done, trials, best[0][0]))
+    return best[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tunes the PID controller parameters in simulation")
+    parser.add_argument('--trials', type=int, default=200, help="parameter sets to score")
+    parser.add_argument('--workers', type=int, default=None, help="processes, defaults to the CPU count")
+    parser.add_argument('--duration', type=float, default=6.0, help="seconds per step scenario")
+    parser.add_argument('--latency', type=float, default=0.1, help="capture and detection latency in seconds")
+    parser.add_argument('--recording', action='append', default=[],
+                        help="CSV of time, pan and tilt of a recorded target, may be repeated")
+    parser.add_argument('--config', default=DEFAULT_CONFIG, help="config file to start from and write")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count()
+    runs = scenarios(args.recording, args.duration, args.latency)
+    start = controller(WIDTH, HEIGHT, send=lambda packet: None, config_file=args.config).get_parameters()
+    start = {name: start[name] for name in SEARCH_SPACE}
+
+    started = time.perf_counter()
+    objective, results, parameters = tune(args.trials, workers, runs, start, args.seed)
+    print("best objective {:.4f} in {:.1f}s".format(objective, time.perf_counter() - started))
+    for metrics in results:
+        print(json.dumps(metrics))
+
+    tuned = controller(WIDTH, HEIGHT, send=lambda packet: None, config_file=args.config)
+    tuned.set_parameters(parameters)
+    tuned.save_parameters(args.config)
+    print("saved to " + args.config)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Benchmarks for detectors, trackers and VISCA packet generation
+Runs headless on synthetic or recorded video at several resolutions and
+crowd sizes and reports FPS, per frame latency and allocations as JSON
+so runs can be compared for regressions
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from utils.detectors import ColorDetector, FaceCascadeDetector, OpenCVDNNDetector
+from utils.trackers import CostBasedTracker, MultiObjectTracker, MAX_COST
+from utils.VISCA_controller import controller
+
+
+RESOLUTIONS = ['320x240', '640x480', '1280x720', '1920x1080']
+CROWDS = [1, 5, 20]
+
+
+def synthetic_video(width, height, crowd, frames = 30, seed = 0):
+    """
+    Frames of red boxes moving over a noise background
+    :param width: frame width
+    :param height: frame height
+    :param crowd: number of boxes
+    :param frames: number of frames
+    :param seed: random seed
+    :return: list of frames and list of per frame detections
+    """
+    random = np.random.default_rng(seed)
+    background = random.integers(40, 90, (height, width, 3), dtype=np.uint8)
+    size = max(8, min(width, height) // 12)
+    positions = random.uniform((0, 0), (width - size, height - size), (crowd, 2))
+    velocities = random.uniform(-size / 8, size / 8, (crowd, 2))
+    video = []
+    detections = []
+    for _ in range(frames):
+        frame = background.copy()
+        boxes = []
+        for x, y in positions.astype(int):
+            cv2.rectangle(frame, (x, y), (x + size, y + size), (0, 0, 255), -1)
+            boxes.append({'box': [int(x), int(y), size, size], 'confidence': 1})
+        video.append(frame)
+        detections.append(boxes)
+        positions += velocities
+        #bounce off the edges
+        outside = (positions < 0) | (positions > (width - size, height - size))
+        velocities[outside] *= -1
+        positions = np.clip(positions, 0, (width - size, height - size))
+    return video, detections
+
+
+def recorded_video(path, width, height, frames = 30):
+    """
+    Frames read from a video file and resized
+    :param path: video file
+    :param width: frame width
+    :param height: frame height
+    :param frames: largest number of frames
+    :return: list of frames
+    """
+    cap = cv2.VideoCapture(path)
+    video = []
+    while len(video) < frames:
+        ok, frame = cap.read()
+        if not ok:
+            break
+        video.append(cv2.resize(frame, (width, height)))
+    cap.release()
+    if len(video) == 0:
+        raise Exception("could not read video: " + path)
+    return video
+
+
+def measure(function, inputs, iterations, warmup = 5, allocations = True):
+    """
+    Times a function over inputs
+    :param function: callable taking one input
+    :param inputs: list of inputs, cycled
+    :param iterations: timed calls
+    :param warmup: untimed calls first
+    :param allocations: also trace Python and NumPy allocations in a
+    separate pass, OpenCV's own allocations are not visible to tracemalloc
+    :return: dict of results, times in milliseconds
+    """
+    for index in range(warmup):
+        function(inputs[index % len(inputs)])
+    latencies = np.empty(iterations)
+    started = time.perf_counter()
+    for index in range(iterations):
+        start = time.perf_counter()
+        function(inputs[index % len(inputs)])
+        latencies[index] = time.perf_counter() - start
+    elapsed = time.perf_counter() - started
+    latencies *= 1000
+    result = {
+        'iterations': iterations,
+        'fps': iterations / elapsed,
+        'mean_ms': float(latencies.mean()),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+    if allocations:
+        count = min(iterations, 50)
+        peaks = np.empty(count)
+        retained = np.empty(count)
+        tracemalloc.start()
+        for index in range(count):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function(inputs[index % len(inputs)])
+            current, peak = tracemalloc.get_traced_memory()
+            peaks[index] = peak - before
+            retained[index] = current - before
+        tracemalloc.stop()
+        result['peak_alloc_bytes'] = float(peaks.mean())
+        result['retained_bytes'] = float(retained.mean())
+    return result
+
+
+def detector_cases(width, height):
+    """Detector name and callable for one resolution"""
+    cases = [('ColorDetector', lambda: ColorDetector(height, width, headless=True))]
+    cases.append(('FaceCascadeDetector', lambda: FaceCascadeDetector(width, height)))
+    cases.append(('OpenCVDNNDetector', lambda: OpenCVDNNDetector(width, height)))
+    for name, create in cases:
+        try:
+            detector = create()
+        except Exception as error:
+            #e.g. the DNN model file is not in models/
+            yield name, None, str(error).strip().splitlines()[-1]
+            continue
+        yield name, detector.detect, None
+
+
+def synthetic_tracks(width, height, crowd, frames = 30, seed = 0):
+    """
+    Detections of boxes circling in their own grid cell, the circles close
+    after frames so cycling the frames never makes an object jump and
+    objects never overlap, so every detection has one true track
+    :param width: frame width
+    :param height: frame height
+    :param crowd: number of boxes
+    :param frames: frames per loop
+    :param seed: random seed
+    :return: list of per frame detections
+    """
+    random = np.random.default_rng(seed)
+    cols = int(np.ceil(np.sqrt(crowd * width / height)))
+    rows = int(np.ceil(crowd / cols))
+    cell = min(width / cols, height / rows)
+    size = max(4, min(min(width, height) // 12, int(cell // 3)))
+    cells = random.permutation(rows * cols)[:crowd]
+    centers = np.stack((cells % cols + 0.5, cells // cols + 0.5), axis=1) * cell
+    #size is at most a third of the cell, so the box stays inside it
+    radius = random.uniform(0.5, 1.0, crowd) * size
+    phase = random.uniform(0, 2 * np.pi, crowd)
+    direction = random.choice((-1, 1), crowd)
+    detections = []
+    for index in range(frames):
+        angle = phase + direction * 2 * np.pi * index / frames
+        positions = centers + radius[:, None] * np.stack((np.cos(angle), np.sin(angle)), axis=1) - size / 2
+        detections.append([{'box': [int(x), int(y), size, size], 'confidence': 1} for x, y in positions])
+    return detections
+
+
+def tracker_cases(detections):
+    """
+    Tracker name and callable taking a list of detections
+    :param detections: per frame detections from synthetic_tracks
+    """
+    tracker = CostBasedTracker(5)
+    first = detections[0][0]['box']
+    tracker.find_track(detections[0], first[0] + 1, first[1] + 1)
+    yield 'CostBasedTracker.iou_cost', lambda point_sets: tracker.iou_cost(point_sets, 0)
+    yield 'CostBasedTracker.location_cost', lambda point_sets: tracker.location_cost(point_sets, 0)
+    crowd = len(detections[0])
+    for cost in ('iou', 'location'):
+        #two loops must keep one track per object, else the timing would
+        #measure track births instead of matching
+        check = MultiObjectTracker(cost=cost, max_cost=MAX_COST[cost])
+        for point_sets in detections + detections:
+            ids, _ = check.update(point_sets)
+        if check.next_id != crowd or len(ids) != crowd:
+            raise Exception("{} tracker did not match: {} tracks for {} objects".format(cost, check.next_id, crowd))
+        multi = MultiObjectTracker(cost=cost, max_cost=MAX_COST[cost])
+        yield 'MultiObjectTracker.update.' + cost, multi.update
+
+
+def controller_cases(seed = 0):
+    """Controller name, callable and inputs"""
+    random = np.random.default_rng(seed)
+    #simulated clock so every follow call runs a full PID update
+    ticks = iter(range(sys.maxsize))
+    camera = controller(640, 480, send=lambda packet: None, config_file=None,
+                        clock=lambda: next(ticks) / 30)
+    errors = [tuple(error) for error in random.uniform(-1.2, 1.2, (256, 3))]
+    yield 'controller.move', lambda error: camera.move(*error), errors
+    boxes = [tuple(box) for box in random.uniform((0, 0, 40, 40), (600, 440, 200, 200), (256, 4))]
+    yield 'controller.follow', camera.follow, boxes
+
+
+def run(args):
+    """
+    Runs every benchmark
+    :param args: parsed command line arguments
+    :return: dict of results
+    """
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'opencv_threads': cv2.getNumThreads(),
+        'cases': {},
+    }
+    cases = results['cases']
+    only = args.only
+
+    for resolution in args.resolutions:
+        width, height = [int(value) for value in resolution.split('x')]
+        for crowd in args.crowds:
+            if args.video:
+                video = recorded_video(args.video, width, height, args.frames)
+            else:
+                video, _ = synthetic_video(width, height, crowd, args.frames, args.seed)
+            suffix = '/{}/crowd{}'.format(resolution, crowd)
+
+            for name, detect, skipped in detector_cases(width, height):
+                if only and not name.startswith(only):
+                    continue
+                if skipped is not None:
+                    cases[name + suffix] = {'skipped': skipped}
+                else:
+                    try:
+                        cases[name + suffix] = measure(detect, video, args.iterations, args.warmup,
+                                                       not args.no_alloc)
+                    except cv2.error as error:
+                        cases[name + suffix] = {'skipped': str(error).strip().splitlines()[-1]}
+                print(name + suffix, cases[name + suffix])
+
+            #tracker costs depend on the crowd, not the resolution
+            if resolution == args.resolutions[0]:
+                tracks = synthetic_tracks(width, height, crowd, args.frames, args.seed)
+                for name, function in tracker_cases(tracks):
+                    if only and not name.startswith(only):
+                        continue
+                    key = '{}/crowd{}'.format(name, crowd)
+                    cases[key] = measure(function, tracks, args.iterations * 10, args.warmup,
+                                         not args.no_alloc)
+                    print(key, cases[key])
+
+    for name, function, inputs in controller_cases(args.seed):
+        if only and not name.startswith(only):
+            continue
+        cases[name] = measure(function, inputs, args.iterations * 10, args.warmup, not args.no_alloc)
+        print(name, cases[name])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints FPS changes against an earlier run
+    :param results: results of this run
+    :param baseline: results of the earlier run
+    :param tolerance: relative FPS drop reported as a regression
+    :return: list of regressed case names
+    """
+    regressions = []
+    for name, result in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None or 'fps' not in old or 'fps' not in result:
+            continue
+        change = result['fps'] / old['fps'] - 1
+        flag = ''
+        if change < -tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:60s} {:10.1f} -> {:10.1f} fps ({:+.1%}){}'.format(name, old['fps'], result['fps'], change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks detectors, trackers and VISCA encoding")
+    parser.add_argument('--resolutions', nargs='+', default=RESOLUTIONS, help="WIDTHxHEIGHT")
+    parser.add_argument('--crowds', nargs='+', type=int, default=CROWDS, help="objects per frame")
+    parser.add_argument('--video', default=None, help="recorded video instead of synthetic frames")
+    parser.add_argument('--frames', type=int, default=30, help="distinct frames per video")
+    parser.add_argument('--iterations', type=int, default=100, help="timed detector calls per case")
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--only', default=None, help="run cases whose name starts with this")
+    parser.add_argument('--no-alloc', action='store_true', help="skip the allocation pass")
+    parser.add_argument('--threads', type=int, default=None, help="OpenCV threads, fix for comparable runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help="JSON file for the results")
+    parser.add_argument('--compare', default=None, help="earlier JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="FPS drop counted as a regression")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+    results = run(args)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=4)
+    print("saved to " + args.output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
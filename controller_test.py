@@ -7,17 +7,20 @@ Benjamin Dostie 2022
 
 import cv2
 from utils.VISCA_controller import controller
+from utils.sources import open_source
 
 
 SIZE_THRESHOLD = 50
 DISPLAY_WIDTH = 640
 DISPLAY_HEIGHT = 480
-cam = cv2.VideoCapture(1)
+SOURCE = 1 #camera index, video file, image directory or recorded session
+cam = open_source(SOURCE)
 
 # trackbars for moving test bounding box
 def nothing(x):
     pass
 cv2.namedWindow('web_cam')
+cv2.moveWindow('web_cam',0,0)
 cv2.createTrackbar('xVal' , 'web_cam', 200, 1920, nothing)
 cv2.createTrackbar('yVal' , 'web_cam', 200, 1080, nothing)
 cv2.createTrackbar('hVal' , 'web_cam', 100, 500, nothing)
@@ -48,7 +51,6 @@ while True:
 
     #cv2.drawContours(frame, contours, 0,(255,0,0), 3)
     cv2.imshow('web_cam', frame)
-    cv2.moveWindow('web_cam',0,0)
     
     key = cv2.waitKey(1)
     if key == ord('q'):
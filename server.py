@@ -0,0 +1,213 @@
+"""
+Headless tracking server
+Runs capture, detection and control without any windows for rack servers
+Detector, controller and preview parameters come from a JSON config
+instead of trackbars, the largest detection is followed, and an optional
+low rate preview is served as MJPEG or written as a JPEG file
+"""
+
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+
+import numpy as np
+
+from utils import metrics
+from utils.detectors import ColorDetector
+from utils.pipeline import Pipeline
+from utils.preview import Preview
+from utils.sources import open_source, Recorder, RecordingSource
+from utils.trackers import CostBasedTracker
+from utils.VISCA_controller import controller, DEFAULT_CONFIG
+
+
+SERVER_CONFIG = 'server_config.json'
+
+DEFAULTS = {
+    'source': 0, #camera index, video file, image directory or recorded session
+    'width': 640,
+    'height': 480,
+    'ring_slots': 8,
+    'record_path': None,
+    'lost_frames': 30, #frames without a match before the track is dropped
+    'stats_interval': 10.0, #seconds between stats lines, 0 disables them
+    'detector': {
+        'bounds': [150, 179, 0, 30, 125, 255, 103, 255],
+        'threshold': 50,
+        'scale': 1.0,
+        'lut_bits': None,
+    },
+    'controller': {
+        'ip_address': None, #None runs without moving a camera
+        'port_number': 1259,
+        'control_rate': 30,
+        'max_command_rate': None,
+        'config_file': DEFAULT_CONFIG,
+    },
+    'preview': {
+        'enabled': False,
+        'rate': 5,
+        'port': 8080,
+        'host': '127.0.0.1',
+        'path': None,
+        'quality': 70,
+        'scale': 1.0,
+    },
+    'metrics': {
+        'port': None,
+        'path': None,
+        'interval': 5.0,
+    },
+}
+
+
+def load_config(path):
+    """
+    Server config with defaults for missing values
+    :param path: JSON file, missing files give the defaults
+    :return: dict of settings
+    """
+    config = json.loads(json.dumps(DEFAULTS))
+    if path is not None and os.path.exists(path):
+        with open(path) as file:
+            loaded = json.load(file)
+        for key, value in loaded.items():
+            if key not in config:
+                raise Exception("unknown server setting: " + key)
+            if isinstance(config[key], dict):
+                config[key].update(value)
+            else:
+                config[key] = value
+    return config
+
+
+class Follower:
+    """
+    Detection and tracking without a user to pick the target.
+    The largest detection starts a track and a track that is not matched
+    for lost_frames frames is dropped so a new one can start.
+    """
+    def __init__(self, detector, tracker, lost_frames = 30) -> None:
+        """
+        New follower
+        :param detector: detector with a detect(frame) method
+        :param tracker: CostBasedTracker
+        :param lost_frames: frames without a match before the track is dropped
+        """
+        self.detector = detector
+        self.tracker = tracker
+        self.lost_frames = lost_frames
+        self.lost_track_frames = 0
+        self.tracking = False
+        #pipeline detection stage, its interval converts tracker velocity to pixels per second
+        self.detection = None
+
+    def process(self, frame):
+        """
+        Detects objects and updates the track. Runs on the detection thread.
+        :param frame: newest camera frame
+        :return: all detections, the tracked box or None and its velocity
+        in pixels per second
+        """
+        detections = self.detector.detect(frame)
+        track_box = velocity = None
+        if not self.tracking and len(detections) > 0:
+            #detections are sorted by area
+            x, y, w, h = detections[0]['box']
+            self.tracking = self.tracker.find_track(detections, x + w / 2, y + h / 2)
+            self.lost_track_frames = 0
+        if self.tracking:
+            gate = self.tracker.gate(detections, self.lost_track_frames)
+            candidates = [detection for detection, inside in zip(detections, gate) if inside]
+            costs = self.tracker.location_cost(candidates, self.lost_track_frames)
+            if len(costs) > 0:
+                track_box = candidates[np.argmin(costs)]['box']
+                self.tracker.update_track(*track_box)
+                if self.detection is not None and self.detection.interval:
+                    velocity = np.divide(self.tracker.get_velocity(), self.detection.interval)
+                self.lost_track_frames = 0
+            else:
+                self.lost_track_frames += 1
+                if self.lost_track_frames > self.lost_frames:
+                    self.tracker.drop_track()
+                    self.tracking = False
+        return detections, track_box, velocity
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs tracking and camera control without a display")
+    parser.add_argument('--config', default=SERVER_CONFIG, help="JSON server config")
+    parser.add_argument('--save-config', action='store_true', help="write the config with defaults filled in and exit")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.save_config:
+        with open(args.config, 'w') as file:
+            json.dump(config, file, indent=4)
+        print("saved to " + args.config)
+        return
+
+    width, height = config['width'], config['height']
+    cam = open_source(config['source'], width = width, height = height)
+    recorder = None
+    if config['record_path'] is not None:
+        recorder = Recorder(config['record_path'])
+        cam = RecordingSource(cam, recorder)
+
+    detector_config = config['detector']
+    detector = ColorDetector(height, width, detector_config['threshold'], headless = True,
+                             bounds = detector_config['bounds'], scale = detector_config['scale'],
+                             lut_bits = detector_config['lut_bits'])
+    follower = Follower(detector, CostBasedTracker(5), config['lost_frames'])
+
+    follow = stop = None
+    camera_config = config['controller']
+    if camera_config['ip_address'] is not None:
+        camera = controller(width, height, camera_config['max_command_rate'], camera_config['ip_address'],
+                            camera_config['port_number'], control_rate = camera_config['control_rate'],
+                            config_file = camera_config['config_file'])
+        if recorder is not None:
+            camera.send = recorder.wrap_send(camera.connection.send)
+        follow, stop = camera.follow, camera.stop
+
+    preview = None
+    preview_config = config['preview']
+    if preview_config['enabled']:
+        preview = Preview(preview_config['rate'], preview_config['port'], preview_config['host'],
+                          preview_config['path'], preview_config['quality'], preview_config['scale'])
+
+    metrics_config = config['metrics']
+    if metrics_config['port'] is not None or metrics_config['path'] is not None:
+        metrics.enable()
+        if metrics_config['port'] is not None:
+            metrics.serve(metrics_config['port'])
+        if metrics_config['path'] is not None:
+            metrics.export(metrics_config['path'], metrics_config['interval'])
+
+    pipeline = Pipeline(cam, follower.process, follow = follow, control_rate = camera_config['control_rate'],
+                        stop = stop, recorder = recorder, ring_slots = config['ring_slots'], preview = preview)
+    follower.detection = pipeline.detection
+
+    done = threading.Event()
+    signal.signal(signal.SIGINT, lambda *args: done.set())
+    signal.signal(signal.SIGTERM, lambda *args: done.set())
+    pipeline.start()
+    interval = config['stats_interval']
+    last_stats = time.monotonic()
+    #runs until stopped or until a recorded source ends
+    while not done.wait(0.1) and not pipeline.finished():
+        if interval and time.monotonic() - last_stats >= interval:
+            print(json.dumps(pipeline.stats()))
+            last_stats = time.monotonic()
+    if interval:
+        print(json.dumps(pipeline.stats()))
+
+    pipeline.stop()
+    cam.release()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,99 +1,150 @@
 """
 File for testing detector, tracker, and controller with real example
 Set for VISCA
+Capture, detection and control run on separate threads, see utils/pipeline.py
 Benjamin Dostie 2022
 """
 
 
+import threading
 import cv2
 import numpy as np
 from utils.trackers import CostBasedTracker
 from utils.detectors import ColorDetector
 from utils.display import draw_points
+from utils.pipeline import Pipeline
+from utils.propagators import KeyframeDetector
+from utils.sources import open_source, Recorder, RecordingSource
 from numpy.core.fromnumeric import argmin
 
 
 SIZE_THRESHOLD = 50 #detection bounding box size threshold
 DISPLAY_WIDTH = 640
 DISPLAY_HEIGHT = 480
-cam = cv2.VideoCapture(0)
-cam.set(3, DISPLAY_WIDTH)
-cam.set(4, DISPLAY_HEIGHT)
+CONTROL_RATE = 30 #camera commands per second
+SOURCE = 0 #camera index, video file, image directory or recorded session
+RECORD_PATH = None #session directory to record frames, detections and commands
+RING_SLOTS = 8 #shared memory frame slots, each frame is captured once and shared
+KEYFRAMES = False #detect on keyframes only, optical flow carries boxes between them
+cam = open_source(SOURCE, width = DISPLAY_WIDTH, height = DISPLAY_HEIGHT)
+recorder = None
+if RECORD_PATH is not None:
+    recorder = Recorder(RECORD_PATH)
+    cam = RecordingSource(cam, recorder)
 
 
 
 detector = ColorDetector(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+#detection on every frame or on keyframes with propagated boxes in between
+frame_detector = KeyframeDetector(detector) if KEYFRAMES else detector
 tracker = CostBasedTracker(5)
+#controller = controller(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+#controller.send = recorder.wrap_send(controller.connection.send) to record commands
 lost_track_frames = 0
 tracking = False
+#tracker is shared by the detection thread and the click callback
+tracker_lock = threading.Lock()
+point_sets = []
+preview = None #reused display buffer, drawing never touches the shared frames
+
+
+def process(frame):
+    """
+    Detects objects and updates the track. Runs on the detection thread.
+    :param frame: newest camera frame
+    :return: all detections, the tracked box or None and its velocity
+    in pixels per second
+    """
+    global lost_track_frames
+    #HighGUI is only used from the main loop
+    detections = frame_detector.detect(frame, display = False)
+    track_box = velocity = None
+    with tracker_lock:
+        if tracking == True:
+            #drop detections far from the predicted location before costing
+            gate = tracker.gate(detections, lost_track_frames)
+            candidates = [detection for detection, inside in zip(detections, gate) if inside]
+            bb_costs = tracker.location_cost(candidates, lost_track_frames)
+            if len(bb_costs) > 0:
+                track_box = candidates[argmin(bb_costs)]['box']
+                x,y,w,h = track_box
+                tracker.update_track(x, y, w, h)
+                #tracker velocity is per processed frame
+                if pipeline.detection.interval:
+                    velocity = np.divide(tracker.get_velocity(), pipeline.detection.interval)
+                #follow lighting changes once a color is learned
+                detector.update_model(frame, track_box)
+                lost_track_frames = 0
+            else:
+                lost_track_frames += 1
+                if KEYFRAMES:
+                    #propagation lost the target, detect on the next frame
+                    frame_detector.request_keyframe()
+    return detections, track_box, velocity
 
 
 def click(event, x, y, flags, params):
     """
-    Checks for click event to set track and 
+    Checks for click event to set track and
     """
-    global tracking
+    global tracking, lost_track_frames
     if event == cv2.EVENT_LBUTTONDOWN:
-        _, frame = cam.read()
-        bounding_boxes = detector.detect(frame)
-        #find bounding box nearest click event:
-        tracking = tracker.find_track(bounding_boxes, x, y) 
-
-    #not functioning
-    #if event == cv2.EVENT_RBUTTONDOWN:
-    #    _, frame = cam.read()
-    #    detector.assign_detection(frame, x, y)
-        
-        
+        #find bounding box nearest click event in the displayed detections:
+        with tracker_lock:
+            tracking = tracker.find_track(point_sets, x, y)
+            lost_track_frames = 0
+        if KEYFRAMES:
+            frame_detector.request_keyframe()
+
+    #learn the color under the click
+    if event == cv2.EVENT_RBUTTONDOWN:
+        latest, _ = pipeline.frames.peek()
+        if latest is not None:
+            detector.assign_detection(latest[2], x, y)
+
+
 cv2.namedWindow('web_cam')
+cv2.moveWindow('web_cam',0,0)
 cv2.setMouseCallback('web_cam', click)
 
+#follow = controller.follow, stop = controller.stop to move the camera
+pipeline = Pipeline(cam, process, follow = None, control_rate = CONTROL_RATE, recorder = recorder,
+                    ring_slots = RING_SLOTS)
+pipeline.start()
 
 
 while True:
-    #camera
-    _, frame = cam.read()
-    
- 
-
-    point_sets = detector.detect(frame)
-    
-    
-    
-    
-            
-    if tracking == True:
-        bb_costs = tracker.location_cost(point_sets, lost_track_frames)
-       
-        if len(bb_costs) > 0: 
-            
-            track_box = point_sets[argmin(bb_costs)]['box']
-            #controller.follow(track_box)
-            x,y,w,h = track_box
-            tracker.update_track(x, y, w, h) 
-            frame = draw_points(frame, [point_sets[argmin(bb_costs)]], type = 'box')
-            
- 
-    else:
-        frame = draw_points(frame, point_sets, 'box')
-            
-        
-                
-    
-         
-        
-
-
-    #cv2.drawContours(frame, contours, 0,(255,0,0), 3)
-    cv2.imshow('web_cam', frame)
-    cv2.moveWindow('web_cam',0,0)
-    
+    #newest processed frame, older frames were dropped by the pipeline
+    latest = pipeline.latest(timeout = 0.1)
+    if latest is not None:
+        frame_id, _, frame, point_sets, track_box = latest
+        if preview is None:
+            preview = np.empty_like(frame)
+        np.copyto(preview, frame)
+
+        #skip frames whose slot was reused while copying
+        if pipeline.valid(frame_id):
+            if track_box is not None:
+                draw_points(preview, [{'box': track_box}], type = 'box')
+            elif tracking == False:
+                draw_points(preview, point_sets, 'box')
+
+            cv2.imshow('web_cam', preview)
+
+    #trackbars are read on the main thread, detection runs with the new bounds
+    detector.update_trackbars()
     key = cv2.waitKey(1)
-    if key == ord('q'):
+    if key == ord('q') or pipeline.finished():
         break
     elif key == ord('c'):
-        tracking = False
-        tracker.drop_track()
-
-cam.release
-cv2.destroyAllWindows
\ No newline at end of file
+        with tracker_lock:
+            tracking = False
+            tracker.drop_track()
+        if KEYFRAMES:
+            frame_detector.request_keyframe()
+    elif key == ord('r'):
+        detector.clear_model()
+
+pipeline.stop()
+cam.release()
+cv2.destroyAllWindows()
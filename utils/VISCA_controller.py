@@ -1,34 +1,172 @@
+import json
+import os
 import socket
+import time
 import cv2
 import sys
-import numpy as np
+from utils.scheduler import CommandScheduler
+from utils.pid import AxisPID
+from utils.metrics import span, timed
 
 
 
+#maximum VISCA speeds for PTZOptics cameras
+PAN_SPEED_MAX = 24
+TILT_SPEED_MAX = 20
+ZOOM_SPEED_MAX = 7
+
+#direction bytes for pan/tilt drive and zoom
+PAN_LEFT = 0x01
+PAN_RIGHT = 0x02
+TILT_UP = 0x01
+TILT_DOWN = 0x02
+AXIS_STOP = 0x03
+
+def _drive_table(max_speed, negative, positive):
+    """
+    (speed byte, direction byte) for every signed speed
+    index with speed + max_speed
+    """
+    table = []
+    for speed in range(-max_speed, max_speed + 1):
+        if speed < 0:
+            table.append((-speed, negative))
+        elif speed > 0:
+            table.append((speed, positive))
+        else:
+            table.append((0x00, AXIS_STOP))
+    return tuple(table)
+
+PAN_TABLE = _drive_table(PAN_SPEED_MAX, PAN_LEFT, PAN_RIGHT)
+TILT_TABLE = _drive_table(TILT_SPEED_MAX, TILT_UP, TILT_DOWN)
+#zoom byte 2p is tele, 3p is wide, 00 is stop
+ZOOM_TABLE = tuple([0x30 | -speed for speed in range(-ZOOM_SPEED_MAX, 0)]
+    + [0x00] + [0x20 | speed for speed in range(1, ZOOM_SPEED_MAX + 1)])
+
+#controller parameters that can be loaded from a config file and their types
+PARAMETERS = {
+    'target_x': int, 'target_y': int, 'target_z': int,
+    'p_gain': float, 'p_slope': float, 'p_shape': int, 'i_gain': float, 'd_gain': float,
+    'd_noise_reduction': float, 'm_smooth': float, 'length': int,
+    'x_threshold': float, 'y_threshold': float,
+    'z_p_gain': float, 'z_p_slope': float, 'z_p_shape': int, 'z_i_gain': float, 'z_d_gain': float,
+    'z_d_noise_reduction': float, 'z_m_smooth': float, 'z_length': int, 'z_threshold': float,
+    'prediction': float, 'command_delay': float, 'feed_forward': float,
+    'pan_rate': float, 'tilt_rate': float,
+}
+DEFAULT_CONFIG = 'controller_config.json'
+
+
+
+class VISCAEncoder:
+    """
+    Encodes pan/tilt and zoom drive commands into preallocated buffers.
+    Speeds are signed integers, negative values pan left, tilt up or
+    zoom wide. Packets identical to the last one sent are skipped
+    unless repeat_interval seconds have passed.
+    """
+    def __init__(self, repeat_interval = 1.0, clock = time.monotonic) -> None:
+        """
+        New VISCA encoder
+        :param repeat_interval: seconds after which an identical packet is
+        sent again in case the camera missed it, None never repeats
+        :param clock: function returning the time in seconds
+        """
+        self.repeat_interval = repeat_interval
+        self.clock = clock
+        self.pan_tilt_packet = bytearray(b'\x81\x01\x06\x01\x00\x00\x03\x03\xff')
+        self.zoom_packet = bytearray(b'\x81\x01\x04\x07\x00\xff')
+        self._last_pan_tilt = bytearray(len(self.pan_tilt_packet))
+        self._last_zoom = bytearray(len(self.zoom_packet))
+        self._pan_tilt_sent = None
+        self._zoom_sent = None
+
+    def _changed(self, sent_at, force):
+        return (force or sent_at is None or (self.repeat_interval is not None
+            and self.clock() - sent_at >= self.repeat_interval))
+
+    def pan_tilt(self, pan_speed, tilt_speed, force = False):
+        """
+        Encodes a pan/tilt drive command
+        :param pan_speed: signed speed between -24 and 24
+        :param tilt_speed: signed speed between -20 and 20
+        :param force: encode even if identical to the last packet
+        :return: packet buffer or None if it does not need to be sent
+        """
+        packet = self.pan_tilt_packet
+        packet[4], packet[6] = PAN_TABLE[min(PAN_SPEED_MAX, max(-PAN_SPEED_MAX, pan_speed)) + PAN_SPEED_MAX]
+        packet[5], packet[7] = TILT_TABLE[min(TILT_SPEED_MAX, max(-TILT_SPEED_MAX, tilt_speed)) + TILT_SPEED_MAX]
+        if packet == self._last_pan_tilt and not self._changed(self._pan_tilt_sent, force):
+            return None
+        self._last_pan_tilt[:] = packet
+        self._pan_tilt_sent = self.clock()
+        return packet
+
+    def zoom(self, zoom_speed, force = False):
+        """
+        Encodes a zoom drive command
+        :param zoom_speed: signed speed between -7 (wide) and 7 (tele)
+        :param force: encode even if identical to the last packet
+        :return: packet buffer or None if it does not need to be sent
+        """
+        packet = self.zoom_packet
+        packet[4] = ZOOM_TABLE[min(ZOOM_SPEED_MAX, max(-ZOOM_SPEED_MAX, zoom_speed)) + ZOOM_SPEED_MAX]
+        if packet == self._last_zoom and not self._changed(self._zoom_sent, force):
+            return None
+        self._last_zoom[:] = packet
+        self._zoom_sent = self.clock()
+        return packet
+
+
 
 class controller:
     """
     PID controller for VISCA over IP camera
     """
-    def __init__(self, width, height) -> None:
+    def __init__(self, width, height, max_command_rate = None, ip_address = '192.168.10.97',
+                 port_number = 1259, send = None, control_rate = 30, clock = time.monotonic,
+                 config_file = DEFAULT_CONFIG) -> None:
         """
         new controller instance
         :param width: width of input frame
         :type width: int
         :param height: height of input frame
         :type height: int
+        :param max_command_rate: packets per second sent to the camera,
+        None sends every command immediately
+        :type max_command_rate: float
+        :param ip_address: camera ip address
+        :type ip_address: String
+        :param port_number: camera VISCA port
+        :type port_number: int
+        :param send: callable taking an encoded packet, replaces the
+        controller's own socket, e.g. to share one event loop between cameras
+        :param control_rate: PID updates per second, follow calls in
+        between repeat the last output
+        :type control_rate: float
+        :param clock: function returning the time in seconds, e.g. a
+        simulated clock
+        :param config_file: JSON file of parameters, e.g. written by
+        autotune.py, loaded if it exists. None keeps the defaults
+        :type config_file: String
         :return:
         :rtype: None
         """
 
-
-        #fix: needs to load parameters from file
         self.WIDTH = width
         self.HEIGHT = height
-        self.ip_address = '192.168.10.97'
-        self.port_number = 1259
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-        self.connection.connect((self.ip_address, self.port_number))
+        self.ip_address = ip_address
+        self.port_number = port_number
+        self.send = send
+        self.clock = clock
+        self.connection = None
+        if send is None:
+            self.connect()
+        self.encoder = VISCAEncoder(clock=clock)
+        self.scheduler = None
+        if max_command_rate is not None:
+            self.scheduler = CommandScheduler(self.send_command, self.encoder, max_command_rate)
+            self.scheduler.start()
 
         #target values in pixel coordinates
         self.target_x = 250 #int(width/2)
@@ -36,23 +174,11 @@ class controller:
         self.target_z = 100 #int(width/12)
         
 
-        #motor saturation for integral, stops summing if saturated
+        #motor saturation, set by move
         self.x_unsaturated = True
         self.y_unsaturated = True
         self.z_unsaturated = True
 
-        #running sum of the error (integral)
-        self.x_error_sum = 0
-        self.y_error_sum = 0
-        self.z_error_sum = 0
-
-        #history of the error (derivative)  length defined by self._length
-        self.x_error_history = np.array([0,0])
-        self.y_error_history = np.array([0,0])
-        self.z_error_history = np.array([0,0])
-        #self.h_error_history = np.array([0,0])
-
-
         #acceptable exponents to control proportion equation
         #exponents are used to adjust response of the proportional error
         self.shape_list = [0.6, 0.76, 1, 1.32, 1.96, 2.2, 3, 5, 7, 21, 81]
@@ -63,7 +189,7 @@ class controller:
         self.p_shape = 6 # index of shape for proportional error
         self.i_gain = 0 #contribution of i component to total error
         self.d_gain = 0 #contribution of d component to total error
-        self.d_noise_reduction = 1 
+        self.d_noise_reduction = 1 #derivative filter time constant in control periods
         self.m_smooth = 1.0
         self.length = 3 #history length
 
@@ -83,10 +209,84 @@ class controller:
         self.z_length = 1
         self.z_threshold = 0
 
+        #latency compensation, used when follow is given a velocity
+        self.prediction = 1.0 #fraction of the latency to predict over
+        self.command_delay = 0.02 #seconds for a command to reach the camera
+        self.feed_forward = 0.0 #contribution of target velocity to pan/tilt speed
+        self.pan_rate = 1000.0 #pixels per second the image moves at full pan speed
+        self.tilt_rate = 750.0 #pixels per second the image moves at full tilt speed
+        self.x_output = 0.0
+        self.y_output = 0.0
+
+        if config_file is not None and os.path.exists(config_file):
+            self.load_parameters(config_file)
+
+        #per axis PID state, gains are copied from the parameters above
+        self.x_pid = AxisPID(control_rate, self.length)
+        self.y_pid = AxisPID(control_rate, self.length)
+        self.z_pid = AxisPID(control_rate, self.z_length)
+        self.update_pid()
 
    
     def nothing(self, x):
         pass
+
+    def set_parameters(self, parameters):
+        """
+        Sets tuning parameters
+        :param parameters: dict of parameter name to value, see PARAMETERS
+        :return:
+        :rtype: None
+        """
+        for name, value in parameters.items():
+            if name not in PARAMETERS:
+                raise Exception("unknown controller parameter: " + name)
+            setattr(self, name, PARAMETERS[name](value))
+        for name in ('p_shape', 'z_p_shape'):
+            if not 0 <= getattr(self, name) < len(self.shape_list):
+                raise Exception(name + " must index shape_list")
+        if hasattr(self, 'x_pid'):
+            self.update_pid()
+
+    def get_parameters(self):
+        """
+        Current tuning parameters
+        :return: dict of parameter name to value
+        """
+        return {name: getattr(self, name) for name in PARAMETERS}
+
+    def load_parameters(self, config_file):
+        """
+        Loads tuning parameters from a JSON file
+        :param config_file: path of the file
+        :type config_file: String
+        :return:
+        :rtype: None
+        """
+        with open(config_file) as file:
+            self.set_parameters(json.load(file))
+
+    def save_parameters(self, config_file):
+        """
+        Writes the tuning parameters to a JSON file
+        :param config_file: path of the file
+        :type config_file: String
+        :return:
+        :rtype: None
+        """
+        with open(config_file, 'w') as file:
+            json.dump(self.get_parameters(), file, indent=4)
+    def connect(self):
+        """
+        Opens a UDP socket to the camera
+        :return:
+        :rtype: None
+        """
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        self.connection.connect((self.ip_address, self.port_number))
+
     def set_ip(self, ip):
         """
         IP Setter
@@ -97,8 +297,8 @@ class controller:
         """
         try:
             self.ip_address = ip
-            self.connection.close()
-            self.connection.connect((self.ip_address, self.port_number))
+            if self.send is None:
+                self.connect()
         except:
             print("Connection Error: Could not set camera ip address")
         
@@ -112,16 +312,21 @@ class controller:
         """
         try:
             self.port_number = port
-            self.connection.close()
-            self.connection.connect((self.ip_address, self.port_number))
+            if self.send is None:
+                self.connect()
         except:
             print("Connection Error: Could not set camera port")
 
 
-    def follow(self, box):
+    def follow(self, box, velocity = None, latency = None):
         """
         Moves camera to follow a bounding box in the frame.
+        With a velocity the camera aims at where the box will be when the
+        command reaches the camera instead of where it was captured.
         :param box: tuple containing box upper left corner x, y, width, and height
+        :param velocity: box x, y (and optionally w, h) change in pixels
+        per second, e.g. the tracker velocity times the detection rate
+        :param latency: seconds since the frame of the box was captured
         :return:
         :rtype: None
         """
@@ -130,36 +335,57 @@ class controller:
         x, y, w, h = box
         center_x = x + w/2
         center_y = y + h/2
+        if velocity is not None:
+            #predict the box at command arrival time
+            lead = self.prediction * ((latency or 0.0) + self.command_delay)
+            center_x += (velocity[0] + (velocity[2] / 2 if len(velocity) > 2 else 0)) * lead
+            center_y += (velocity[1] + (velocity[3] / 2 if len(velocity) > 3 else 0)) * lead
+            if len(velocity) > 2:
+                w += velocity[2] * lead
         x_error = center_x - self.target_x
         y_error = center_y - self.target_y
         z_error = w - self.target_z
         
-        #calculate PID error
-        px, py, pz = self.calculate_p(x_error, y_error, z_error)
-        ix, iy, iz = self.calculate_i(x_error, y_error, z_error)
-        dy, dx, dz = self.calculate_d(x_error, y_error, z_error)
-
-        #adjust for gain. Assumes gains add up to 1
-        px *= self.p_gain
-        py *= self.p_gain
-        pz *= self.z_p_gain
-
-        ix *= self.i_gain
-        iy *= self.i_gain
-        iz *= self.z_i_gain
-
-        dy *= self.d_gain
-        dx *= self.d_gain
-        dz *= self.z_d_gain
-
-        x_pid_error = px + ix + dx
-        y_pid_error = py + iy + dy
-        z_pid_error = pz + iz + dz
+        #parameters may be changed at any time, e.g. from trackbars
+        with span('controller.pid'):
+            self.update_pid()
+            now = self.clock()
+            x_pid_error = self.x_pid.update(x_error, center_x, now)
+            y_pid_error = self.y_pid.update(y_error, center_y, now)
+            z_pid_error = self.z_pid.update(z_error, w, now)
+
+        if velocity is not None and self.feed_forward != 0:
+            #target speed over the ground is its image speed plus the camera's own speed
+            x_pid_error += self.feed_forward * (velocity[0] / self.pan_rate + self.x_output)
+            y_pid_error += self.feed_forward * (velocity[1] / self.tilt_rate + self.y_output)
 
         self.move(x_pid_error, y_pid_error, z_pid_error)
 
         
 
+    def update_pid(self):
+        """
+        Copies the pan/tilt and zoom parameters into the PID state
+        :return:
+        :rtype: None
+        """
+        shape = self.shape_list[self.p_shape]
+        for pid in (self.x_pid, self.y_pid):
+            pid.configure(self.p_gain, self.p_slope, shape, self.i_gain, self.d_gain,
+                          self.d_noise_reduction, self.length)
+        self.z_pid.configure(self.z_p_gain, self.z_p_slope, self.shape_list[self.z_p_shape],
+                             self.z_i_gain, self.z_d_gain, self.z_d_noise_reduction, self.z_length)
+
+    def reset_pid(self):
+        """
+        Clears the integral and derivative history, e.g. when a new track starts
+        :return:
+        :rtype: None
+        """
+        self.x_pid.reset()
+        self.y_pid.reset()
+        self.z_pid.reset()
+
     def move(self, x_error, y_error, z_error):
         """
         Generates VISCA commands to move PTZOptics Camera
@@ -187,134 +413,63 @@ class controller:
             z_error = min(1, max(-1, z_error))
         else:
             self.z_unsaturated = True
-        
-        print(x_error, y_error)
-        
 
-        #build VISCA hex command
-        command_type = '81010601'
-        pan_speed = '00'
-        tilt_speed = '00'
-        pan_direction = '03'
-        tilt_direction = '03ff'
-        zoom_header = '81010407'
-        zoom_speed = '00ff'
-
-        #get magnitiude and direction in hex for x and y
-        if x_error > self.x_threshold:
-            pan_speed = str(int(x_error * 24)).zfill(2)
-            pan_direction = '02'
-        elif x_error < 0 - self.x_threshold:
-            pan_speed = str(int(x_error * -24)).zfill(2)
-            pan_direction = '01'
-
-        if y_error > self.y_threshold:
-            tilt_speed = str(int(y_error * 20)).zfill(2)
-            tilt_direction = '02ff'
-        elif y_error < 0 - self.y_threshold:
-            tilt_speed = str(int(y_error * -20)).zfill(2)
-            tilt_direction = '01ff'
-            
-        command = (command_type + pan_speed + tilt_speed 
-        + pan_direction + tilt_direction)
-        self.send_command(command)
-
-        #get magnitude and direction in hex for zoom
-        if z_error > self.z_threshold:
-            zoom_speed = '2{}ff'.format(str(int(z_error * 7)))
-        elif z_error < 0 - self.z_threshold:
-            zoom_speed = '3{}ff'.format(str(int(z_error * -7)))
-        zoom_command = zoom_header + zoom_speed
-        self.send_command(zoom_command)
+        #get signed speed for x, y and zoom, zero inside the threshold
+        pan_speed = tilt_speed = zoom_speed = 0
+        if abs(x_error) > self.x_threshold:
+            pan_speed = int(x_error * PAN_SPEED_MAX)
+        if abs(y_error) > self.y_threshold:
+            tilt_speed = int(y_error * TILT_SPEED_MAX)
+        if abs(z_error) > self.z_threshold:
+            #box wider than the target zooms wide (negative speed)
+            zoom_speed = int(-z_error * ZOOM_SPEED_MAX)
+        #commanded speeds, used by the feed forward
+        self.x_output = pan_speed / PAN_SPEED_MAX
+        self.y_output = tilt_speed / TILT_SPEED_MAX
+
+        #scheduler keeps only the newest speeds and sends at a limited rate
+        if self.scheduler is not None:
+            self.scheduler.set_pan_tilt(pan_speed, tilt_speed)
+            self.scheduler.set_zoom(zoom_speed)
+            return
+
+        #identical packets are skipped by the encoder
+        command = self.encoder.pan_tilt(pan_speed, tilt_speed)
+        if command is not None:
+            self.send_command(command)
+        zoom_command = self.encoder.zoom(zoom_speed)
+        if zoom_command is not None:
+            self.send_command(zoom_command)
         
+    def stop(self):
+        """
+        Stops pan, tilt and zoom movement
+        :return:
+        :rtype: None
+        """
+        self.x_output = self.y_output = 0.0
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            return
+        self.send_command(self.encoder.pan_tilt(0, 0, force=True))
+        self.send_command(self.encoder.zoom(0, force=True))
+
+    @timed('controller.send')
     def send_command(self, command):
         """
-        Sends VISCA hex command to camera
-        :param command: hex code to send to camera
-        :type command: String
+        Sends VISCA command to camera
+        :param command: hex code or encoded packet to send to camera
+        :type command: String, bytes or bytearray
         :return:
         :rtype: None
         """
         try:
-            data = bytes.fromhex(command)
-            self.connection.send(data)
+            if isinstance(command, str):
+                command = bytes.fromhex(command)
+            if self.send is not None:
+                self.send(command)
+            else:
+                self.connection.send(command)
             
         except:
             print("Connection Error: Could not send VISCA command to camera")
-
-    def calculate_p(self, x_error, y_error, z_error):
-        """
-        Calculates proportional error.
-        :param x_error: absolute difference between target x and 
-        bounding box center between -1 and 1
-        :param y_error: absolute difference between target y and 
-        bounding box center between -1 and 1
-        :param z_error: absolute difference between target width 
-        and bounding box width between -1 and 1
-        :return: proportional error for x, y, and zoom between -1 and 1
-        """
-        #proportional error calculated as slope/10 x^shape
-        #error is clamped between 1 and -1
-        px = max(-1.0, min(1.0, (self.p_slope/10) * x_error**self.shape_list[self.p_shape]))
-        py = max(-1.0, min(1.0, (self.p_slope/10) * y_error**self.shape_list[self.p_shape]))
-        pz = max(-1.0, min(1.0, (self.z_p_slope/10) * z_error**self.shape_list[self.z_p_shape]))
-        
-
-
-
-        return px, py, pz
-       
-            
-    def calculate_i(self, x_error, y_error, z_error):
-        """
-        Calculates integral error by keeping a running error sum 
-        when not saturated.
-        :param x_error: absolute difference between target x and 
-        bounding box center between -1 and 1
-        :param y_error: absolute difference between target y and 
-        bounding box center between -1 and 1
-        :param z_error: absolute difference between target width 
-        and bounding box width between -1 and 1
-        :return: integral error
-        """
-        # does not accumulate if motor is saturated (at max speed)
-        self.x_error_sum += x_error * self.x_unsaturated
-        self.y_error_sum += y_error * self.y_unsaturated
-        self.z_error_sum += z_error * self.z_unsaturated
-
-        return self.x_error_sum, self.y_error_sum, self.z_error_sum
-
-    def calculate_d(self, x_error, y_error, z_error):
-        """
-        Approximates derivative of the error from history.
-        :param x_error: absolute difference between target x and 
-        bounding box center between -1 and 1
-        :param y_error: absolute difference between target y and 
-        bounding box center between -1 and 1
-        :param z_error: absolute difference between target width 
-        and bounding box width between -1 and 1
-        :return: derivative error for x, y, and zoom between -1 and 1
-        """
-        #maintain history length
-        self.x_error_history = self.x_error_history[
-            max(0, self.x_error_history.size - self.length):self.x_error_history.size]
-        self.y_error_history = self.y_error_history[
-            max(0, self.y_error_history.size - self.length):self.y_error_history.size]
-        self.z_error_history = self.z_error_history[
-            max(0, self.z_error_history.size - self.z_length):self.z_error_history.size]
-        
-
-        #add new error
-        self.x_error_history = np.append(self.x_error_history, x_error)
-        self.y_error_history = np.append(self.y_error_history, y_error)
-        self.z_error_history = np.append(self.z_error_history, z_error)
-        
-
-        #calculate derivative with respect to time
-        dx = np.mean(np.diff(self.x_error_history))
-        dy = np.mean(np.diff(self.y_error_history))
-        dz = np.mean(np.diff(self.z_error_history))
-        
-
-        return dx, dy, dz
-        
\ No newline at end of file
@@ -0,0 +1,165 @@
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+def _worker(detector_class, detector_args, memory_name, slot_shape, dtype, tasks, results):
+    """
+    Detection process. Loads the detector once, then detects on frames
+    read in place from the shared frame slots.
+    """
+    detector = detector_class(*detector_args)
+    memory = shared_memory.SharedMemory(name=memory_name)
+    slots = np.ndarray(slot_shape, dtype=dtype, buffer=memory.buf)
+    frame = None
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            frame_id, slot, shape = task
+            frame = slots[slot, :shape[0], :shape[1]]
+            try:
+                result = detector.detect(frame)
+            except Exception as error:
+                result = error
+            results.put((frame_id, slot, result))
+    finally:
+        del slots, frame
+        memory.close()
+
+
+
+class DetectorProcessPool:
+    """
+    Runs any detector from utils/detectors.py in worker processes.
+    Each worker builds its own detector once at startup. Frames are
+    copied once into shared memory slots instead of being pickled, and
+    results are returned in submission order with their frame ids.
+    """
+    def __init__(self, detector_class, detector_args = (), workers = None,
+                 max_shape = (1080, 1920, 3), dtype = np.uint8, slots = None,
+                 context = 'spawn') -> None:
+        """
+        New detector process pool
+        :param detector_class: detector class, e.g. OpenCVDNNDetector
+        :param detector_args: arguments passed to the detector constructor
+        :param workers: number of processes, defaults to the CPU count
+        :param max_shape: largest frame shape that will be submitted
+        :param dtype: frame data type
+        :param slots: number of shared frame slots, defaults to twice the workers
+        :param context: multiprocessing start method
+        """
+        self.workers = workers or mp.cpu_count()
+        self.slot_count = slots or 2 * self.workers
+        self.max_shape = tuple(max_shape)
+        self.dtype = np.dtype(dtype)
+        slot_shape = (self.slot_count,) + self.max_shape
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=int(np.prod(slot_shape)) * self.dtype.itemsize)
+        self.slots = np.ndarray(slot_shape, dtype=self.dtype, buffer=self.memory.buf)
+
+        ctx = mp.get_context(context)
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.free_slots = queue.Queue()
+        for slot in range(self.slot_count):
+            self.free_slots.put(slot)
+        self.processes = [ctx.Process(target=_worker, daemon=True,
+            args=(detector_class, tuple(detector_args), self.memory.name, slot_shape,
+                  self.dtype.str, self.tasks, self.results))
+            for _ in range(self.workers)]
+        for process in self.processes:
+            process.start()
+
+        self.next_frame_id = 0
+        self.next_result_id = 0
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def submit(self, frame, timeout = None):
+        """
+        Copies a frame into a free slot and queues it for detection
+        :param frame: camera frame or image
+        :param timeout: seconds to wait for a free slot, None waits forever
+        :return: frame id of the submitted frame
+        """
+        if frame.shape[0] > self.max_shape[0] or frame.shape[1] > self.max_shape[1]:
+            raise Exception("frame larger than max_shape")
+        slot = self.free_slots.get(timeout=timeout)
+        self.slots[slot, :frame.shape[0], :frame.shape[1]] = frame
+        with self._lock:
+            frame_id = self.next_frame_id
+            self.next_frame_id += 1
+        self.tasks.put((frame_id, slot, frame.shape[:2]))
+        return frame_id
+
+    def pending(self):
+        """
+        Number of submitted frames whose result has not been returned
+        :return: count of pending frames
+        """
+        return self.next_frame_id - self.next_result_id
+
+    def get(self, timeout = None):
+        """
+        Next result in submission order
+        :param timeout: seconds to wait, None waits forever
+        :return: frame id and list of detections
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.next_result_id not in self._finished:
+            wait = 0.5 if deadline is None else min(0.5, max(0.0, deadline - time.monotonic()))
+            try:
+                frame_id, slot, result = self.results.get(timeout=wait)
+            except queue.Empty:
+                if not any(process.is_alive() for process in self.processes):
+                    raise Exception("detector workers exited")
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+                continue
+            self.free_slots.put(slot)
+            self._finished[frame_id] = result
+        frame_id = self.next_result_id
+        result = self._finished.pop(frame_id)
+        self.next_result_id += 1
+        if isinstance(result, Exception):
+            raise result
+        return frame_id, result
+
+    def map(self, frames):
+        """
+        Detects on a sequence of frames, keeping every worker busy
+        :param frames: iterable of frames
+        :return: generator of (frame_id, detections) in order
+        """
+        for frame in frames:
+            #wait for a result before blocking on a full set of slots
+            while self.free_slots.empty() and self.pending() > 0:
+                yield self.get()
+            self.submit(frame)
+        while self.pending() > 0:
+            yield self.get()
+
+    def close(self):
+        """Stops the workers and releases the shared memory"""
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        del self.slots
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,19 +1,107 @@
+import threading
 import cv2
 import numpy as np
 from collections import deque
+from utils.metrics import timed
 
-from numpy.lib.utils import byte_bounds
+
+
+class ColorLUT:
+    """
+    Lookup table from quantized BGR color to mask value.
+    Any color model, such as several HSV ranges or a learned histogram,
+    is evaluated once for every quantized color when the table is built.
+    Segmenting a frame is then a table lookup per pixel with no color
+    conversion.
+    """
+    def __init__(self, bits = 5) -> None:
+        """
+        New color lookup table
+        :param bits: bits kept per channel, the table has 2^(3*bits) entries
+        """
+        self.bits = bits
+        self.shift = 8 - bits
+        levels = 1 << bits
+        self.index_dtype = np.uint16 if 3 * bits <= 16 else np.uint32
+        #every quantized color at the center of its bin
+        centers = (np.arange(levels, dtype=np.uint16) << self.shift) + ((1 << self.shift) >> 1)
+        b, g, r = np.meshgrid(centers, centers, centers, indexing='ij')
+        self.colors = np.stack((b, g, r), axis=-1).reshape(-1, 1, 3).astype(np.uint8)
+        self.hsv_colors = cv2.cvtColor(self.colors, cv2.COLOR_BGR2HSV)
+        self.table = np.zeros(levels ** 3, dtype=np.uint8)
+        self._quantized = None
+        self._index = None
+        self._channel = None
+
+    def build(self, predicate):
+        """
+        Evaluates a color model for every quantized color
+        :param predicate: callable taking BGR and HSV colors as (N, 3)
+        uint8 arrays and returning N booleans or weights between 0 and 1
+        """
+        selected = np.asarray(predicate(self.colors[:, 0], self.hsv_colors[:, 0]))
+        if selected.dtype == bool:
+            self.table[:] = selected * 255
+        else:
+            self.table[:] = np.clip(selected * 255, 0, 255)
+
+    def build_ranges(self, ranges):
+        """
+        Selects colors inside any of several HSV ranges
+        :param ranges: list of (lower, upper) HSV bound pairs
+        """
+        def inside(bgr, hsv):
+            selected = np.zeros(len(hsv), dtype=bool)
+            for lower, upper in ranges:
+                selected |= np.all((hsv >= lower) & (hsv <= upper), axis=1)
+            return selected
+        self.build(inside)
+
+    def apply(self, frame, dst = None):
+        """
+        Segments a frame
+        :param frame: BGR frame
+        :param dst: optional uint8 output of the frame's height and width
+        :return: mask of table values
+        """
+        shape = frame.shape[:2]
+        if self._index is None or self._index.shape != shape:
+            self._quantized = np.empty(shape + (3,), dtype=np.uint8)
+            self._index = np.empty(shape, dtype=self.index_dtype)
+            self._channel = np.empty(shape, dtype=self.index_dtype)
+        if dst is None:
+            dst = np.empty(shape, dtype=np.uint8)
+        quantized = np.right_shift(frame, self.shift, out=self._quantized)
+        #index is blue, green, red bits packed high to low
+        index = np.left_shift(quantized[..., 0], 2 * self.bits, out=self._index, dtype=self.index_dtype)
+        np.bitwise_or(index, np.left_shift(quantized[..., 1], self.bits, out=self._channel,
+                      dtype=self.index_dtype), out=index)
+        np.bitwise_or(index, quantized[..., 2], out=index)
+        return np.take(self.table, index, out=dst)
 
 
 
 class ColorDetector:
     """Detect a bounding box around a thresholded HSV selection"""
-    def __init__(self, height, width, threshold = 50) -> None:
+    def __init__(self, height, width, threshold = 50, headless = False, bounds = None,
+                 scale = 1.0, lut_bits = None, model_threshold = 40, model_decay = 0.05) -> None:
         """New instance of color based detector
 
         :param width: width of frames
         :param height: height of frames
         :param threshold: minimum size of pixel group
+        :param headless: if true no trackbars are created and bounds are
+        only changed through set_bounds
+        :param bounds: initial (hue_lower_1, hue_upper_1, hue_lower_2,
+        hue_upper_2, saturation_lower, saturation_upper, value_lower,
+        value_upper), defaults to the trackbar start values
+        :param scale: factor frames are resized by before thresholding,
+        boxes are returned in full frame coordinates
+        :param lut_bits: if set, frames are segmented with a ColorLUT of
+        this many bits per channel instead of HSV conversion
+        :param model_threshold: minimum back projection value of a pixel
+        once a color model is learned with assign_detection
+        :param model_decay: weight of the newest histogram in update_model
         """
 
         self.lower_bound_1 = 0
@@ -23,25 +111,98 @@ class ColorDetector:
         self.DISPLAY_HEIGHT = height
         self.DISPLAY_WIDTH = width
         self.THRESHOLD = threshold
+        self.headless = headless
+        self.scale = scale
+        self.bounds = None
+        self.lut = ColorLUT(lut_bits) if lut_bits else None
+        #set by set_ranges and set_color_model, trackbars then leave the LUT alone
+        self.custom_model = False
+        #hue/saturation histogram learned by assign_detection
+        self.histogram = None
+        self.model_threshold = model_threshold
+        self.model_decay = model_decay
+        self.hist_bins = [30, 32]
+        self.hist_ranges = [0, 180, 0, 256]
+        #histogram is replaced from the click and detection threads
+        self._model_lock = threading.Lock()
+        #set by trackbar callbacks so trackbars are only read after a change
+        self.trackbars_changed = True
+
+        #buffers reused between frames, allocated for the first frame size
+        self._small = None
+        self._hsv = None
+        self._mask_1 = None
+        self._mask_2 = None
+
+        self.set_bounds(bounds or (150, 179, 0, 30, 125, 255, 103, 255))
+        if headless:
+            return
 
         cv2.namedWindow('Trackbars')
         cv2.moveWindow('Trackbars', self.DISPLAY_WIDTH * 2, self.DISPLAY_HEIGHT + 20)
-        cv2.createTrackbar('HueLow', 'Trackbars', 150, 179, self.nothing)
-        cv2.createTrackbar('HueHigh', 'Trackbars', 179, 179, self.nothing)
+        cv2.createTrackbar('HueLow', 'Trackbars', self.bounds[0], 179, self.nothing)
+        cv2.createTrackbar('HueHigh', 'Trackbars', self.bounds[1], 179, self.nothing)
 
-        cv2.createTrackbar('HueLow2', 'Trackbars', 0, 179, self.nothing)
-        cv2.createTrackbar('HueHigh2', 'Trackbars', 30, 179, self.nothing)
+        cv2.createTrackbar('HueLow2', 'Trackbars', self.bounds[2], 179, self.nothing)
+        cv2.createTrackbar('HueHigh2', 'Trackbars', self.bounds[3], 179, self.nothing)
 
-        cv2.createTrackbar('SatLow', 'Trackbars', 125, 255, self.nothing)
-        cv2.createTrackbar('SatHigh', 'Trackbars', 255, 255, self.nothing)
-        cv2.createTrackbar('ValLow', 'Trackbars', 103, 255, self.nothing)
-        cv2.createTrackbar('ValHigh', 'Trackbars', 255, 255, self.nothing)
+        cv2.createTrackbar('SatLow', 'Trackbars', self.bounds[4], 255, self.nothing)
+        cv2.createTrackbar('SatHigh', 'Trackbars', self.bounds[5], 255, self.nothing)
+        cv2.createTrackbar('ValLow', 'Trackbars', self.bounds[6], 255, self.nothing)
+        cv2.createTrackbar('ValHigh', 'Trackbars', self.bounds[7], 255, self.nothing)
 
     def nothing(self, x):
-        pass
+        self.trackbars_changed = True
+
+    def set_bounds(self, bounds):
+        """
+        Sets new HSV bounds, replacing any custom color model
+        :param bounds: (hue_lower_1, hue_upper_1, hue_lower_2, hue_upper_2,
+        saturation_lower, saturation_upper, value_lower, value_upper)
+        """
+        bounds = tuple(int(bound) for bound in bounds)
+        if bounds == self.bounds and not self.custom_model:
+            return
+        self.custom_model = False
+        self.bounds = bounds
+        (hue_lower_1, hue_upper_1, hue_lower_2, hue_upper_2,
+            saturation_lower, saturation_upper, value_lower, value_upper) = bounds
+        self.lower_bound_1 = np.array([hue_lower_1,saturation_lower,value_lower])
+        self.upper_bound_1 = np.array([hue_upper_1,saturation_upper ,value_upper])
+        self.lower_bound_2 = np.array([hue_lower_2,saturation_lower,value_lower])
+        self.upper_bound_2 = np.array([hue_upper_2,saturation_upper ,value_upper])
+        if self.lut is not None:
+            #both hue ranges go into one table, so wrap around red is one pass
+            self.lut.build_ranges([(self.lower_bound_1, self.upper_bound_1),
+                                   (self.lower_bound_2, self.upper_bound_2)])
+
+    def set_ranges(self, ranges):
+        """
+        Segments with any number of HSV ranges, needs lut_bits. Trackbar
+        changes are ignored until set_bounds is called
+        :param ranges: list of (lower, upper) HSV bound pairs
+        """
+        if self.lut is None:
+            raise Exception("set_ranges requires lut_bits")
+        self.lut.build_ranges([(np.asarray(lower), np.asarray(upper)) for lower, upper in ranges])
+        self.custom_model = True
+
+    def set_color_model(self, predicate):
+        """
+        Segments with an arbitrary color model, needs lut_bits. Trackbar
+        changes are ignored until set_bounds is called
+        :param predicate: see ColorLUT.build
+        """
+        if self.lut is None:
+            raise Exception("set_color_model requires lut_bits")
+        self.lut.build(predicate)
+        self.custom_model = True
 
     def update_trackbars(self):
-        """Polls trackbars for updates and sets new bounds"""
+        """Polls trackbars for updates and sets new bounds, unless a custom color model is set"""
+        if self.headless or self.custom_model or not self.trackbars_changed:
+            return
+        self.trackbars_changed = False
         hue_lower_1 = cv2.getTrackbarPos('HueLow', 'Trackbars')
         hue_upper_1 = cv2.getTrackbarPos('HueHigh', 'Trackbars')
         hue_lower_2 = cv2.getTrackbarPos('HueLow2', 'Trackbars')
@@ -51,28 +212,68 @@ class ColorDetector:
         value_lower = cv2.getTrackbarPos('ValLow', 'Trackbars')
         value_upper = cv2.getTrackbarPos('ValHigh', 'Trackbars')
 
-        self.lower_bound_1 = np.array([hue_lower_1,saturation_lower,value_lower])
-        self.upper_bound_1 = np.array([hue_upper_1,saturation_upper ,value_upper])
-        self.lower_bound_2 = np.array([hue_lower_2,saturation_lower,value_lower])
-        self.upper_bound_2 = np.array([hue_upper_2,saturation_upper ,value_upper])
+        self.set_bounds((hue_lower_1, hue_upper_1, hue_lower_2, hue_upper_2,
+            saturation_lower, saturation_upper, value_lower, value_upper))
+
+    def _buffers(self, frame):
+        """Allocates the reused buffers when the frame size changes"""
+        height, width = frame.shape[:2]
+        if self.scale != 1.0:
+            height = max(1, int(round(height * self.scale)))
+            width = max(1, int(round(width * self.scale)))
+        if self._hsv is None or self._hsv.shape[:2] != (height, width):
+            self._small = np.empty((height, width, 3), dtype=np.uint8)
+            self._hsv = np.empty((height, width, 3), dtype=np.uint8)
+            self._mask_1 = np.empty((height, width), dtype=np.uint8)
+            self._mask_2 = np.empty((height, width), dtype=np.uint8)
+
+    def mask(self, frame):
+        """
+        Thresholds a frame into the reused mask buffer
+        :param frame: camera frame or image
+        :return: white on black mask, valid until the next call
+        """
+        self._buffers(frame)
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, self._small.shape[1::-1], dst=self._small,
+                               interpolation=cv2.INTER_AREA)
+        histogram = self.histogram
+        if self.lut is not None and histogram is None:
+            return self.lut.apply(frame, dst=self._mask_1)
+        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, dst=self._hsv)
+        if histogram is not None:
+            #learned color model
+            back_projection = cv2.calcBackProject([hsv], [0, 1], histogram, self.hist_ranges, 1,
+                                                  dst=self._mask_2)
+            cv2.threshold(back_projection, self.model_threshold, 255, cv2.THRESH_BINARY, dst=self._mask_1)
+            return self._mask_1
+        cv2.inRange(hsv, self.lower_bound_1, self.upper_bound_1, dst=self._mask_1)
+        cv2.inRange(hsv, self.lower_bound_2, self.upper_bound_2, dst=self._mask_2)
+        #white on black
+        return cv2.bitwise_or(self._mask_1, self._mask_2, dst=self._mask_1)
         
-    def detect(self, frame, display = True):
+    @timed('detect.ColorDetector')
+    def detect(self, frame, display = None):
         """
         Creates bounding boxes around groups of pixels that fall within the color threshold
         :param frame: camera frame or image
-        :param display: If true it shows each frame in a cv2 window with bounding boxes overlaid
-        :return: returns list of bounding boxes in center, w, h format
-        """
-        self.update_trackbars()
-        hsv=cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    
-        foreground_mask_1 = cv2.inRange(hsv,self.lower_bound_1, self.upper_bound_1)
-        foreground_mask_2= cv2.inRange(hsv,self.lower_bound_2, self.upper_bound_2)
-        #white on black
-        foreground_mask_composition = cv2.add(foreground_mask_1, foreground_mask_2) 
+        :param display: If true it shows each frame in a cv2 window with
+        bounding boxes overlaid and polls the trackbars, defaults to true
+        unless headless. Pass False off the main thread and call
+        update_trackbars from the main thread instead
+        :return: returns list of bounding boxes sorted by area
+        """
+        if display is None:
+            display = not self.headless
+        if display == True:
+            self.update_trackbars()
+        foreground_mask_composition = self.mask(frame)
         
 
         if display == True:
+            if self.scale != 1.0:
+                foreground_mask_composition = cv2.resize(foreground_mask_composition,
+                    frame.shape[1::-1], interpolation=cv2.INTER_NEAREST)
             #color on black
             foreground = cv2.bitwise_and(frame, frame, mask = foreground_mask_composition) 
             #black on white
@@ -89,24 +290,88 @@ class ColorDetector:
             cv2.moveWindow('background_mask', self.DISPLAY_WIDTH, self.DISPLAY_HEIGHT + 20)
             cv2.imshow('final', final)
             cv2.moveWindow('final', self.DISPLAY_WIDTH * 2, 0)
+            scale = 1.0
+        else:
+            scale = self.scale
 
         contours, _ = cv2.findContours(foreground_mask_composition, cv2.RETR_EXTERNAL,cv2.CHAIN_APPROX_SIMPLE)
-        contours = sorted(contours, key=lambda x:cv2.contourArea(x), reverse = True)
-        bounding_boxes = []
+        #area of each contour computed once, only large enough contours are sorted
+        threshold = self.THRESHOLD * scale * scale
+        large = []
         for contour in contours:
             area = cv2.contourArea(contour)
-            if area >= self.THRESHOLD:
+            if area >= threshold:
+                large.append((area, contour))
+        large.sort(key=lambda item: item[0], reverse = True)
 
-                (x,y,w,h) = cv2.boundingRect(contour)
-                
-                center = (x+w/2, y+h/2)
-                
-                bounding_boxes.append((center, w, h))
+        bounding_boxes = []
+        for _, contour in large:
+            (x,y,w,h) = cv2.boundingRect(contour)
+            if scale != 1.0:
+                x, y, w, h = int(x / scale), int(y / scale), int(w / scale), int(h / scale)
+            bounding_boxes.append({
+                'box': [x, y, w, h],
+                'confidence': 1
+            })
             
         return bounding_boxes
-    def assign_detection(self, frame, x, y):
-        #target_color = frame[y, x]
-        pass
+    def _histogram(self, frame, x, y, x1, y1):
+        """Normalized hue/saturation histogram of a region, ignoring gray and dark pixels"""
+        height, width = frame.shape[:2]
+        region = frame[max(0, y):min(height, y1), max(0, x):min(width, x1)]
+        if region.size == 0:
+            return None
+        hsv = cv2.cvtColor(region, cv2.COLOR_BGR2HSV)
+        colorful = cv2.inRange(hsv, (0, 40, 40), (180, 255, 255))
+        histogram = cv2.calcHist([hsv], [0, 1], colorful, self.hist_bins, self.hist_ranges)
+        if histogram.max() == 0:
+            return None
+        return cv2.normalize(histogram, None, 0, 255, cv2.NORM_MINMAX)
+
+    def assign_detection(self, frame, x, y, radius = 10):
+        """
+        Learns the color of the object at a clicked point. Detection then
+        uses back projection of the learned histogram instead of the HSV
+        bounds.
+        :param frame: camera frame or image
+        :param x: x coord of the click
+        :param y: y coord of the click
+        :param radius: half size of the sampled neighbourhood
+        :return: True if a color model was learned
+        """
+        histogram = self._histogram(frame, x - radius, y - radius, x + radius + 1, y + radius + 1)
+        if histogram is None:
+            return False
+        with self._model_lock:
+            self.histogram = histogram
+        return True
+
+    def update_model(self, frame, box):
+        """
+        Blends the colors inside a tracked box into the learned model with
+        exponential decay so the model follows slow lighting changes
+        :param frame: camera frame or image
+        :param box: tracked bounding box in x, y, w, h format
+        """
+        if self.histogram is None:
+            return
+        x, y, w, h = [int(value) for value in box]
+        #inner half of the box to keep background out of the model
+        histogram = self._histogram(frame, x + w//4, y + h//4, x + (3*w)//4, y + (3*h)//4)
+        if histogram is None:
+            return
+        with self._model_lock:
+            #the model may have been cleared or relearned meanwhile
+            if self.histogram is None:
+                return
+            blended = cv2.addWeighted(self.histogram, 1 - self.model_decay, histogram, self.model_decay, 0)
+            #readers see the old or the new histogram, never a partial one
+            self.histogram = cv2.normalize(blended, None, 0, 255, cv2.NORM_MINMAX)
+
+    def clear_model(self):
+        """Goes back to the HSV bounds"""
+        with self._model_lock:
+            self.histogram = None
 
 
 
@@ -127,13 +392,26 @@ class FaceCascadeDetector:
         self.mouth_det = CascadeDetector('cascades/haarcascade_smile.xml')
 
 
+    @timed('detect.FaceCascadeDetector')
     def detect(self, frame):
-
-        faces = self.face_det.detect(frame)
+        """
+        Detects faces and their eyes and mouth.
+        The frame is converted to grayscale once and landmarks are only
+        searched in the part of the face where they can be: eyes in the
+        upper half and the mouth in the lower third, with sizes bounded
+        by the face size.
+        :param frame: camera frame or image, BGR or grayscale
+        :return: list of bounding boxes with keypoints
+        """
+        gray = to_grayscale(frame)
+        faces = self.face_det.detect(gray)
         bounding_boxes = []
         for (x,y,w,h) in faces:
-            sub_frame = frame[y:y + h, x:x + w]
-            r_eyes = self.r_eye_det.detect(sub_frame)
+            #regions are at least one cascade window tall for small faces
+            eye_frame = gray[y:y + max(h//2, self.r_eye_det.window[1]), x:x + w]
+            eye_min = (max(1, w//8), max(1, h//8))
+            eye_max = (w//2, h//4)
+            r_eyes = self.r_eye_det.detect(eye_frame, min_size=eye_min, max_size=eye_max)
             
             if len(r_eyes) > 0:
                 r_eye_sub_x, r_eye_sub_y, r_eye_w, r_eye_h = r_eyes[0]
@@ -142,7 +420,7 @@ class FaceCascadeDetector:
             else:
                 r_eye_x = r_eye_y = 0
 
-            l_eyes = self.l_eye_det.detect(sub_frame)
+            l_eyes = self.l_eye_det.detect(eye_frame, min_size=eye_min, max_size=eye_max)
             if len(l_eyes) > 0:
                 
                 l_eye_sub_x, l_eye_sub_y, l_eye_w, l_eye_h = l_eyes[0]
@@ -159,12 +437,15 @@ class FaceCascadeDetector:
             else:
                 nose_y = nose_x = 0
 
-            mouths = self.mouth_det.detect(sub_frame)
+            mouth_y = y + min((2 * h)//3, max(0, h - self.mouth_det.window[1]))
+            mouth_frame = gray[mouth_y:y + h, x:x + w]
+            mouths = self.mouth_det.detect(mouth_frame,
+                min_size=(max(1, w//4), max(1, h//10)), max_size=(w, h//3))
             
             if len(mouths) > 0:
                 mouth_sub_x, mouth_sub_y, mouth_w, mouth_h = mouths[0]
                 l_mouth_x = mouth_sub_x + x 
-                l_mouth_y = r_mouth_y = mouth_sub_y + y + mouth_h/2
+                l_mouth_y = r_mouth_y = mouth_sub_y + mouth_y + mouth_h/2
                 r_mouth_x = mouth_sub_x + x + mouth_w
             else:
                 l_mouth_x = l_mouth_y = r_mouth_y = r_mouth_x = 0
@@ -184,12 +465,37 @@ class FaceCascadeDetector:
     def assign_detection(self, frame, x, y):
         pass
 
+def to_grayscale(frame):
+    """
+    Converts a BGR frame to grayscale, grayscale frames are returned as is
+    :param frame: camera frame or image
+    :return: single channel frame
+    """
+    if frame.ndim == 2:
+        return frame
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
 class CascadeDetector:
     def __init__(self, cascade_path) -> None:
         self.cascade = cv2.CascadeClassifier(cascade_path)
-    def detect(self, frame, display = True):
-        grayscale_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        bounding_boxes = self.cascade.detectMultiScale(grayscale_frame, 1.3, 5)
+        #smallest object the cascade can find, as (w, h)
+        self.window = tuple(self.cascade.getOriginalWindowSize())
+    @timed('detect.CascadeDetector')
+    def detect(self, frame, display = True, min_size = None, max_size = None):
+        """
+        Detects objects with the cascade
+        :param frame: camera frame or image, BGR or grayscale. Grayscale
+        views of a larger frame are searched without copying.
+        :param min_size: smallest object size as (w, h)
+        :param max_size: largest object size as (w, h), raised to at least
+        the cascade window so small objects can still be found
+        :return: array of bounding boxes in x, y, w, h format
+        """
+        if max_size is not None:
+            max_size = (max(max_size[0], self.window[0]), max(max_size[1], self.window[1]))
+        grayscale_frame = to_grayscale(frame)
+        bounding_boxes = self.cascade.detectMultiScale(grayscale_frame, 1.3, 5,
+            minSize=min_size or (0, 0), maxSize=max_size or (0, 0))
         
         
             
@@ -197,30 +503,234 @@ class CascadeDetector:
     def assign_detection(self, frame, x, y):
         pass
 
+#compact detection record returned by array based detectors
+DETECTION_DTYPE = np.dtype([('box', np.int32, (4,)), ('confidence', np.float32)])
+
+def to_dicts(detections):
+    """
+    Legacy view of a detection array
+    :param detections: structured array of DETECTION_DTYPE
+    :return: list of dicts with 'box' and 'confidence' entries
+    """
+    return [{'box': box, 'confidence': confidence}
+            for box, confidence in zip(detections['box'].tolist(), detections['confidence'].tolist())]
+
+def non_max_suppression(detections, threshold):
+    """
+    Removes detections that overlap a more confident detection
+    :param detections: structured array of DETECTION_DTYPE
+    :param threshold: IoU above which the less confident box is removed
+    :return: kept detections ordered by confidence
+    """
+    if len(detections) < 2:
+        return detections
+    keep = cv2.dnn.NMSBoxes(detections['box'].tolist(), detections['confidence'].tolist(),
+                            0.0, threshold)
+    return detections[np.asarray(keep, dtype=np.int64).reshape(-1)]
+
 class OpenCVDNNDetector:
-    def __init__(self, width, height) -> None:
+    def __init__(self, width, height, confidence = 0.5, nms_threshold = 0.4) -> None:
+        """
+        New instance of OpenCV DNN face detector
+        :param width: width of frames
+        :param height: height of frames
+        :param confidence: minimum detection confidence
+        :param nms_threshold: IoU above which overlapping boxes are
+        suppressed, None disables suppression
+        """
         self.width = width
         self.height = height
+        self.confidence = confidence
+        self.nms_threshold = nms_threshold
         self.model_file = "models/res10_300x300_ssd_iter_140000.caffemodel"
         self.config_file =  "models/deploy.prototxt.txt"
         self.model = cv2.dnn.readNetFromCaffe(self.config_file, self.model_file)
-    def detect(self, frame):
-        blob = cv2.dnn.blobFromImage(cv2.resize(frame, (300, 300)), 1.0,
-                            (300, 300), (104.0, 117.0, 123.0))
+    @timed('detect.OpenCVDNNDetector')
+    def detect(self, frame, legacy = False):
+        """
+        Detects faces in one frame
+        :param frame: camera frame or image
+        :param legacy: return a list of dicts instead of an array
+        :return: structured array of DETECTION_DTYPE with boxes in
+        x, y, w, h format
+        """
+        return self.detect_batch([frame], legacy)[0]
+    @timed('detect.OpenCVDNNDetector.batch')
+    def detect_batch(self, frames, legacy = False):
+        """
+        Detects faces in many frames with a single forward pass
+        :param frames: list of frames, e.g. from several cameras or
+        tiles of one frame. Frames may differ in size.
+        :param legacy: return lists of dicts instead of arrays
+        :return: detections for each frame
+        """
+        blob = cv2.dnn.blobFromImages([cv2.resize(frame, (300, 300)) for frame in frames],
+                            1.0, (300, 300), (104.0, 117.0, 123.0))
         self.model.setInput(blob)
         faces = self.model.forward()
+        sizes = np.array([(frame.shape[1], frame.shape[0]) for frame in frames], dtype=np.float32)
+        bounding_boxes = self.decode(faces, sizes)
+        if legacy:
+            return [to_dicts(detections) for detections in bounding_boxes]
+        return bounding_boxes
+    @timed('detect.OpenCVDNNDetector.tiles')
+    def detect_tiles(self, frame, rows = 2, cols = 2, overlap = 0.1, legacy = False):
+        """
+        Splits a frame into overlapping tiles and detects on all tiles in
+        one batch, so small faces are seen at a higher resolution
+        :param frame: camera frame or image
+        :param rows: number of tile rows
+        :param cols: number of tile columns
+        :param overlap: fraction of a tile shared with its neighbours
+        :param legacy: return a list of dicts instead of an array
+        :return: detections in frame coordinates
+        """
+        height, width = frame.shape[:2]
+        tile_h = int(height / (rows - (rows - 1) * overlap))
+        tile_w = int(width / (cols - (cols - 1) * overlap))
+        tiles = []
+        offsets = []
+        for row in range(rows):
+            for col in range(cols):
+                y = min(height - tile_h, int(row * tile_h * (1 - overlap)))
+                x = min(width - tile_w, int(col * tile_w * (1 - overlap)))
+                tiles.append(frame[y:y + tile_h, x:x + tile_w])
+                offsets.append((x, y))
+        detections = self.detect_batch(tiles)
+        for (x, y), tile_detections in zip(offsets, detections):
+            tile_detections['box'][:, :2] += (x, y)
+        bounding_boxes = np.concatenate(detections)
+        if self.nms_threshold is not None:
+            #faces in the overlap are found by two tiles
+            bounding_boxes = non_max_suppression(bounding_boxes, self.nms_threshold)
+        if legacy:
+            return to_dicts(bounding_boxes)
+        return bounding_boxes
+    def decode(self, faces, sizes):
+        """
+        Converts SSD output rows to bounding boxes for every frame.
+        Rows are thresholded, scaled and clipped to the frame in one
+        array operation, then overlapping boxes are suppressed.
+        :param faces: network output of shape (1, 1, N, 7), column 0 is
+        the frame index in the batch
+        :param sizes: width and height of each frame, shape (frames, 2)
+        :return: structured array of DETECTION_DTYPE for each frame
+        """
+        rows = faces[0, 0]
+        rows = rows[rows[:, 2] > self.confidence]
+        image = rows[:, 0].astype(np.int64)
+        scale = np.tile(sizes[image], 2)
+        corners = np.clip(rows[:, 3:7], 0.0, 1.0) * scale
+        detections = np.empty(len(rows), dtype=DETECTION_DTYPE)
+        detections['box'] = corners
+        detections['box'][:, 2:] -= detections['box'][:, :2]
+        detections['confidence'] = rows[:, 2]
+        #drop boxes that were clipped to nothing
+        valid = (detections['box'][:, 2] > 0) & (detections['box'][:, 3] > 0)
+
         bounding_boxes = []
-        for i in range(faces.shape[2]):
-            confidence = faces[0, 0, i, 2]
-            if confidence > 0.5:
-                box = faces[0, 0, i, 3:7] * np.array([self.width, self.height, self.width, self.height])
-                (x, y, x1, y1) = box.astype("int")
-                w = x1 - x
-                h = y1 - y
-                bounding_boxes.append({
-                    'box': [x, y, w, h],
-                    'confidence': confidence
-                })
+        for index in range(len(sizes)):
+            frame_detections = detections[valid & (image == index)]
+            if self.nms_threshold is not None:
+                frame_detections = non_max_suppression(frame_detections, self.nms_threshold)
+            bounding_boxes.append(frame_detections)
         return bounding_boxes
     def assign_detection(self, frame, x, y):
-        pass
\ No newline at end of file
+        pass
+
+def offset_detections(detections, x, y):
+    """
+    Moves detections found in a crop back to full frame coordinates
+    :param detections: list of dicts with 'box' and optional 'keypoints'
+    entries or a structured detection array
+    :param x: x coord of the crop in the frame
+    :param y: y coord of the crop in the frame
+    :return: detections in frame coordinates
+    """
+    if isinstance(detections, np.ndarray):
+        detections['box'][:, :2] += (x, y)
+        return detections
+    for detection in detections:
+        box = detection['box']
+        detection['box'] = [box[0] + x, box[1] + y, box[2], box[3]]
+        keypoints = detection.get('keypoints')
+        if keypoints is not None:
+            for name, (point_x, point_y) in keypoints.items():
+                #landmarks that were not found stay at 0, 0
+                if point_x or point_y:
+                    keypoints[name] = (point_x + x, point_y + y)
+    return detections
+
+class ROIDetector:
+    """
+    Runs a detector only around the tracked object.
+    While the track is healthy the wrapped detector sees an expanded
+    crop around the tracker's predicted box. The full frame is scanned
+    every full_frame_interval frames and whenever the track is lost.
+    """
+    def __init__(self, detector, tracker, margin = 1.0, full_frame_interval = 15,
+                 max_lost = 2, sigmas = 2.0) -> None:
+        """
+        New region of interest detector
+        :param detector: any detector from this module
+        :param tracker: CostBasedTracker following the object
+        :param margin: crop padding on each side as a fraction of the box size
+        :param full_frame_interval: frames between full frame scans
+        :param max_lost: lost frames after which the full frame is scanned
+        :param sigmas: extra padding in standard deviations of the
+        predicted position
+        """
+        self.detector = detector
+        self.tracker = tracker
+        self.margin = margin
+        self.full_frame_interval = full_frame_interval
+        self.max_lost = max_lost
+        self.sigmas = sigmas
+        self.frame_count = 0
+        self.roi = None
+
+    def region(self, frame, lost_track_frames):
+        """
+        Crop to search in the next frame
+        :param frame: camera frame or image
+        :param lost_track_frames: number of frames the object has not
+        been seen
+        :return: x, y, x1, y1 of the crop or None for a full frame scan
+        """
+        if (len(self.tracker.location_history) == 0 or lost_track_frames > self.max_lost
+                or self.frame_count % self.full_frame_interval == 0):
+            return None
+        (pred_x, pred_y), pred_w, pred_h = self.tracker.location_prediction(lost_track_frames)
+        pad_x = self.margin * pred_w
+        pad_y = self.margin * pred_h
+        covariance = self.tracker.prediction_covariance(lost_track_frames)
+        if covariance is not None:
+            pad_x += self.sigmas * np.sqrt(covariance[0, 0])
+            pad_y += self.sigmas * np.sqrt(covariance[1, 1])
+        height, width = frame.shape[:2]
+        x = int(max(0, pred_x - pad_x))
+        y = int(max(0, pred_y - pad_y))
+        x1 = int(min(width, pred_x + pred_w + pad_x))
+        y1 = int(min(height, pred_y + pred_h + pad_y))
+        if x1 - x < 2 or y1 - y < 2:
+            return None
+        return x, y, x1, y1
+
+    @timed('detect.ROIDetector')
+    def detect(self, frame, lost_track_frames = 0):
+        """
+        Detects in the region of interest or the full frame
+        :param frame: camera frame or image
+        :param lost_track_frames: number of frames the object has not
+        been seen
+        :return: detections in full frame coordinates
+        """
+        self.roi = self.region(frame, lost_track_frames)
+        self.frame_count += 1
+        if self.roi is None:
+            return self.detector.detect(frame)
+        x, y, x1, y1 = self.roi
+        return offset_detections(self.detector.detect(frame[y:y1, x:x1]), x, y)
+
+    def assign_detection(self, frame, x, y):
+        return self.detector.assign_detection(frame, x, y)
@@ -5,16 +5,18 @@ def draw_points(frame, point_sets, type = 'box'):
     Draws bounding boxes and facial landmarks on frame
     :param frame: camera frame or image to be modified
     :param point_sets: list of bounding box and landmark coordinates
+    or a structured detection array
     :param type: box or face. Indicates if list contains landmarks
     
     """
     for point_set in point_sets:
-        bounding_box = point_set['box']
+        #boxes may be lists, tuples or rows of a detection array
+        x, y, w, h = [int(value) for value in point_set['box']]
         
         if type == 'box':
             cv2.rectangle(frame,
-              (bounding_box[0], bounding_box[1]),
-              (bounding_box[0]+bounding_box[2], bounding_box[1] + bounding_box[3]),
+              (x, y),
+              (x + w, y + h),
               (0,155,255),
               2)
         elif type == 'face':
@@ -0,0 +1,175 @@
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+class FrameRing:
+    """
+    Ring of preallocated frame slots in shared memory.
+    A single writer claims a slot, captures straight into it and
+    publishes it with a sequence number. Readers in other threads or
+    processes use views of the slots without copying. A slot pinned by a
+    reader is skipped by the writer, and valid() tells a reader whether
+    an unpinned slot was overwritten while it was being used.
+    """
+    def __init__(self, shape, dtype = np.uint8, slots = 8, name = None, create = True) -> None:
+        """
+        New frame ring
+        :param shape: frame shape, e.g. (480, 640, 3)
+        :param dtype: frame data type
+        :param slots: number of frame slots
+        :param name: shared memory name, None picks a free name
+        :param create: create the shared memory, False attaches to an existing ring
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        #header: latest sequence, then per slot sequence, timestamp and pin count
+        header = 8 * (1 + 3 * slots)
+        header += -header % 64
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.memory = shared_memory.SharedMemory(name=name, create=create, size=header + slots * frame_bytes)
+        self.name = self.memory.name
+        buffer = self.memory.buf
+        self._head = np.ndarray((1,), dtype=np.int64, buffer=buffer)
+        self.sequences = np.ndarray((slots,), dtype=np.int64, buffer=buffer, offset=8)
+        self.timestamps = np.ndarray((slots,), dtype=np.float64, buffer=buffer, offset=8 + 8 * slots)
+        self.pins = np.ndarray((slots,), dtype=np.int64, buffer=buffer, offset=8 + 16 * slots)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=buffer, offset=header)
+        if create:
+            self._head[0] = 0
+            self.sequences[:] = 0
+            self.pins[:] = 0
+        self._lock = threading.Lock()
+        self._next = 0
+        self._claimed = None
+
+    @classmethod
+    def attach(cls, name, shape, dtype = np.uint8, slots = 8):
+        """
+        Opens a ring created by another process
+        :param name: shared memory name of the ring
+        :return: FrameRing
+        """
+        return cls(shape, dtype, slots, name, create=False)
+
+    @property
+    def head(self):
+        """Sequence number of the newest published frame, 0 if none"""
+        return int(self._head[0])
+
+    def _slot(self, sequence):
+        found = np.flatnonzero(self.sequences == sequence)
+        return int(found[0]) if found.size > 0 and sequence > 0 else None
+
+    def claim(self):
+        """
+        Next free slot for the writer, a claimed slot that is never
+        published stays empty
+        :return: sequence number and slot view, or (None, None) if every
+        slot is pinned
+        """
+        with self._lock:
+            for step in range(self.slots):
+                index = (self._next + step) % self.slots
+                if self.pins[index] == 0:
+                    self._next = (index + 1) % self.slots
+                    self._claimed = index
+                    #negative marks the slot as being written
+                    self.sequences[index] = -1
+                    return self.head + 1, self.frames[index]
+        return None, None
+
+    def publish(self, sequence, timestamp):
+        """
+        Makes a claimed slot visible to readers
+        :param sequence: sequence number returned by claim
+        :param timestamp: capture time of the frame
+        """
+        index = self._claimed
+        self._claimed = None
+        self.timestamps[index] = timestamp
+        self.sequences[index] = sequence
+        self._head[0] = sequence
+
+    def write(self, frame, timestamp):
+        """
+        Copies a frame into the ring, for sources that cannot read into a slot
+        :param frame: frame of the ring's shape and type
+        :param timestamp: capture time of the frame
+        :return: sequence number or None if every slot is pinned
+        """
+        sequence, slot = self.claim()
+        if sequence is None:
+            return None
+        np.copyto(slot, frame)
+        self.publish(sequence, timestamp)
+        return sequence
+
+    def get(self, sequence):
+        """
+        View of a published frame without pinning it
+        :param sequence: sequence number
+        :return: frame view or None if it was overwritten
+        """
+        index = self._slot(sequence)
+        return None if index is None else self.frames[index]
+
+    def latest(self):
+        """
+        Newest published frame
+        :return: sequence number, timestamp and frame view, or None
+        """
+        sequence = self.head
+        index = self._slot(sequence)
+        if index is None:
+            return None
+        return sequence, float(self.timestamps[index]), self.frames[index]
+
+    def acquire(self, sequence):
+        """
+        Pins a frame so the writer does not reuse its slot, pins are
+        only locked within the writing process so other processes should
+        use get and valid
+        :param sequence: sequence number
+        :return: frame view or None if it was already overwritten
+        """
+        with self._lock:
+            index = self._slot(sequence)
+            if index is None:
+                return None
+            self.pins[index] += 1
+            return self.frames[index]
+
+    def release(self, sequence):
+        """
+        Unpins a frame pinned with acquire
+        :param sequence: sequence number
+        """
+        with self._lock:
+            index = self._slot(sequence)
+            if index is not None and self.pins[index] > 0:
+                self.pins[index] -= 1
+
+    def valid(self, sequence):
+        """
+        Whether a frame is still in the ring, check after using an unpinned view
+        :param sequence: sequence number
+        :return: True if the slot still holds the frame
+        """
+        return self._slot(sequence) is not None
+
+    def close(self):
+        """Detaches from the shared memory, views must no longer be used"""
+        del self._head, self.sequences, self.timestamps, self.pins, self.frames
+        try:
+            self.memory.close()
+        except BufferError:
+            #views are still held by a consumer, freed when they are dropped
+            pass
+
+    def unlink(self):
+        """Frees the shared memory once every process has closed it"""
+        self.memory.unlink()
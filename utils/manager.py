@@ -0,0 +1,274 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils.metrics import record
+from utils.pipeline import LatestValueQueue
+from utils.trackers import MultiObjectTracker
+from utils.VISCA_controller import controller
+from utils.visca_client import VISCAClient, VISCA_COMMAND
+
+
+
+class Camera:
+    """
+    One camera managed by CameraManager.
+    Holds the capture source, tracker, controller and VISCA client of
+    the camera, the newest frame and result, and its statistics.
+    """
+    def __init__(self, name, source, tracker, timeout = 0.5) -> None:
+        """
+        New managed camera
+        :param name: unique camera name
+        :param source: cv2.VideoCapture or any object with read() and isOpened() methods
+        :param tracker: MultiObjectTracker for this camera
+        :param timeout: seconds before a stale track stops the camera
+        """
+        self.name = name
+        self.source = source
+        self.tracker = tracker
+        self.timeout = timeout
+        self.controller = None
+        self.client = None
+        #id of the followed track, None follows the largest track
+        self.target_id = None
+
+        self.frames = LatestValueQueue()
+        self.results = LatestValueQueue()
+        self.detecting = False
+        self.frame_id = 0
+        self.moving = False
+
+        self.started_at = None
+        self.captured = 0
+        self.detected = 0
+        self.commands = 0
+        self.latency = 0.0
+        self.detection_time = 0.0
+        #seconds between tracker updates, converts tracker velocity to pixels per second
+        self.detection_interval = None
+        self.last_timestamp = None
+
+    def select(self, ids, boxes):
+        """
+        Picks the tracked box to follow
+        :param ids: confirmed track ids
+        :param boxes: confirmed track boxes
+        :return: x, y, w, h box or None
+        """
+        if len(ids) == 0:
+            return None
+        for track_id, box in zip(ids, boxes):
+            if track_id == self.target_id:
+                return tuple(box)
+        largest = (boxes[:, 2] * boxes[:, 3]).argmax()
+        self.target_id = ids[largest]
+        return tuple(boxes[largest])
+
+    def stats(self):
+        """
+        Rates and latency of the camera
+        :return: dict of statistics, times in seconds
+        """
+        elapsed = max(1e-6, time.monotonic() - self.started_at) if self.started_at else 1
+        stats = {
+            'capture_fps': self.captured / elapsed,
+            'detection_fps': self.detected / elapsed,
+            'command_rate': self.commands / elapsed,
+            'frames_dropped': self.frames.dropped,
+            'latency': self.latency,
+            'detection_time': self.detection_time,
+        }
+        if self.client is not None:
+            stats['visca'] = self.client.stats()
+        return stats
+
+
+
+class CameraManager:
+    """
+    Drives many PTZ cameras from one process.
+    Capture and detection for all cameras share two small thread pools,
+    each detection thread holds its own detector instance, and all
+    VISCA sockets and control loops run on a single asyncio event loop,
+    so the thread count does not grow with the number of cameras.
+    """
+    def __init__(self, detector_factory, detector_workers = 4, capture_workers = 4,
+                 control_rate = 30, smoothing = 0.1) -> None:
+        """
+        New camera manager
+        :param detector_factory: callable returning a new detector, called
+        once per detection thread
+        :param detector_workers: number of detection threads
+        :param capture_workers: number of capture threads, reads block for
+        a frame interval so size this to the cameras' combined frame rate
+        :param control_rate: control updates per second for every camera
+        :param smoothing: weight of the newest sample in latency averages
+        """
+        self.detector_factory = detector_factory
+        self.control_rate = control_rate
+        self.smoothing = smoothing
+        self.cameras = {}
+        self.capture_pool = ThreadPoolExecutor(capture_workers, thread_name_prefix='capture')
+        self.detector_pool = ThreadPoolExecutor(detector_workers, thread_name_prefix='detector')
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = None
+        self._control_task = None
+        self.running = False
+
+    def add_camera(self, name, source, ip_address, port_number = 52381, width = 640,
+                   height = 480, tracker = None, timeout = 0.5):
+        """
+        Adds a camera, must be called before start
+        :param name: unique camera name
+        :param source: cv2.VideoCapture or any object with read() and isOpened() methods
+        :param ip_address: camera ip address
+        :param port_number: camera VISCA over IP port
+        :param width: width of frames
+        :param height: height of frames
+        :param tracker: tracker for the camera, defaults to MultiObjectTracker
+        :param timeout: seconds before a stale track stops the camera
+        :return: the new Camera
+        """
+        if name in self.cameras:
+            raise Exception("camera name already in use")
+        camera = Camera(name, source, tracker or MultiObjectTracker(), timeout)
+        camera.client = VISCAClient(ip_address, port_number)
+        camera.controller = controller(width, height, ip_address=ip_address,
+            port_number=port_number, send=lambda packet, camera=camera: self._send(camera, packet))
+        self.cameras[name] = camera
+        return camera
+
+    def _send(self, camera, packet):
+        """Hands a packet to the camera's client on the event loop"""
+        #pan/tilt and zoom packets coalesce separately
+        key = bytes(packet[2:4])
+        self.loop.call_soon_threadsafe(camera.client.submit, bytes(packet), VISCA_COMMAND, key)
+        camera.commands += 1
+
+    def start(self):
+        """Connects all cameras and starts capture, detection and control"""
+        self.running = True
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name='visca_loop', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._connect(), self.loop).result()
+        for camera in self.cameras.values():
+            camera.started_at = time.monotonic()
+            self.capture_pool.submit(self._capture, camera)
+        self._control_task = asyncio.run_coroutine_threadsafe(self._control(), self.loop)
+
+    async def _connect(self):
+        await asyncio.gather(*[camera.client.connect() for camera in self.cameras.values()])
+
+    def _capture(self, camera):
+        """Reads one frame, then queues the next read so cameras share threads"""
+        if not self.running:
+            return
+        started = time.perf_counter()
+        ok, frame = camera.source.read()
+        if ok:
+            #failed reads return at once and are not counted as captures
+            record('capture', time.perf_counter() - started)
+            camera.frames.put((camera.frame_id, time.monotonic(), frame))
+            camera.frame_id += 1
+            camera.captured += 1
+            with self._lock:
+                start_detection = not camera.detecting
+                camera.detecting = True
+            if start_detection:
+                self.detector_pool.submit(self._detect, camera)
+        elif not camera.source.isOpened():
+            #recorded source ran out, leave the pool to the other cameras
+            return
+        else:
+            time.sleep(0.005)
+        if self.running:
+            self.capture_pool.submit(self._capture, camera)
+
+    def _detector(self):
+        """Detector instance owned by the calling detection thread"""
+        detector = getattr(self._local, 'detector', None)
+        if detector is None:
+            detector = self._local.detector = self.detector_factory()
+        return detector
+
+    def _detect(self, camera):
+        """Detects and tracks on the newest frame of a camera"""
+        item = camera.frames.get(timeout=0)
+        if item is not None and self.running:
+            frame_id, timestamp, frame = item
+            started = time.monotonic()
+            point_sets = self._detector().detect(frame)
+            ids, boxes = camera.tracker.update(point_sets)
+            box = camera.select(ids, boxes)
+            if camera.last_timestamp is not None:
+                interval = timestamp - camera.last_timestamp
+                if camera.detection_interval is None:
+                    camera.detection_interval = interval
+                camera.detection_interval += self.smoothing * (interval - camera.detection_interval)
+            camera.last_timestamp = timestamp
+            velocity = None
+            if box is not None and camera.detection_interval:
+                track_velocity = camera.tracker.get_velocity(camera.target_id)
+                if track_velocity is not None:
+                    velocity = np.divide(track_velocity, camera.detection_interval)
+            camera.results.put((frame_id, timestamp, point_sets, box, velocity))
+            camera.detected += 1
+            camera.detection_time += self.smoothing * (time.monotonic() - started - camera.detection_time)
+        with self._lock:
+            #keep going while newer frames arrived during detection
+            if self.running and camera.frames.peek()[1]:
+                self.detector_pool.submit(self._detect, camera)
+            else:
+                camera.detecting = False
+
+    async def _control(self):
+        """Fixed rate control loop for all cameras"""
+        period = 1.0 / self.control_rate
+        next_tick = self.loop.time()
+        while self.running:
+            now = time.monotonic()
+            for camera in self.cameras.values():
+                item, fresh = camera.results.peek()
+                if item is not None and item[3] is not None and now - item[1] < camera.timeout:
+                    #only new results reach the PID, the last command keeps running in between
+                    if fresh:
+                        camera.results.get(timeout=0)
+                        camera.latency += self.smoothing * (now - item[1] - camera.latency)
+                        #aim where the target will be when the command arrives
+                        camera.controller.follow(item[3], item[4], now - item[1])
+                        camera.moving = True
+                elif camera.moving:
+                    camera.controller.stop()
+                    camera.moving = False
+            next_tick = max(next_tick + period, self.loop.time())
+            await asyncio.sleep(next_tick - self.loop.time())
+
+    def stop(self):
+        """Stops all cameras, threads and the event loop"""
+        self.running = False
+        if self._control_task is not None:
+            #a control iteration in progress could still send a drive command after the stop
+            self._control_task.result()
+        #controllers are only used by the control loop, which has exited
+        for camera in self.cameras.values():
+            camera.controller.stop()
+        self.capture_pool.shutdown(wait=True)
+        self.detector_pool.shutdown(wait=True)
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), self.loop).result()
+        for camera in self.cameras.values():
+            self.loop.call_soon_threadsafe(camera.client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join(timeout=1)
+
+    def stats(self):
+        """
+        Statistics of every camera
+        :return: dict of camera name to statistics
+        """
+        return {name: camera.stats() for name, camera in self.cameras.items()}
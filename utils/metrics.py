@@ -0,0 +1,257 @@
+import functools
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+
+#set PTZ_METRICS=1 or call enable() to record spans and decorated
+#functions, while disabled each timed call costs one branch
+ENABLED = os.environ.get('PTZ_METRICS', '0') not in ('', '0')
+
+
+
+class _Ring:
+    """Recent samples recorded by one thread"""
+    __slots__ = ('samples', 'index', 'count')
+
+    def __init__(self, size) -> None:
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+
+    def recent(self):
+        return self.samples[:min(self.count, self.samples.size)]
+
+
+
+class Histogram:
+    """
+    Latency samples of one stage in fixed size ring buffers.
+    Every thread recording the stage gets its own ring, so threads of a
+    pool sharing a stage name never lose samples, and summary() merges
+    the rings. Recording overwrites the thread's oldest sample and never
+    allocates after its first call, so statistics cover recent samples.
+    """
+    def __init__(self, size = 1024) -> None:
+        """
+        New histogram
+        :param size: number of recent samples kept per thread
+        """
+        self.size = size
+        self._local = threading.local()
+        self._rings = []
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        """Samples recorded since the last reset by all threads"""
+        return sum(ring.count for ring in self._rings)
+
+    def record(self, value):
+        """
+        Adds a sample
+        :param value: duration in seconds
+        """
+        ring = getattr(self._local, 'ring', None)
+        if ring is None:
+            ring = self._local.ring = _Ring(self.size)
+            with self._lock:
+                self._rings.append(ring)
+        ring.samples[ring.index] = value
+        ring.index = (ring.index + 1) % self.size
+        ring.count += 1
+
+    def summary(self):
+        """
+        Statistics of the recent samples
+        :return: dict with the total count, and mean, p50, p99 and max in
+        seconds of the recent samples
+        """
+        with self._lock:
+            rings = list(self._rings)
+        recent = [ring.recent() for ring in rings if ring.count > 0]
+        if len(recent) == 0:
+            return {'count': 0}
+        recent = np.concatenate(recent)
+        p50, p99 = np.percentile(recent, (50, 99))
+        return {'count': sum(ring.count for ring in rings), 'mean': float(recent.mean()),
+                'p50': float(p50), 'p99': float(p99), 'max': float(recent.max())}
+
+    def reset(self):
+        """Drops all samples"""
+        with self._lock:
+            for ring in self._rings:
+                ring.index = ring.count = 0
+
+
+
+class _Span:
+    """Times a with block into a histogram"""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.record(time.perf_counter() - self.start)
+
+
+
+class _NullSpan:
+    """Shared do-nothing span used while metrics are disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_SPAN = _NullSpan()
+_histograms = {}
+_lock = threading.Lock()
+_started = time.monotonic()
+
+
+def enable():
+    """Starts recording spans"""
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    """Stops recording spans, spans then return a shared no-op"""
+    global ENABLED
+    ENABLED = False
+
+def histogram(name, size = 1024):
+    """
+    Histogram of a stage, created on first use
+    :param name: stage name, e.g. 'detect.ColorDetector'
+    :param size: number of recent samples kept per thread
+    :return: Histogram
+    """
+    found = _histograms.get(name)
+    if found is None:
+        with _lock:
+            found = _histograms.setdefault(name, Histogram(size))
+    return found
+
+def span(name):
+    """
+    Times a block of code
+    with metrics.span('capture'):
+        ok, frame = cam.read()
+    :param name: stage name
+    :return: context manager
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(histogram(name))
+
+def record(name, value):
+    """
+    Adds a sample to a stage while metrics are enabled, for code where
+    only some runs of a block should count, e.g. successful reads
+    :param name: stage name
+    :param value: duration in seconds
+    """
+    if ENABLED:
+        histogram(name).record(value)
+
+def timed(name = None):
+    """
+    Decorator timing every call of a function while metrics are enabled
+    :param name: stage name, defaults to the qualified function name
+    :return: decorator
+    """
+    def decorate(function):
+        stage = histogram(name or function.__qualname__)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stage.record(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def snapshot():
+    """
+    Statistics of every stage
+    :return: dict of stage name to summary of stages with samples, plus
+    uptime in seconds
+    """
+    with _lock:
+        items = list(_histograms.items())
+    stages = {name: stage.summary() for name, stage in sorted(items) if stage.count > 0}
+    return {'uptime': time.monotonic() - _started, 'stages': stages}
+
+def reset():
+    """Drops all recorded samples, histograms stay registered"""
+    with _lock:
+        stages = list(_histograms.values())
+    for stage in stages:
+        stage.reset()
+
+def write(path):
+    """
+    Writes a snapshot to a JSON file, replacing it atomically
+    :param path: file path
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(snapshot(), file, indent=4)
+    os.replace(temporary, path)
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(snapshot()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port = 9100, host = '127.0.0.1'):
+    """
+    Serves snapshots as JSON over HTTP from a background thread
+    :param port: port to listen on
+    :param host: address to listen on, local only by default
+    :return: server, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+def export(path, interval = 5.0):
+    """
+    Writes a snapshot to a file periodically from a background thread
+    :param path: file path
+    :param interval: seconds between writes
+    :return: threading.Event, set it to stop exporting
+    """
+    stop = threading.Event()
+    def run():
+        while not stop.wait(interval):
+            write(path)
+        write(path)
+    threading.Thread(target=run, name='metrics_export', daemon=True).start()
+    return stop
@@ -0,0 +1,134 @@
+import math
+import time
+
+
+
+class AxisPID:
+    """
+    PID state for one camera axis.
+    Runs at a fixed rate with real timestamps so the response does not
+    depend on the frame rate. The derivative is taken on the measurement
+    over a short ring buffer and low-pass filtered, and the integral is
+    clamped and frozen while the output is saturated (anti-windup).
+    Errors are measurement minus target, as in controller.follow.
+    """
+    def __init__(self, rate = 30, length = 3) -> None:
+        """
+        New axis controller
+        :param rate: updates per second, calls in between hold the output
+        :param length: samples used for the derivative
+        """
+        self.period = 1.0 / rate
+        self.p_gain = 1.0
+        self.p_slope = 1.0
+        self.p_shape = 1.0
+        self.i_gain = 0.0
+        self.i_limit = 1.0
+        self.d_gain = 0.0
+        self.d_filter = 1.0
+        self.output_limit = 1.0
+
+        self.length = 0
+        self.set_length(length)
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.output = 0.0
+        self.last_time = None
+
+    def configure(self, p_gain, p_slope, p_shape, i_gain, d_gain, d_filter = 1.0,
+                  length = None, i_limit = None):
+        """
+        Sets the gains
+        :param p_gain: contribution of the proportional term
+        :param p_slope: proportional response is p_slope/10 * |error|^p_shape
+        :param p_shape: exponent of the proportional response
+        :param i_gain: contribution of the integral term, per second
+        :param d_gain: contribution of the derivative term, in seconds
+        :param d_filter: derivative low-pass time constant in update periods
+        :param length: samples used for the derivative
+        :param i_limit: largest integral term, defaults to the output limit
+        """
+        self.p_gain = p_gain
+        self.p_slope = p_slope
+        self.p_shape = p_shape
+        self.i_gain = i_gain
+        self.d_gain = d_gain
+        self.d_filter = d_filter
+        self.i_limit = self.output_limit if i_limit is None else i_limit
+        if length is not None and length != self.length:
+            self.set_length(length)
+
+    def set_length(self, length):
+        """
+        Resizes the derivative ring buffer
+        :param length: samples used for the derivative, at least 2
+        """
+        self.length = max(2, int(length))
+        self._times = [0.0] * self.length
+        self._measurements = [0.0] * self.length
+        self._index = 0
+        self._count = 0
+
+    def reset(self):
+        """Clears the integral, derivative and history"""
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.output = 0.0
+        self.last_time = None
+        self._index = 0
+        self._count = 0
+
+    def proportional(self, error):
+        """
+        Shaped proportional response, keeps the sign of the error
+        :param error: measurement minus target
+        :return: proportional response clamped to the output limit
+        """
+        response = (self.p_slope / 10) * abs(error) ** self.p_shape
+        return math.copysign(min(self.output_limit, response), error)
+
+    def update(self, error, measurement, now = None):
+        """
+        Computes the output for a new error
+        :param error: measurement minus target
+        :param measurement: measured position, used for the derivative
+        :param now: monotonic time in seconds, defaults to the current time
+        :return: output clamped to the output limit
+        """
+        if now is None:
+            now = time.monotonic()
+        #half a period of slack so frame jitter does not skip updates
+        if self.last_time is not None and now - self.last_time < 0.5 * self.period:
+            return self.output
+        #long gaps are treated as a few missed periods, not a jump
+        dt = self.period if self.last_time is None else min(now - self.last_time, 5 * self.period)
+        self.last_time = now
+
+        #derivative on measurement over the ring buffer, filtered
+        if self._count > 0:
+            #oldest sample, overwritten below once the buffer is full
+            oldest = (self._index - self._count) % self.length if self._count < self.length else self._index
+            span = now - self._times[oldest]
+            if span > 0:
+                slope = (measurement - self._measurements[oldest]) / span
+                alpha = dt / (self.d_filter * self.period + dt)
+                self.derivative += alpha * (slope - self.derivative)
+        self._times[self._index] = now
+        self._measurements[self._index] = measurement
+        self._index = (self._index + 1) % self.length
+        self._count = min(self._count + 1, self.length)
+
+        p = self.p_gain * self.proportional(error)
+        d = self.d_gain * self.derivative
+        output = p + self.i_gain * self.integral + d
+
+        #anti-windup: only integrate when it does not push further into saturation
+        saturated = abs(output) >= self.output_limit and (output > 0) == (error > 0)
+        if not saturated and self.i_gain != 0:
+            self.integral += error * dt
+            limit = self.i_limit / self.i_gain
+            self.integral = max(-abs(limit), min(abs(limit), self.integral))
+            output = p + self.i_gain * self.integral + d
+
+        self.output = max(-self.output_limit, min(self.output_limit, output))
+        return self.output
@@ -0,0 +1,433 @@
+import threading
+import time
+
+import numpy as np
+
+from utils.frame_ring import FrameRing
+from utils.metrics import record
+
+
+
+class LatestValueQueue:
+    """
+    Single slot queue between pipeline stages.
+    Putting a value replaces any value that has not been read yet, so a
+    slow consumer always sees the newest item and never builds a backlog.
+    """
+    def __init__(self) -> None:
+        """
+        New latest value queue
+        """
+        self._condition = threading.Condition()
+        self._value = None
+        self._sequence = 0
+        self._read_sequence = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, value):
+        """
+        Stores a value, replacing any unread value
+        :param value: item to hand to the next stage
+        """
+        with self._condition:
+            if self._sequence != self._read_sequence:
+                self.dropped += 1
+            self._value = value
+            self._sequence += 1
+            self._condition.notify_all()
+
+    def get(self, timeout = None):
+        """
+        Waits for a value newer than the last one read
+        :param timeout: seconds to wait, None waits forever
+        :return: newest value or None on timeout or when closed
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: self.closed or self._sequence != self._read_sequence, timeout):
+                return None
+            if self._sequence == self._read_sequence:
+                return None
+            self._read_sequence = self._sequence
+            return self._value
+
+    def peek(self):
+        """
+        Returns the newest value without consuming it
+        :return: newest value and True if it has not been read by get
+        """
+        with self._condition:
+            return self._value, self._sequence != self._read_sequence
+
+    def close(self):
+        """Wakes up all waiting consumers so their stage can exit"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+
+class Stage(threading.Thread):
+    """Base class for a pipeline thread that can be stopped"""
+    def __init__(self, name) -> None:
+        """
+        New pipeline stage
+        :param name: thread name
+        """
+        super().__init__(name=name, daemon=True)
+        self.running = threading.Event()
+        self.running.set()
+        self.count = 0
+        self.started_at = None
+
+    def stop(self):
+        self.running.clear()
+
+    def fps(self):
+        """
+        Average rate of the stage since it started
+        :return: iterations per second
+        """
+        if self.started_at is None:
+            return 0.0
+        return self.count / max(1e-6, time.monotonic() - self.started_at)
+
+
+
+class CaptureThread(Stage):
+    """
+    Reads frames from a camera as fast as it delivers them.
+    Only the newest frame is kept, so detection always starts on the
+    freshest image available. With a frame ring the camera decodes
+    straight into a shared memory slot and consumers get views of it,
+    so a frame is written once and never copied or allocated. The stage
+    ends when a replay source runs out of frames.
+    """
+    def __init__(self, cam, output, ring_slots = 0) -> None:
+        """
+        New capture stage
+        :param cam: cv2.VideoCapture or any object with read() and isOpened() methods
+        :param output: LatestValueQueue receiving (frame_id, timestamp, frame),
+        frame_id is the ring sequence number when a ring is used
+        :param ring_slots: frame ring slots, 0 allocates a frame per read,
+        needs more slots than frames held at once by consumers
+        """
+        super().__init__('capture')
+        self.cam = cam
+        self.output = output
+        self.ring = None
+        self.ring_full = 0
+        #set when the source had no frames left
+        self.exhausted = False
+        self._read_into = True
+        if ring_slots > 0:
+            #the first frame sizes the ring and is its first entry
+            ok, frame = cam.read()
+            if not ok:
+                raise Exception("could not read a frame to size the frame ring")
+            self.ring = FrameRing(frame.shape, frame.dtype, ring_slots)
+            timestamp = time.monotonic()
+            frame_id = self.ring.write(frame, timestamp)
+            self.output.put((frame_id, timestamp, self.ring.get(frame_id)))
+
+    def _read(self, slot):
+        """Reads into a ring slot, copying once for cameras without a buffer argument"""
+        if self._read_into:
+            try:
+                ok, frame = self.cam.read(slot)
+            except TypeError:
+                self._read_into = False
+        if not self._read_into:
+            ok, frame = self.cam.read()
+        if ok and frame is not slot:
+            np.copyto(slot, frame)
+        return ok
+
+    def run(self):
+        self.started_at = time.monotonic()
+        frame_id = 0
+        while self.running.is_set():
+            if self.ring is not None:
+                frame_id, frame = self.ring.claim()
+                if frame_id is None:
+                    #every slot is held by a consumer
+                    self.ring_full += 1
+                    time.sleep(0.005)
+                    continue
+                started = time.perf_counter()
+                ok = self._read(frame)
+            else:
+                started = time.perf_counter()
+                ok, frame = self.cam.read()
+            timestamp = time.monotonic()
+            if not ok:
+                if not self.cam.isOpened():
+                    #end of a replay, consumers finish the last frame and exit
+                    self.exhausted = True
+                    break
+                time.sleep(0.005)
+                continue
+            #failed reads return at once and are not counted as captures
+            record('capture', time.perf_counter() - started)
+            if self.ring is not None:
+                self.ring.publish(frame_id, timestamp)
+            self.output.put((frame_id, timestamp, frame))
+            frame_id += 1
+            self.count += 1
+        self.output.close()
+
+
+
+class DetectionWorker(Stage):
+    """
+    Runs detection and tracking on the newest captured frame.
+    Frames that arrive while a detection is running are dropped.
+    """
+    def __init__(self, process, frames, output, recorder = None, ring = None, smoothing = 0.1) -> None:
+        """
+        New detection stage
+        :param process: callable taking a frame and returning a result,
+        usually detection followed by a tracker update
+        :param frames: LatestValueQueue of (frame_id, timestamp, frame)
+        :param output: LatestValueQueue receiving
+        (frame_id, timestamp, frame, result)
+        :param recorder: Recorder receiving the detections, optional
+        :param ring: FrameRing the frames are views of, the frame is pinned
+        while it is processed
+        :param smoothing: weight of the newest sample in the interval average
+        """
+        super().__init__('detection')
+        self.process = process
+        self.frames = frames
+        self.output = output
+        self.recorder = recorder
+        self.ring = ring
+        self.overwritten = 0
+        self.smoothing = smoothing
+        #recent seconds between the capture times of processed frames,
+        #converts per processed frame tracker velocity to pixels per second
+        self.interval = None
+        self._last_timestamp = None
+
+    def run(self):
+        self.started_at = time.monotonic()
+        while self.running.is_set():
+            item = self.frames.get(timeout=0.1)
+            if item is None:
+                if self.frames.closed:
+                    break
+                continue
+            frame_id, timestamp, frame = item
+            if self._last_timestamp is not None:
+                interval = timestamp - self._last_timestamp
+                if self.interval is None:
+                    self.interval = interval
+                self.interval += self.smoothing * (interval - self.interval)
+            self._last_timestamp = timestamp
+            if self.ring is not None:
+                frame = self.ring.acquire(frame_id)
+                if frame is None:
+                    #slot was reused before this worker got to it
+                    self.overwritten += 1
+                    continue
+            try:
+                result = self.process(frame)
+                if self.recorder is not None:
+                    #ring sequences start at 1, recorded frames at 0
+                    self.recorder.write_detections(result[0], frame_id if self.ring is None else frame_id - 1)
+                self.output.put((frame_id, timestamp, frame, result))
+            finally:
+                if self.ring is not None:
+                    self.ring.release(frame_id)
+            self.count += 1
+        self.output.close()
+
+
+
+class ControlLoop(Stage):
+    """
+    Drives the camera at a fixed rate independent of detection speed.
+    A tick with a new detection result passes it to follow, ticks without
+    one leave the last command running so the PID never integrates an old
+    error twice, and the camera is stopped when results are older than
+    the timeout.
+    """
+    def __init__(self, follow, results, rate = 30, timeout = 0.5, stop = None) -> None:
+        """
+        New control stage
+        :param follow: callable taking a bounding box, its velocity and its
+        age in seconds, e.g. controller.follow
+        :param results: LatestValueQueue of (frame_id, timestamp, frame, box,
+        velocity) where box is None when nothing is tracked
+        :param rate: control updates per second
+        :param timeout: seconds before a stale result stops the camera
+        :param stop: callable used to stop the camera, optional
+        """
+        super().__init__('control')
+        self.follow = follow
+        self.results = results
+        self.period = 1.0 / rate
+        self.timeout = timeout
+        self.stop_camera = stop
+        self.latency = 0.0
+        self._stopped = True
+
+    def run(self):
+        self.started_at = next_tick = time.monotonic()
+        while self.running.is_set():
+            item, fresh = self.results.peek()
+            now = time.monotonic()
+            if item is not None and item[3] is not None and now - item[1] < self.timeout:
+                if fresh:
+                    self.results.get(timeout=0)
+                    #glass to command latency of the newest frame
+                    self.latency = now - item[1]
+                    #age of the box lets the controller predict over the latency
+                    self.follow(item[3], item[4], now - item[1])
+                    self._stopped = False
+            elif not self._stopped:
+                if self.stop_camera is not None:
+                    self.stop_camera()
+                self._stopped = True
+            self.count += 1
+
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                #fell behind, skip missed ticks instead of bursting
+                next_tick = time.monotonic()
+        if self.stop_camera is not None:
+            self.stop_camera()
+
+
+
+class Pipeline:
+    """
+    Capture, detection and control running on separate threads.
+    Stages are joined by latest value queues so each stage works on
+    fresh data and a slow detector only lowers the detection rate, not
+    the control rate.
+    """
+    def __init__(self, cam, process, follow = None, control_rate = 30,
+                 timeout = 0.5, stop = None, recorder = None, ring_slots = 0, preview = None) -> None:
+        """
+        New capture, detect and control pipeline
+        :param cam: cv2.VideoCapture or any object with read() and isOpened() methods
+        :param process: callable taking a frame and returning
+        (point_sets, track_box) or (point_sets, track_box, velocity) where
+        track_box is None if not tracking and velocity is in pixels per second
+        :param follow: callable taking the tracked box, velocity and latency,
+        e.g. controller.follow, None disables control
+        :param control_rate: control updates per second
+        :param timeout: seconds before a stale track stops the camera
+        :param stop: callable that stops the camera, optional
+        :param recorder: Recorder receiving detections by frame id, use with
+        a RecordingSource around cam so frame ids match
+        :param ring_slots: capture into a shared memory FrameRing of this many
+        slots instead of allocating a frame per read, display frames are then
+        views that stay valid while valid(frame_id) is True
+        :param preview: Preview receiving every result, it runs as a stage
+        and never blocks the others, optional
+        """
+        self.frames = LatestValueQueue()
+        self.results = LatestValueQueue()
+        self.display = LatestValueQueue()
+        self._track = LatestValueQueue()
+
+        self.capture = CaptureThread(cam, self.frames, ring_slots)
+        self.ring = self.capture.ring
+        self.detection = DetectionWorker(process, self.frames, self.results, recorder, self.ring)
+        self.stages = [self.capture, self.detection]
+        self.control = None
+        if follow is not None:
+            self.control = ControlLoop(follow, self._track, control_rate, timeout, stop)
+            self.stages.append(self.control)
+        self.preview = preview
+        if preview is not None:
+            if preview.valid is None:
+                preview.valid = self.valid
+            self.stages.append(preview)
+
+    def start(self):
+        """Starts all stages and the fan out thread"""
+        self._fan_out = threading.Thread(target=self._distribute, name='fan_out', daemon=True)
+        for stage in self.stages:
+            stage.start()
+        self._fan_out.start()
+
+    def _distribute(self):
+        """Copies detection results to the control, display and preview queues"""
+        while True:
+            item = self.results.get(timeout=0.1)
+            if item is None:
+                if self.results.closed:
+                    break
+                continue
+            frame_id, timestamp, frame, result = item
+            point_sets, track_box = result[:2]
+            velocity = result[2] if len(result) > 2 else None
+            self._track.put((frame_id, timestamp, frame, track_box, velocity))
+            self.display.put((frame_id, timestamp, frame, point_sets, track_box))
+            if self.preview is not None:
+                self.preview.publish((frame_id, timestamp, frame, point_sets, track_box))
+        self._track.close()
+        self.display.close()
+
+    def latest(self, timeout = None):
+        """
+        Newest processed frame for display
+        :param timeout: seconds to wait for a new frame
+        :return: (frame_id, timestamp, frame, point_sets, track_box) or None
+        """
+        return self.display.get(timeout)
+
+    def valid(self, frame_id):
+        """
+        Whether a frame returned by latest() has not been overwritten,
+        check after copying or drawing from it
+        :param frame_id: frame id of the item
+        :return: True if the frame is intact
+        """
+        return self.ring is None or self.ring.valid(frame_id)
+
+    def finished(self):
+        """
+        Whether the source ran out and every captured frame was processed
+        and handed out, e.g. at the end of a recorded session
+        :return: True once the pipeline can be stopped
+        """
+        return self.capture.exhausted and not self._fan_out.is_alive()
+
+    def stop(self):
+        """Stops all stages and waits for them to exit"""
+        for stage in self.stages:
+            stage.stop()
+        self.frames.close()
+        for stage in self.stages:
+            stage.join(timeout=1)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring.unlink()
+
+    def stats(self):
+        """
+        Rates and drop counts of each stage
+        :return: dict of stage statistics
+        """
+        stats = {
+            'capture_fps': self.capture.fps(),
+            'detection_fps': self.detection.fps(),
+            'frames_dropped': self.frames.dropped,
+        }
+        if self.ring is not None:
+            stats['ring_full'] = self.capture.ring_full
+            stats['frames_overwritten'] = self.detection.overwritten
+        if self.control is not None:
+            stats['control_fps'] = self.control.fps()
+            stats['latency'] = self.control.latency
+        if self.preview is not None:
+            stats['preview_fps'] = self.preview.fps()
+        return stats
@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from utils.display import draw_points
+from utils.pipeline import LatestValueQueue, Stage
+
+
+
+class Preview(Stage):
+    """
+    Optional low rate preview of pipeline results for headless servers.
+    publish() only replaces the newest item, so capture, detection and
+    control never wait on the preview. The preview thread draws on its
+    own buffer at most rate times a second, JPEG encodes the result and
+    serves it as an MJPEG stream and/or writes it to a file.
+    """
+    def __init__(self, rate = 5, port = None, host = '127.0.0.1', path = None,
+                 quality = 70, scale = 1.0, valid = None) -> None:
+        """
+        New preview
+        :param rate: largest number of preview frames per second
+        :param port: port serving an MJPEG stream at / and the newest
+        frame at /snapshot.jpg, None serves nothing
+        :param host: address to listen on, local only by default
+        :param path: JPEG file replaced with every preview frame, optional
+        :param quality: JPEG quality, 0 to 100
+        :param scale: factor preview frames are resized by
+        :param valid: callable taking a frame id, False if the frame was
+        overwritten while it was drawn, e.g. Pipeline.valid
+        """
+        super().__init__('preview')
+        self.period = 1.0 / rate
+        self.path = path
+        self.scale = scale
+        self.valid = valid
+        self.items = LatestValueQueue()
+        self._parameters = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self._buffer = None
+        self._condition = threading.Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer((host, port), _handler(self))
+            self.server.daemon_threads = True
+
+    def publish(self, item):
+        """
+        Hands a result to the preview without waiting
+        :param item: (frame_id, timestamp, frame, point_sets, track_box)
+        """
+        self.items.put(item)
+
+    def render(self, item):
+        """
+        Draws detections and the track on the preview buffer
+        :param item: (frame_id, timestamp, frame, point_sets, track_box)
+        :return: preview frame or None if the frame was overwritten
+        """
+        frame_id, _, frame, point_sets, track_box = item
+        if self.scale != 1.0:
+            size = (int(frame.shape[1] * self.scale), int(frame.shape[0] * self.scale))
+            if self._buffer is None or self._buffer.shape[1::-1] != size:
+                self._buffer = np.empty((size[1], size[0]) + frame.shape[2:], dtype=frame.dtype)
+            cv2.resize(frame, size, dst=self._buffer, interpolation=cv2.INTER_AREA)
+        else:
+            if self._buffer is None or self._buffer.shape != frame.shape:
+                self._buffer = np.empty_like(frame)
+            np.copyto(self._buffer, frame)
+        if self.valid is not None and not self.valid(frame_id):
+            return None
+
+        scale = self.scale
+        if track_box is not None:
+            point_sets = [{'box': track_box}]
+        if scale != 1.0:
+            point_sets = [{'box': [value * scale for value in point_set['box']]} for point_set in point_sets]
+        return draw_points(self._buffer, point_sets, 'box')
+
+    def run(self):
+        self.started_at = time.monotonic()
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, name='preview_server', daemon=True).start()
+        next_frame = time.monotonic()
+        while self.running.is_set():
+            #only the newest result at each preview tick is drawn
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            item = self.items.get(timeout=0.1)
+            if item is None:
+                if self.items.closed:
+                    break
+                continue
+            next_frame = time.monotonic() + self.period
+            preview = self.render(item)
+            if preview is None:
+                continue
+            ok, jpeg = cv2.imencode('.jpg', preview, self._parameters)
+            if not ok:
+                continue
+            with self._condition:
+                self.jpeg = jpeg.tobytes()
+                self.sequence += 1
+                self._condition.notify_all()
+            if self.path is not None:
+                self._write(self.jpeg)
+            self.count += 1
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _write(self, jpeg):
+        """Replaces the preview file atomically so readers never see a partial image"""
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(jpeg)
+        os.replace(temporary, self.path)
+
+    def wait(self, sequence, timeout = None):
+        """
+        Waits for a preview frame newer than sequence
+        :param sequence: sequence of the last frame seen
+        :param timeout: seconds to wait
+        :return: sequence and JPEG bytes, JPEG is None on timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence != sequence or not self.running.is_set(),
+                                            timeout):
+                return sequence, None
+            return self.sequence, self.jpeg
+
+    def stop(self):
+        super().stop()
+        self.items.close()
+        with self._condition:
+            self._condition.notify_all()
+
+
+
+def _handler(preview):
+    """HTTP handler class bound to a preview"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith('/snapshot'):
+                jpeg = preview.jpeg
+                if jpeg is None:
+                    self.send_error(503, "no preview frame yet")
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(jpeg)))
+                self.end_headers()
+                self.wfile.write(jpeg)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.end_headers()
+            sequence = 0
+            try:
+                while preview.running.is_set():
+                    sequence, jpeg = preview.wait(sequence, timeout=1.0)
+                    if jpeg is None:
+                        continue
+                    self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: '
+                                     + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                #viewer closed the stream
+                pass
+
+        def log_message(self, *args):
+            pass
+    return Handler
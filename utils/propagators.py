@@ -0,0 +1,216 @@
+import cv2
+import numpy as np
+
+from utils.detectors import to_grayscale, to_dicts
+from utils.metrics import timed
+
+
+
+class OpticalFlowPropagator:
+    """
+    Carries bounding boxes from frame to frame with sparse optical flow.
+    A few corner points are picked inside every box on a keyframe and
+    followed with pyramidal Lucas-Kanade flow. Points that fail a
+    forward-backward check are dropped, and each box moves by the median
+    motion of its remaining points.
+    """
+    def __init__(self, max_points = 20, max_error = 1.0, window = (15, 15), levels = 2) -> None:
+        """
+        New optical flow propagator
+        :param max_points: corner points tracked per box
+        :param max_error: forward-backward error in pixels above which a point is dropped
+        :param window: Lucas-Kanade search window
+        :param levels: pyramid levels
+        """
+        self.max_points = max_points
+        self.max_error = max_error
+        self.lk_params = dict(winSize=window, maxLevel=levels,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.previous = None
+        self.detections = []
+        self.points = np.empty((0, 1, 2), dtype=np.float32)
+        self.owners = np.empty(0, dtype=np.int64)
+        self.initial_counts = np.empty(0, dtype=np.int64)
+
+    def init(self, frame, detections):
+        """
+        Starts propagating a new set of detections
+        :param frame: keyframe the detections were found in
+        :param detections: list of dicts with a 'box' entry
+        """
+        gray = to_grayscale(frame)
+        self.previous = gray
+        self.detections = [dict(detection) for detection in detections]
+        points = []
+        owners = []
+        for index, detection in enumerate(self.detections):
+            x, y, w, h = [int(value) for value in detection['box']]
+            x0, y0 = max(0, x), max(0, y)
+            roi = gray[y0:y + h, x0:x + w]
+            if roi.size == 0:
+                continue
+            corners = cv2.goodFeaturesToTrack(roi, self.max_points, 0.01, max(2, min(w, h) // 10))
+            if corners is None:
+                #featureless box, follow its center instead
+                corners = np.array([[[w / 2, h / 2]]], dtype=np.float32)
+            corners += (x0, y0)
+            points.append(corners.astype(np.float32))
+            owners.append(np.full(len(corners), index))
+        if len(points) > 0:
+            self.points = np.concatenate(points)
+            self.owners = np.concatenate(owners)
+        else:
+            self.points = np.empty((0, 1, 2), dtype=np.float32)
+            self.owners = np.empty(0, dtype=np.int64)
+        self.initial_counts = np.bincount(self.owners, minlength=len(self.detections))
+
+    def propagate(self, frame):
+        """
+        Moves the boxes to a new frame
+        :param frame: next camera frame
+        :return: propagated detections and a confidence between 0 and 1,
+        the fraction of points still tracked
+        """
+        gray = to_grayscale(frame)
+        if len(self.points) == 0:
+            self.previous = gray
+            return [], 0.0
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, gray, self.points, None, **self.lk_params)
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous, forward, None, **self.lk_params)
+        error = np.linalg.norm((backward - self.points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < self.max_error)
+
+        motion = (forward - self.points).reshape(-1, 2)
+        propagated = []
+        for index, detection in enumerate(self.detections):
+            mine = good & (self.owners == index)
+            if not mine.any():
+                continue
+            dx, dy = np.median(motion[mine], axis=0)
+            x, y, w, h = detection['box']
+            detection['box'] = [x + dx, y + dy, w, h]
+            keypoints = detection.get('keypoints')
+            if keypoints is not None:
+                detection['keypoints'] = {name: (int(point_x + dx), int(point_y + dy)) if (point_x or point_y)
+                    else (point_x, point_y) for name, (point_x, point_y) in keypoints.items()}
+            propagated.append(detection)
+
+        counts = np.bincount(self.owners[good], minlength=len(self.detections))
+        confidence = float(counts.sum()) / max(1, self.initial_counts.sum())
+        self.points = forward[good]
+        self.owners = self.owners[good]
+        self.previous = gray
+        return [dict(detection, box=[int(value) for value in detection['box']])
+                for detection in propagated], confidence
+
+
+
+class OpenCVTrackerPropagator:
+    """
+    Carries bounding boxes forward with OpenCV single object trackers,
+    one per box. Slower than optical flow but more robust on low texture.
+    """
+    def __init__(self, create = None) -> None:
+        """
+        New OpenCV tracker propagator
+        :param create: factory for cv2 trackers, defaults to cv2.TrackerMIL_create
+        """
+        self.create = create or cv2.TrackerMIL_create
+        self.trackers = []
+
+    def init(self, frame, detections):
+        """
+        Starts propagating a new set of detections
+        :param frame: keyframe the detections were found in
+        :param detections: list of dicts with a 'box' entry
+        """
+        self.trackers = []
+        for detection in detections:
+            tracker = self.create()
+            tracker.init(frame, tuple(int(value) for value in detection['box']))
+            self.trackers.append((tracker, dict(detection)))
+
+    def propagate(self, frame):
+        """
+        Moves the boxes to a new frame
+        :param frame: next camera frame
+        :return: propagated detections and the fraction of boxes still tracked
+        """
+        propagated = []
+        for tracker, detection in self.trackers:
+            ok, box = tracker.update(frame)
+            if ok:
+                propagated.append(dict(detection, box=[int(value) for value in box]))
+        return propagated, len(propagated) / max(1, len(self.trackers))
+
+
+
+class KeyframeDetector:
+    """
+    Runs a heavy detector only on keyframes.
+    Between keyframes a propagator carries the last detections forward.
+    The keyframe interval grows while propagation stays confident and
+    shrinks when it degrades, and a low confidence forces a keyframe.
+    """
+    def __init__(self, detector, propagator = None, min_interval = 1, max_interval = 15,
+                 min_confidence = 0.5, grow_confidence = 0.8) -> None:
+        """
+        New keyframe detector
+        :param detector: any detector from utils/detectors.py
+        :param propagator: OpticalFlowPropagator or OpenCVTrackerPropagator
+        :param min_interval: smallest number of frames between keyframes
+        :param max_interval: largest number of frames between keyframes
+        :param min_confidence: propagation confidence that forces a keyframe
+        :param grow_confidence: confidence above which the interval grows
+        """
+        self.detector = detector
+        self.propagator = propagator or OpticalFlowPropagator()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_confidence = min_confidence
+        self.grow_confidence = grow_confidence
+        self.interval = min_interval
+        self.since_keyframe = 0
+        self.confidence = 0.0
+        self.keyframe = False
+        self.force = True
+
+    def request_keyframe(self):
+        """Runs the detector on the next frame, e.g. after a new track is set"""
+        self.force = True
+
+    @timed('detect.KeyframeDetector')
+    def detect(self, frame, **kwargs):
+        """
+        Detects on keyframes and propagates on other frames
+        :param frame: camera frame or image
+        :param kwargs: passed to the wrapped detector on keyframes, e.g.
+        display = False off the main thread
+        :return: list of detections with a 'box' entry
+        """
+        self.keyframe = self.force or self.since_keyframe >= self.interval
+        if not self.keyframe:
+            detections, self.confidence = self.propagator.propagate(frame)
+            self.since_keyframe += 1
+            if self.confidence >= self.min_confidence:
+                return detections
+            #propagation failed, detect on this frame instead
+            self.keyframe = True
+
+        if self.since_keyframe > 0:
+            #adapt the interval to how well the last propagation held up
+            if self.confidence >= self.grow_confidence:
+                self.interval = min(self.max_interval, self.interval + 1)
+            else:
+                self.interval = max(self.min_interval, self.interval // 2)
+        detections = self.detector.detect(frame, **kwargs)
+        if isinstance(detections, np.ndarray):
+            detections = to_dicts(detections)
+        self.propagator.init(frame, detections)
+        self.since_keyframe = 0
+        self.confidence = 1.0
+        self.force = False
+        return detections
+
+    def assign_detection(self, frame, x, y):
+        return self.detector.assign_detection(frame, x, y)
@@ -0,0 +1,135 @@
+import threading
+import time
+
+
+
+class CommandScheduler:
+    """
+    Rate limits camera commands.
+    Only the newest desired speed is kept for pan/tilt and for zoom, and
+    pending speeds are flushed at no more than max_rate packets per
+    second. A stop is sent ahead of everything else and is never rate
+    limited, so stale commands never queue up behind the controller.
+    """
+    def __init__(self, send, encoder, max_rate = 10, burst = 2) -> None:
+        """
+        New command scheduler
+        :param send: callable taking an encoded packet, e.g. controller.send_command
+        :param encoder: VISCAEncoder used to build and deduplicate packets
+        :param max_rate: maximum packets per second
+        :param burst: packets that can be sent back to back
+        """
+        self.send = send
+        self.encoder = encoder
+        self.max_rate = max_rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pan_tilt = None
+        self._zoom = None
+        self._stop = False
+        self._tokens = burst
+        self._refilled = time.monotonic()
+        self._thread = None
+        self._running = False
+        self.sent = 0
+        self.replaced = 0
+
+    def set_pan_tilt(self, pan_speed, tilt_speed):
+        """
+        Sets the desired pan/tilt speed, replacing any unsent speed
+        :param pan_speed: signed pan speed
+        :param tilt_speed: signed tilt speed
+        """
+        with self._lock:
+            if self._pan_tilt is not None:
+                self.replaced += 1
+            self._pan_tilt = (pan_speed, tilt_speed)
+        self._wake.set()
+
+    def set_zoom(self, zoom_speed):
+        """
+        Sets the desired zoom speed, replacing any unsent speed
+        :param zoom_speed: signed zoom speed
+        """
+        with self._lock:
+            if self._zoom is not None:
+                self.replaced += 1
+            self._zoom = zoom_speed
+        self._wake.set()
+
+    def stop(self):
+        """Drops unsent speeds and stops the camera ahead of any other command"""
+        with self._lock:
+            self._pan_tilt = None
+            self._zoom = None
+            self._stop = True
+        if self._running:
+            self._wake.set()
+        else:
+            self.flush()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.max_rate)
+        self._refilled = now
+
+    def flush(self, now = None):
+        """
+        Sends pending commands that fit in the rate limit
+        :param now: monotonic time, defaults to the current time
+        :return: seconds until the next command could be sent, None if
+        nothing is pending
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._refill(now)
+            packets = []
+            if self._stop:
+                #stop bypasses the rate limit
+                self._stop = False
+                packets.append(bytes(self.encoder.pan_tilt(0, 0, force=True)))
+                packets.append(bytes(self.encoder.zoom(0, force=True)))
+                self._tokens = max(0, self._tokens - 2)
+            if self._pan_tilt is not None and self._tokens >= 1:
+                packet = self.encoder.pan_tilt(*self._pan_tilt)
+                self._pan_tilt = None
+                if packet is not None:
+                    packets.append(bytes(packet))
+                    self._tokens -= 1
+            if self._zoom is not None and self._tokens >= 1:
+                packet = self.encoder.zoom(self._zoom)
+                self._zoom = None
+                if packet is not None:
+                    packets.append(bytes(packet))
+                    self._tokens -= 1
+            pending = self._pan_tilt is not None or self._zoom is not None
+            wait = max(0.0, (1 - self._tokens) / self.max_rate) if pending else None
+
+        for packet in packets:
+            self.send(packet)
+        self.sent += len(packets)
+        return wait
+
+    def start(self):
+        """Flushes from a background thread whenever commands are pending"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='command_scheduler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        wait = None
+        while self._running:
+            self._wake.wait(wait)
+            self._wake.clear()
+            wait = self.flush()
+
+    def close(self):
+        """Stops the camera and the background thread"""
+        self.stop()
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        self.flush()
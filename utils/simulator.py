@@ -0,0 +1,394 @@
+import collections
+import time
+
+import cv2
+import numpy as np
+
+from utils.VISCA_controller import controller, PAN_SPEED_MAX, TILT_SPEED_MAX, ZOOM_SPEED_MAX
+
+
+
+#degrees per second for every VISCA speed, index 0 is stop
+PAN_DEGREES_PER_SECOND = (0.0,) + tuple(np.round(np.geomspace(1.0, 100.0, PAN_SPEED_MAX), 2))
+TILT_DEGREES_PER_SECOND = (0.0,) + tuple(np.round(np.geomspace(1.0, 69.9, TILT_SPEED_MAX), 2))
+#fraction of the zoom range per second for every VISCA zoom speed
+ZOOM_RANGE_PER_SECOND = (0.0,) + tuple(np.round(np.linspace(0.05, 0.5, ZOOM_SPEED_MAX), 3))
+
+
+
+def step_trajectory(pan, tilt):
+    """
+    Target standing still
+    :param pan: target pan angle in degrees
+    :param tilt: target tilt angle in degrees, positive is down
+    :return: function of time returning pan and tilt
+    """
+    return lambda t: (pan, tilt)
+
+def sine_trajectory(amplitude = 20.0, period = 4.0, pan = 0.0, tilt = 0.0):
+    """
+    Target walking back and forth
+    :param amplitude: largest pan offset in degrees
+    :param period: seconds per cycle
+    :param pan: center pan angle in degrees
+    :param tilt: tilt angle in degrees
+    :return: function of time returning pan and tilt
+    """
+    return lambda t: (pan + amplitude * np.sin(2 * np.pi * t / period), tilt)
+
+def recorded_trajectory(times, pans, tilts):
+    """
+    Target following recorded positions, linearly interpolated
+    :param times: sample times in seconds
+    :param pans: pan angles in degrees
+    :param tilts: tilt angles in degrees
+    :return: function of time returning pan and tilt
+    """
+    times = np.asarray(times, dtype=np.float64)
+    pans = np.asarray(pans, dtype=np.float64)
+    tilts = np.asarray(tilts, dtype=np.float64)
+    return lambda t: (float(np.interp(t, times, pans)), float(np.interp(t, times, tilts)))
+
+
+
+class PTZPlant:
+    """
+    Simulated PTZ head.
+    Decodes the VISCA pan/tilt and zoom drive packets sent by the
+    controller, delivers them after a network delay, maps speeds to
+    angular rates with speed tables and ramps the head towards them
+    with limited acceleration.
+    """
+    def __init__(self, pan = 0.0, tilt = 0.0, zoom = 0.0, delay = 0.02, jitter = 0.0,
+                 acceleration = 300.0, zoom_acceleration = 2.0, wide_fov = 60.0, tele_fov = 3.0,
+                 pan_limits = (-170.0, 170.0), tilt_limits = (-30.0, 90.0), seed = None) -> None:
+        """
+        New simulated PTZ head
+        :param pan: starting pan angle in degrees
+        :param tilt: starting tilt angle in degrees, positive is down
+        :param zoom: starting zoom position, 0 is wide and 1 is tele
+        :param delay: network delay of a packet in seconds
+        :param jitter: largest random extra delay in seconds
+        :param acceleration: pan/tilt acceleration in degrees per second squared
+        :param zoom_acceleration: zoom acceleration in zoom ranges per second squared
+        :param wide_fov: horizontal field of view in degrees at full wide
+        :param tele_fov: horizontal field of view in degrees at full tele
+        :param pan_limits: smallest and largest pan angle
+        :param tilt_limits: smallest and largest tilt angle
+        :param seed: random seed for the jitter
+        """
+        self.time = 0.0
+        self.pan = pan
+        self.tilt = tilt
+        self.zoom = zoom
+        self.pan_velocity = 0.0
+        self.tilt_velocity = 0.0
+        self.zoom_velocity = 0.0
+        self.pan_command = 0.0
+        self.tilt_command = 0.0
+        self.zoom_command = 0.0
+
+        self.delay = delay
+        self.jitter = jitter
+        self.acceleration = acceleration
+        self.zoom_acceleration = zoom_acceleration
+        self.wide_fov = wide_fov
+        self.tele_fov = tele_fov
+        self.pan_limits = pan_limits
+        self.tilt_limits = tilt_limits
+        self.random = np.random.default_rng(seed)
+
+        self.in_flight = collections.deque()
+        self.packets = 0
+
+    def clock(self):
+        """
+        Simulated time, pass as the controller clock
+        :return: seconds since the start of the simulation
+        """
+        return self.time
+
+    def send(self, packet):
+        """
+        Receives a packet from the controller
+        :param packet: VISCA packet, with or without a VISCA over IP header
+        """
+        arrival = self.time + self.delay
+        if self.jitter > 0:
+            arrival += self.random.uniform(0, self.jitter)
+        #keep delivery in order like a single UDP path
+        if self.in_flight:
+            arrival = max(arrival, self.in_flight[-1][0])
+        self.in_flight.append((arrival, bytes(packet)))
+        self.packets += 1
+
+    def _apply(self, packet):
+        """Sets the commanded rates from a VISCA drive packet"""
+        if packet[0] != 0x81:
+            #strip the VISCA over IP header
+            packet = packet[8:]
+        if packet[1:4] == b'\x01\x06\x01':
+            pan_speed = PAN_DEGREES_PER_SECOND[min(packet[4], PAN_SPEED_MAX)]
+            tilt_speed = TILT_DEGREES_PER_SECOND[min(packet[5], TILT_SPEED_MAX)]
+            self.pan_command = {0x01: -pan_speed, 0x02: pan_speed}.get(packet[6], 0.0)
+            self.tilt_command = {0x01: -tilt_speed, 0x02: tilt_speed}.get(packet[7], 0.0)
+        elif packet[1:4] == b'\x01\x04\x07':
+            speed = ZOOM_RANGE_PER_SECOND[min(packet[4] & 0x0f, ZOOM_SPEED_MAX)]
+            self.zoom_command = {0x20: speed, 0x30: -speed}.get(packet[4] & 0xf0, 0.0)
+
+    @staticmethod
+    def _ramp(velocity, command, change):
+        return min(command, velocity + change) if command > velocity else max(command, velocity - change)
+
+    def step(self, dt):
+        """
+        Advances the head by dt seconds
+        :param dt: time step in seconds
+        """
+        self.time += dt
+        while self.in_flight and self.in_flight[0][0] <= self.time:
+            self._apply(self.in_flight.popleft()[1])
+
+        change = self.acceleration * dt
+        self.pan_velocity = self._ramp(self.pan_velocity, self.pan_command, change)
+        self.tilt_velocity = self._ramp(self.tilt_velocity, self.tilt_command, change)
+        self.zoom_velocity = self._ramp(self.zoom_velocity, self.zoom_command, self.zoom_acceleration * dt)
+
+        self.pan = min(self.pan_limits[1], max(self.pan_limits[0], self.pan + self.pan_velocity * dt))
+        self.tilt = min(self.tilt_limits[1], max(self.tilt_limits[0], self.tilt + self.tilt_velocity * dt))
+        self.zoom = min(1.0, max(0.0, self.zoom + self.zoom_velocity * dt))
+
+    def fov(self):
+        """
+        Horizontal field of view at the current zoom
+        :return: degrees
+        """
+        return self.wide_fov * (self.tele_fov / self.wide_fov) ** self.zoom
+
+    def project(self, pan, tilt, size, width, height):
+        """
+        Where an object appears in the camera frame
+        :param pan: object pan angle in degrees
+        :param tilt: object tilt angle in degrees
+        :param size: object width and height in degrees
+        :param width: frame width in pixels
+        :param height: frame height in pixels
+        :return: x, y, w, h box in pixels
+        """
+        scale = width / self.fov()
+        w, h = size[0] * scale, size[1] * scale
+        center_x = width / 2 + (pan - self.pan) * scale
+        center_y = height / 2 + (tilt - self.tilt) * scale
+        return center_x - w / 2, center_y - h / 2, w, h
+
+
+
+class Renderer:
+    """
+    Draws the simulated target into frames so a real detector can run
+    in the loop. The background is flat noise, a still image or frames
+    read from a recording.
+    """
+    def __init__(self, width, height, background = None, color = (0, 0, 255), seed = 0) -> None:
+        """
+        New renderer
+        :param width: frame width
+        :param height: frame height
+        :param background: image, object with a read() method such as a
+        cv2.VideoCapture, or None for noise
+        :param color: BGR color of the target, red matches the ColorDetector defaults
+        :param seed: random seed for the noise background
+        """
+        self.width = width
+        self.height = height
+        self.color = color
+        self.source = None
+        self.frame = np.empty((height, width, 3), dtype=np.uint8)
+        if background is None:
+            self.background = np.random.default_rng(seed).integers(
+                40, 90, (height, width, 3), dtype=np.uint8)
+        elif hasattr(background, 'read'):
+            self.source = background
+            self.background = np.zeros((height, width, 3), dtype=np.uint8)
+        else:
+            self.background = cv2.resize(background, (width, height))
+
+    def render(self, box):
+        """
+        Draws a frame
+        :param box: x, y, w, h target box or None if out of view
+        :return: frame, reused on the next call
+        """
+        if self.source is not None:
+            ok, frame = self.source.read()
+            if ok:
+                cv2.resize(frame, (self.width, self.height), dst=self.background)
+        np.copyto(self.frame, self.background)
+        if box is not None:
+            x, y, w, h = [int(round(value)) for value in box]
+            cv2.rectangle(self.frame, (x, y), (x + w, y + h), self.color, -1)
+        return self.frame
+
+
+
+class Simulation:
+    """
+    Closed loop run of the controller against a simulated PTZ head.
+    Every frame the target is projected into the camera (optionally
+    rendered and run through a detector and tracker), delayed by the
+    pipeline latency and handed to controller.follow. Time is simulated,
+    so runs are deterministic and much faster than real time.
+    """
+    def __init__(self, trajectory, target_size = (8.0, 16.0), plant = None, camera_controller = None,
+                 width = 640, height = 480, frame_rate = 30, latency = 0.1, detector = None,
+                 tracker = None, renderer = None, noise = 0.0, steps = 4, predictive = False,
+                 seed = 0) -> None:
+        """
+        New simulation
+        :param trajectory: function of time returning target pan and tilt,
+        see step_trajectory, sine_trajectory and recorded_trajectory
+        :param target_size: target width and height in degrees
+        :param plant: PTZPlant, defaults to a head at 0, 0
+        :param camera_controller: controller sending to the plant, defaults
+        to a new controller with default parameters
+        :param width: frame width
+        :param height: frame height
+        :param frame_rate: frames per second given to the controller
+        :param latency: capture and detection delay in seconds
+        :param detector: detector run on rendered frames, None uses the
+        projected box directly
+        :param tracker: MultiObjectTracker run on the detections
+        :param renderer: Renderer, defaults to a noise background when a detector is given
+        :param noise: standard deviation in pixels added to projected boxes
+        :param steps: physics steps per frame
+        :param predictive: give the controller the box velocity and latency,
+        from the tracker or from the change between observed boxes
+        :param seed: random seed for the box noise
+        """
+        self.trajectory = trajectory
+        self.target_size = target_size
+        self.plant = plant or PTZPlant()
+        self.controller = camera_controller or controller(width, height, send=self.plant.send,
+                                                          clock=self.plant.clock)
+        self.width = width
+        self.height = height
+        self.frame_rate = frame_rate
+        self.latency = latency
+        self.detector = detector
+        self.tracker = tracker
+        self.renderer = renderer
+        if detector is not None and renderer is None:
+            self.renderer = Renderer(width, height)
+        self.noise = noise
+        self.steps = steps
+        self.predictive = predictive
+        self._previous = None
+        self.random = np.random.default_rng(seed)
+
+    def observe(self, box):
+        """
+        What the pipeline reports for a projected target box
+        :param box: projected x, y, w, h box
+        :return: box given to the controller or None, and its velocity in
+        pixels per second or None
+        """
+        visible = box[0] + box[2] > 0 and box[0] < self.width and box[1] + box[3] > 0 and box[1] < self.height
+        velocity = None
+        if self.detector is None:
+            if not visible:
+                observed = None
+            elif self.noise > 0:
+                observed = tuple(np.asarray(box) + self.random.normal(0, self.noise, 4))
+            else:
+                observed = tuple(box)
+        else:
+            frame = self.renderer.render(box if visible else None)
+            point_sets = self.detector.detect(frame)
+            if self.tracker is not None:
+                ids, boxes = self.tracker.update(point_sets)
+            else:
+                boxes = np.array([detection['box'] for detection in point_sets]).reshape(-1, 4)
+            observed = None
+            if len(boxes) > 0:
+                largest = (boxes[:, 2] * boxes[:, 3]).argmax()
+                observed = tuple(boxes[largest])
+                if self.predictive and self.tracker is not None:
+                    velocity = np.multiply(self.tracker.get_velocity(ids[largest]), self.frame_rate)
+        if self.predictive and velocity is None and observed is not None and self._previous is not None:
+            velocity = np.subtract(observed, self._previous) * self.frame_rate
+        self._previous = observed
+        return observed, velocity
+
+    def run(self, duration = 5.0, tolerance = 0.05):
+        """
+        Runs the closed loop
+        :param duration: simulated seconds
+        :param tolerance: error, as a fraction of the frame width, that
+        counts as settled
+        :return: dict of metrics, times in seconds
+        """
+        plant = self.plant
+        frames = int(round(duration * self.frame_rate))
+        dt = 1.0 / (self.frame_rate * self.steps)
+        delay_frames = int(round(self.latency * self.frame_rate))
+        observations = collections.deque(maxlen=delay_frames + 1)
+        errors = np.empty((frames, 3))
+        moving = False
+        started = time.perf_counter()
+
+        for index in range(frames):
+            pan, tilt = self.trajectory(plant.time)
+            box = plant.project(pan, tilt, self.target_size, self.width, self.height)
+            errors[index] = (box[0] + box[2] / 2 - self.controller.target_x,
+                             box[1] + box[3] / 2 - self.controller.target_y,
+                             box[2] - self.controller.target_z)
+            observations.append(self.observe(box))
+            if len(observations) == observations.maxlen:
+                observed, velocity = observations[0]
+                if observed is not None:
+                    self.controller.follow(observed, velocity, self.latency)
+                    moving = True
+                elif moving:
+                    self.controller.stop()
+                    moving = False
+            for _ in range(self.steps):
+                plant.step(dt)
+
+        return self.metrics(errors, tolerance * self.width, time.perf_counter() - started)
+
+    def metrics(self, errors, tolerance, wall_time):
+        """
+        Summarizes a run
+        :param errors: per frame x, y and width errors in pixels
+        :param tolerance: settled error in pixels
+        :param wall_time: seconds the run took
+        :return: dict of metrics
+        """
+        duration = len(errors) / self.frame_rate
+        metrics = {
+            'duration': duration,
+            'wall_time': wall_time,
+            'speedup': duration / max(wall_time, 1e-9),
+            'commands': self.plant.packets,
+            'command_rate': self.plant.packets / duration,
+        }
+        for axis, name in enumerate(('x', 'y', 'z')):
+            error = errors[:, axis]
+            outside = np.flatnonzero(np.abs(error) > tolerance)
+            if len(outside) == 0:
+                settling = 0.0
+            elif outside[-1] == len(error) - 1:
+                #never settled
+                settling = None
+            else:
+                settling = float(outside[-1] + 1) / self.frame_rate
+            #overshoot past the target relative to the starting error
+            initial = error[0]
+            overshoot = 0.0
+            if abs(initial) > tolerance:
+                overshoot = max(0.0, float(np.max(-np.sign(initial) * error))) / float(abs(initial))
+            metrics[name + '_settling_time'] = settling
+            metrics[name + '_overshoot'] = overshoot
+            metrics[name + '_rms_error'] = float(np.sqrt(np.mean(error ** 2)))
+            metrics[name + '_max_error'] = float(np.max(np.abs(error)))
+        return metrics
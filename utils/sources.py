@@ -0,0 +1,418 @@
+import glob
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+
+
+class FrameSource:
+    """
+    Base class for frame sources.
+    Sources have the cv2.VideoCapture read() interface, so they can be
+    used anywhere a camera is, and keep the timestamp of the last frame.
+    isOpened() turns False once a finite source has no frames left.
+    """
+    def __init__(self) -> None:
+        self.timestamp = None
+        self.index = -1
+
+    def read(self, frame = None):
+        """
+        Next frame
+        :param frame: preallocated buffer to read into, e.g. a FrameRing
+        slot, the returned frame may be another array if it does not fit
+        :return: ok flag and frame, frame is None when ok is False
+        """
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+    def isOpened(self):
+        return True
+
+    def __iter__(self):
+        while True:
+            ok, frame = self.read()
+            if not ok:
+                return
+            yield frame
+
+
+
+class LiveSource(FrameSource):
+    """Frames from a camera"""
+    def __init__(self, index = 0, width = None, height = None) -> None:
+        """
+        New live source
+        :param index: camera index or stream url
+        :param width: requested frame width
+        :param height: requested frame height
+        """
+        super().__init__()
+        self.cap = cv2.VideoCapture(index)
+        if width is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+    def read(self, frame = None):
+        #cv2 decodes straight into the buffer when it has the frame's size
+        ok, frame = self.cap.read(frame)
+        if ok:
+            self.timestamp = time.monotonic()
+            self.index += 1
+        return ok, frame
+
+    def set(self, prop, value):
+        return self.cap.set(prop, value)
+
+    def release(self):
+        self.cap.release()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+
+
+class _Paced(FrameSource):
+    """Replays frames at their recorded timestamps or as fast as possible"""
+    def __init__(self, realtime = True, speed = 1.0, loop = False) -> None:
+        super().__init__()
+        self.realtime = realtime
+        self.speed = speed
+        self.loop = loop
+        #set when the last frame was read and the source does not loop
+        self.exhausted = False
+        self._start = None
+        self._first = None
+
+    def _wait(self, timestamp):
+        """Sleeps until a recorded timestamp is due"""
+        if not self.realtime:
+            return
+        now = time.monotonic()
+        if self._start is None:
+            self._start, self._first = now, timestamp
+            return
+        delay = (timestamp - self._first) / self.speed - (now - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _restart(self):
+        """Starts over for looping, returns False if not looping"""
+        if not self.loop:
+            self.exhausted = True
+            return False
+        self._start = None
+        self.index = -1
+        return True
+
+    def isOpened(self):
+        return not self.exhausted
+
+
+
+class VideoFileSource(_Paced):
+    """Frames from a video file, timestamps from the container"""
+    def __init__(self, path, realtime = False, speed = 1.0, loop = False) -> None:
+        """
+        New video file source
+        :param path: video file
+        :param realtime: replay at the recorded frame times, else as fast as possible
+        :param speed: replay speed when realtime
+        :param loop: start over at the end
+        """
+        super().__init__(realtime, speed, loop)
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise Exception("could not open video: " + path)
+
+    def read(self, frame = None):
+        buffer = frame
+        ok, frame = self.cap.read(buffer)
+        if not ok and self._restart():
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.cap.read(buffer)
+        if not ok:
+            return False, None
+        self.index += 1
+        self.timestamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        self._wait(self.timestamp)
+        return True, frame
+
+    def release(self):
+        self.cap.release()
+
+    def isOpened(self):
+        return self.cap.isOpened() and not self.exhausted
+
+
+
+class ImageDirectorySource(_Paced):
+    """Frames from image files in name order"""
+    def __init__(self, path, frame_rate = 30, realtime = False, speed = 1.0, loop = False,
+                 patterns = ('*.png', '*.jpg', '*.jpeg', '*.bmp')) -> None:
+        """
+        New image directory source
+        :param path: directory of images
+        :param frame_rate: frames per second used for timestamps
+        :param realtime: replay at frame_rate, else as fast as possible
+        :param speed: replay speed when realtime
+        :param loop: start over at the end
+        :param patterns: file patterns to read
+        """
+        super().__init__(realtime, speed, loop)
+        self.files = sorted(file for pattern in patterns for file in glob.glob(os.path.join(path, pattern)))
+        if len(self.files) == 0:
+            raise Exception("no images in " + path)
+        self.frame_rate = frame_rate
+
+    def read(self, frame = None):
+        if self.index + 1 >= len(self.files) and not self._restart():
+            return False, None
+        self.index += 1
+        image = cv2.imread(self.files[self.index])
+        self.timestamp = self.index / self.frame_rate
+        self._wait(self.timestamp)
+        if image is not None and frame is not None and frame.shape == image.shape:
+            np.copyto(frame, image)
+            image = frame
+        return image is not None, image
+
+
+
+class RawDumpSource(_Paced):
+    """
+    Frames from a raw dump written by Recorder.
+    The dump is memory mapped and each frame is copied once into the
+    caller's buffer or a preallocated ring of slots, so reading never
+    allocates. A returned ring frame stays valid until the ring wraps around.
+    """
+    def __init__(self, path, realtime = True, speed = 1.0, loop = False, ring = 8) -> None:
+        """
+        New raw dump source
+        :param path: session directory written by Recorder
+        :param realtime: replay at the recorded timestamps, else as fast as possible
+        :param speed: replay speed when realtime
+        :param loop: start over at the end
+        :param ring: number of preallocated frame slots
+        """
+        super().__init__(realtime, speed, loop)
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as file:
+            self.meta = json.load(file)
+        shape = (self.meta['height'], self.meta['width'], self.meta['channels'])
+        dtype = np.dtype(self.meta['dtype'])
+        self.timestamps = np.load(os.path.join(path, 'timestamps.npy'))
+        count = len(self.timestamps)
+        self.frames = np.memmap(os.path.join(path, 'frames.raw'), dtype=dtype, mode='r',
+                                shape=(count,) + shape)
+        self.ring = np.empty((ring,) + shape, dtype=dtype)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def read(self, frame = None):
+        if self.index + 1 >= len(self.timestamps) and not self._restart():
+            return False, None
+        self.index += 1
+        self.timestamp = float(self.timestamps[self.index])
+        self._wait(self.timestamp)
+        slot = frame
+        if slot is None or slot.shape != self.frames.shape[1:]:
+            slot = self.ring[self.index % len(self.ring)]
+        np.copyto(slot, self.frames[self.index])
+        return True, slot
+
+    def detections(self):
+        """
+        Detections recorded with the frames
+        :return: dict of frame index to list of detections
+        """
+        return {record['frame']: record['detections'] for record in _read_lines(self.path, 'detections.jsonl')}
+
+    def commands(self):
+        """
+        VISCA commands recorded with the frames
+        :return: list of (timestamp, frame index, packet bytes)
+        """
+        return [(record['time'], record['frame'], bytes.fromhex(record['packet']))
+                for record in _read_lines(self.path, 'commands.jsonl')]
+
+    def release(self):
+        del self.frames
+
+
+
+def _read_lines(path, name):
+    path = os.path.join(path, name)
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def _to_json(value):
+    """json default for numpy values in detections"""
+    if isinstance(value, np.ndarray):
+        if value.dtype.names is not None:
+            return [{name: row[name] for name in value.dtype.names} for row in value]
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(type(value).__name__)
+
+
+
+class Recorder:
+    """
+    Records a session: raw frames with their timestamps, detector
+    outputs and VISCA commands, for bit exact replay with RawDumpSource.
+    """
+    def __init__(self, path) -> None:
+        """
+        New recorder
+        :param path: session directory, created if needed
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._frames = open(os.path.join(path, 'frames.raw'), 'wb')
+        self._detections = open(os.path.join(path, 'detections.jsonl'), 'w')
+        self._commands = open(os.path.join(path, 'commands.jsonl'), 'w')
+        self.timestamps = []
+        self.shape = None
+        self.dtype = None
+        self.closed = False
+
+    @property
+    def frame_index(self):
+        return len(self.timestamps) - 1
+
+    def write_frame(self, frame, timestamp = None):
+        """
+        Appends a frame
+        :param frame: frame, every frame must have the same shape
+        :param timestamp: capture time in seconds, defaults to now
+        :return: index of the frame
+        """
+        if self.shape is None:
+            self.shape = frame.shape
+            self.dtype = frame.dtype
+        elif frame.shape != self.shape:
+            raise Exception("frame shape changed during recording")
+        #written straight from the frame's buffer
+        self._frames.write(memoryview(np.ascontiguousarray(frame)))
+        self.timestamps.append(time.monotonic() if timestamp is None else timestamp)
+        return self.frame_index
+
+    def write_detections(self, detections, frame_index = None):
+        """
+        Records the detector output of a frame
+        :param detections: list of dicts or structured array
+        :param frame_index: frame the detections belong to, defaults to the last frame
+        """
+        frame_index = self.frame_index if frame_index is None else frame_index
+        self._detections.write(json.dumps({'frame': frame_index, 'detections': detections},
+                                          default=_to_json) + '\n')
+
+    def write_command(self, packet, timestamp = None):
+        """
+        Records a VISCA command
+        :param packet: encoded packet
+        :param timestamp: send time in seconds, defaults to now
+        """
+        self._commands.write(json.dumps({'time': time.monotonic() if timestamp is None else timestamp,
+            'frame': self.frame_index, 'packet': bytes(packet).hex()}) + '\n')
+
+    def wrap_send(self, send = None):
+        """
+        Send callable that records every packet, for controller(send=...)
+        :param send: callable forwarding the packet, None only records
+        :return: send callable
+        """
+        def recording_send(packet):
+            self.write_command(packet)
+            if send is not None:
+                send(packet)
+        return recording_send
+
+    def close(self):
+        """Writes the timestamps and frame format and closes the files"""
+        if self.closed:
+            return
+        self.closed = True
+        self._frames.close()
+        self._detections.close()
+        self._commands.close()
+        np.save(os.path.join(self.path, 'timestamps.npy'), np.asarray(self.timestamps, dtype=np.float64))
+        if self.shape is not None:
+            height, width = self.shape[:2]
+            channels = self.shape[2] if len(self.shape) > 2 else 1
+            meta = {'width': width, 'height': height, 'channels': channels,
+                    'dtype': np.dtype(self.dtype).str, 'frames': len(self.timestamps)}
+            with open(os.path.join(self.path, 'meta.json'), 'w') as file:
+                json.dump(meta, file, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class RecordingSource(FrameSource):
+    """Passes frames through from another source and records them"""
+    def __init__(self, source, recorder) -> None:
+        """
+        New recording source
+        :param source: any frame source or cv2.VideoCapture
+        :param recorder: Recorder receiving the frames
+        """
+        super().__init__()
+        self.source = source
+        self.recorder = recorder
+
+    def read(self, frame = None):
+        ok, frame = self.source.read(frame) if frame is not None else self.source.read()
+        if ok:
+            self.timestamp = getattr(self.source, 'timestamp', None)
+            if self.timestamp is None:
+                self.timestamp = time.monotonic()
+            self.index = self.recorder.write_frame(frame, self.timestamp)
+        return ok, frame
+
+    def release(self):
+        self.source.release()
+        self.recorder.close()
+
+    def isOpened(self):
+        return self.source.isOpened()
+
+
+
+def open_source(spec, realtime = True, loop = False, width = None, height = None):
+    """
+    Opens a frame source from a camera index, video file, image
+    directory or recorded session directory
+    :param spec: camera index or path
+    :param realtime: replay recordings at their recorded timing
+    :param loop: start recordings over at the end
+    :param width: requested camera frame width
+    :param height: requested camera frame height
+    :return: frame source
+    """
+    if isinstance(spec, int) or (isinstance(spec, str) and spec.isdigit()):
+        return LiveSource(int(spec), width, height)
+    if os.path.isdir(spec):
+        if os.path.exists(os.path.join(spec, 'meta.json')):
+            return RawDumpSource(spec, realtime, loop=loop)
+        return ImageDirectorySource(spec, realtime=realtime, loop=loop)
+    if os.path.exists(spec):
+        return VideoFileSource(spec, realtime, loop=loop)
+    #stream urls
+    return LiveSource(spec, width, height)
@@ -1,6 +1,190 @@
 import cv2
 import numpy as np
 from collections import deque
+from scipy.optimize import linear_sum_assignment
+from utils.metrics import timed
+
+
+
+def boxes_to_array(point_sets):
+    """
+    Stacks detection boxes into one array
+    :param point_sets: list of detections with a 'box' entry, a
+    structured detection array or an array of x, y, w, h rows
+    :return: float array of shape (N, 4) in x, y, w, h format
+    """
+    if isinstance(point_sets, np.ndarray):
+        if point_sets.dtype.names is not None:
+            point_sets = point_sets['box']
+        return point_sets.reshape(-1, 4).astype(np.float64, copy=False)
+    boxes = np.empty((len(point_sets), 4), dtype=np.float64)
+    for i, point_set in enumerate(point_sets):
+        boxes[i] = point_set['box']
+    return boxes
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Intersection over union between every pair of boxes
+    :param boxes_a: array of shape (N, 4) in x, y, w, h format
+    :param boxes_b: array of shape (M, 4) in x, y, w, h format
+    :return: array of shape (N, M)
+    """
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    inter_w = np.minimum(a[..., 0] + a[..., 2], b[..., 0] + b[..., 2]) - np.maximum(a[..., 0], b[..., 0])
+    inter_h = np.minimum(a[..., 1] + a[..., 3], b[..., 1] + b[..., 3]) - np.maximum(a[..., 1], b[..., 1])
+    intersection = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    union = a[..., 2] * a[..., 3] + b[..., 2] * b[..., 3] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+def l1_matrix(boxes_a, boxes_b):
+    """
+    Sum of absolute x, y, w, h differences between every pair of boxes
+    :param boxes_a: array of shape (N, 4) in x, y, w, h format
+    :param boxes_b: array of shape (M, 4) in x, y, w, h format
+    :return: array of shape (N, M)
+    """
+    return np.abs(boxes_a[:, None, :] - boxes_b[None, :, :]).sum(axis=2)
+
+
+
+#squared Mahalanobis distance for 4 degrees of freedom at 95% confidence
+GATE_THRESHOLD = 9.4877
+
+#default largest assignment cost of each MultiObjectTracker cost type
+MAX_COST = {'iou': 0.8, 'location': 1.0}
+
+
+
+class KalmanBoxFilter:
+    """
+    Kalman filter for bounding boxes in x, y, w, h format.
+    The state is the box followed by its velocity and, for order 2, its
+    acceleration, with one frame as the time step. Noise is scaled by
+    box height so the filter behaves the same at any distance. All
+    methods work on a batch of N tracks with means of shape (N, d) and
+    covariances of shape (N, d, d).
+    """
+    def __init__(self, order = 1, position_noise = 1/20, velocity_noise = 1/160,
+                 min_noise = 1.0) -> None:
+        """
+        New Kalman filter
+        :param order: 1 for constant velocity, 2 for constant acceleration
+        :param position_noise: position and measurement noise as a fraction of box height
+        :param velocity_noise: velocity noise as a fraction of box height
+        :param min_noise: lower bound on every noise deviation in pixels
+        """
+        if order not in (1, 2):
+            raise Exception("no motion model order")
+        self.order = order
+        self.dim = 4 * (order + 1)
+        self.position_noise = position_noise
+        self.velocity_noise = velocity_noise
+        self.min_noise = min_noise
+
+        #state transition with a time step of one frame
+        self.transition = np.eye(self.dim)
+        for i in range(4 * order):
+            self.transition[i, i + 4] = 1.0
+        if order == 2:
+            for i in range(4):
+                self.transition[i, i + 8] = 0.5
+        self.measurement = np.eye(4, self.dim)
+        self._powers = {1: self.transition}
+
+    def _std(self, heights, weight):
+        """Noise deviation per track, shape (N, 1)"""
+        return np.maximum(weight * heights, self.min_noise)[:, None]
+
+    def _process_noise(self, mean):
+        heights = mean[:, 3]
+        std = np.concatenate([np.repeat(self._std(heights, self.position_noise), 4, axis=1)]
+            + [np.repeat(self._std(heights, self.velocity_noise), 4, axis=1)] * self.order, axis=1)
+        return _diagonal(std ** 2)
+
+    def _measurement_noise(self, mean):
+        std = np.repeat(self._std(mean[:, 3], self.position_noise), 4, axis=1)
+        return _diagonal(std ** 2)
+
+    def initiate(self, boxes):
+        """
+        Creates tracks from unassociated boxes
+        :param boxes: array of shape (N, 4)
+        :return: mean and covariance of the new tracks
+        """
+        mean = np.zeros((len(boxes), self.dim))
+        mean[:, :4] = boxes
+        heights = mean[:, 3]
+        std = np.concatenate([np.repeat(self._std(heights, 2 * self.position_noise), 4, axis=1)]
+            + [np.repeat(self._std(heights, 10 * self.velocity_noise), 4, axis=1)] * self.order, axis=1)
+        return mean, _diagonal(std ** 2)
+
+    def predict(self, mean, covariance, steps = 1):
+        """
+        Projects tracks forward in time
+        :param mean: array of shape (N, d)
+        :param covariance: array of shape (N, d, d)
+        :param steps: number of frames to project
+        :return: predicted mean and covariance
+        """
+        transition = self._powers.get(steps)
+        if transition is None:
+            transition = np.linalg.matrix_power(self.transition, steps)
+            self._powers[steps] = transition
+        noise = self._process_noise(mean) * steps
+        mean = mean @ transition.T
+        covariance = transition @ covariance @ transition.T + noise
+        return mean, covariance
+
+    def project(self, mean, covariance):
+        """
+        Projects tracks into measurement space
+        :param mean: array of shape (N, d)
+        :param covariance: array of shape (N, d, d)
+        :return: predicted boxes of shape (N, 4) and their covariance (N, 4, 4)
+        """
+        boxes = mean[:, :4]
+        innovation = covariance[:, :4, :4] + self._measurement_noise(mean)
+        return boxes, innovation
+
+    def update(self, mean, covariance, boxes):
+        """
+        Corrects predicted tracks with measured boxes
+        :param mean: predicted mean of shape (N, d)
+        :param covariance: predicted covariance of shape (N, d, d)
+        :param boxes: measured boxes of shape (N, 4)
+        :return: corrected mean and covariance
+        """
+        projected, innovation = self.project(mean, covariance)
+        #kalman gain K = P H^T S^-1, solved rather than inverted
+        cross = covariance[:, :, :4]
+        gain = np.linalg.solve(innovation, np.swapaxes(cross, 1, 2))
+        gain = np.swapaxes(gain, 1, 2)
+        mean = mean + np.einsum('nij,nj->ni', gain, boxes - projected)
+        covariance = covariance - gain @ np.swapaxes(cross, 1, 2)
+        return mean, covariance
+
+    def gating_distance(self, mean, covariance, boxes):
+        """
+        Squared Mahalanobis distance between every track and box
+        :param mean: predicted mean of shape (N, d)
+        :param covariance: predicted covariance of shape (N, d, d)
+        :param boxes: detected boxes of shape (M, 4)
+        :return: array of shape (N, M), compare with GATE_THRESHOLD
+        """
+        projected, innovation = self.project(mean, covariance)
+        difference = boxes[None, :, :] - projected[:, None, :]
+        cholesky = np.linalg.cholesky(innovation)
+        #solve L z = d for every track and box
+        z = np.linalg.solve(cholesky[:, None, :, :], difference[..., None])[..., 0]
+        return (z ** 2).sum(axis=2)
+
+def _diagonal(values):
+    """Stack of diagonal matrices from an array of shape (N, d)"""
+    matrices = np.zeros(values.shape + (values.shape[1],))
+    index = np.arange(values.shape[1])
+    matrices[:, index, index] = values
+    return matrices
 
 
 
@@ -12,39 +196,74 @@ class CostBasedTracker:
     and added to the history.
     
     """
-    def __init__(self, loc_history_len):
+    def __init__(self, loc_history_len, order = 1):
         """
         New object tracker
         :param loc_history_len: Maximum length of the track history
+        :param order: Kalman motion model, 1 for constant velocity and
+        2 for constant acceleration
         """
         self.location_history = deque(maxlen=loc_history_len)
+        self.kalman = KalmanBoxFilter(order)
+        self.mean = None
+        self.covariance = None
+        #prediction cached until the next update, shared by all cost functions
+        self._prediction = None
+
+    def _predict(self, lost_track_frames):
+        """
+        Predicted state for the current frame, cached per update
+        :param lost_track_frames: number of frames the object has not
+        been seen
+        :return: predicted mean and covariance of shape (1, d) and (1, d, d)
+        """
+        if self._prediction is None or self._prediction[0] != lost_track_frames:
+            mean, covariance = self.kalman.predict(self.mean, self.covariance, 1 + lost_track_frames)
+            self._prediction = (lost_track_frames, mean, covariance)
+        return self._prediction[1], self._prediction[2]
+
     def location_prediction(self, lost_track_frames):
         """
-        Predicts the location of the tracked object by taking the 
-        derivative over the history and projecting into future.
+        Predicts the location of the tracked object from the Kalman
+        state, extrapolated over the frames the object was lost.
         :param lost_track_frames: number of frames the object has not 
         been seen
         """
-        delta_y = 0
-        delta_x = 0
-        delta_w = 0
-        delta_h = 0
-        hist_len = len(self.location_history)
-        if hist_len > 1:
-            norm = 0
-            pred_x, pred_y, pred_w, pred_h = self.location_history[0]
-            for i in range(1,hist_len,1):
-                delta_x += (self.location_history[i-1][0] - self.location_history[i][0])*(hist_len-i+1)
-                delta_y += (self.location_history[i-1][1] - self.location_history[i][1])*(hist_len-i+1)
-                delta_w += (self.location_history[i-1][2] - self.location_history[i][2])*(hist_len-i+1)
-                delta_h += (self.location_history[i-1][3] - self.location_history[i][3])*(hist_len-i+1)
-                norm += (hist_len-i+1)
-            pred_x = self.location_history[0][0] + delta_x / max(1, norm) * (1 + lost_track_frames)
-            pred_y = self.location_history[0][1] + delta_y / max(1, norm) * (1 + lost_track_frames)
-            pred_w = self.location_history[0][2] + delta_w / max(1, norm) * (1 + lost_track_frames)
-            pred_h = self.location_history[0][3] + delta_h / max(1, norm) * (1 + lost_track_frames)
+        if self.mean is None:
+            return (0, 0), 0, 0
+        mean, _ = self._predict(lost_track_frames)
+        pred_x, pred_y, pred_w, pred_h = mean[0, :4]
         return (pred_x, pred_y), pred_w, pred_h
+
+    def prediction_covariance(self, lost_track_frames):
+        """
+        Covariance of the predicted box, grows while the object is lost
+        :param lost_track_frames: number of frames the object has not
+        been seen
+        :return: 4x4 covariance of x, y, w, h or None if not tracking
+        """
+        if self.mean is None:
+            return None
+        _, innovation = self.kalman.project(*self._predict(lost_track_frames))
+        return innovation[0]
+
+    def gate(self, point_sets, lost_track_frames, threshold = GATE_THRESHOLD):
+        """
+        Rejects proposals that are unlikely under the predicted location
+        before any cost is computed.
+        :param point_sets: bounding box coords of all proposals
+        :param lost_track_frames: number of frames the object has not 
+        been seen
+        :param threshold: maximum squared Mahalanobis distance
+        :return: boolean array, True for proposals inside the gate
+        """
+        boxes = boxes_to_array(point_sets)
+        if self.mean is None:
+            return np.ones(len(boxes), dtype=bool)
+        distance = self.kalman.gating_distance(*self._predict(lost_track_frames), boxes)
+        return distance[0] <= threshold
         
+    @timed('tracker.iou_cost')
     def iou_cost(self, point_sets, lost_track_frames):
         """
         Calculates the intersection over union cost. Proposal with the 
@@ -54,29 +273,12 @@ class CostBasedTracker:
         :param lost_track_frames: number of frames the object has not 
         been seen
         """
-        #a,b for upper left corner, c,d for lower right corner
-        pred_x, pred_y, pred_w, pred_h = self.location_prediction(lost_track_frames)
-        a = pred_x
-        b = pred_y
-        c = pred_x + pred_w
-        d = pred_y + pred_h
-        pred_area = pred_w * pred_h
-        
-        bb_costs = []
-        for point_set in point_sets:
-            (x, y, w, h) = point_set['box']
-            a_2 = x 
-            b_2 = y
-            c_2 = x + w
-            d_2 = y + h
-            intersection = max(0 , (min(c, c_2) - max(a, a_2))) * max(0, (min(d, d_2) - max(b, b_2)))
-            union = pred_area + (w * h) - intersection
-            
-            bb_costs.append(1 - intersection/union)
-            
-        return bb_costs
+        (pred_x, pred_y), pred_w, pred_h = self.location_prediction(lost_track_frames)
+        prediction = np.array([[pred_x, pred_y, pred_w, pred_h]], dtype=np.float64)
+        return 1 - iou_matrix(prediction, boxes_to_array(point_sets))[0]
 
 
+    @timed('tracker.location_cost')
     def location_cost(self, point_sets, lost_track_frames):
         """
         Calculates cost between all proposals and history based on 
@@ -89,12 +291,8 @@ class CostBasedTracker:
             
             
         (pred_x, pred_y), pred_w, pred_h = self.location_prediction(lost_track_frames)
-        bb_costs = []
-        for point_set in point_sets:
-            (x, y, w, h) = point_set['box']
-            bb_costs.append((abs(pred_x - x) + abs(pred_y - y) + abs(pred_h - h) +abs(pred_w - w)))
-            
-        return bb_costs
+        prediction = np.array([[pred_x, pred_y, pred_w, pred_h]], dtype=np.float64)
+        return l1_matrix(prediction, boxes_to_array(point_sets))[0]
     def xy_error(self, bounding_box, x, y):
         """
         Calculates xy error between two bounding boxes
@@ -124,16 +322,208 @@ class CostBasedTracker:
             self.location_history.clear()
             self.location_history.appendleft((x, y, w, h))
             self.location_history.appendleft((x, y, w, h))
+            self.mean, self.covariance = self.kalman.initiate(np.array([[x, y, w, h]], dtype=np.float64))
+            self._prediction = None
 
             return True
         
         else:
             useless = y + x
             return False
+    def get_velocity(self):
+        """
+        Velocity of the tracked object from the Kalman state
+        :return: x, y, w, h change per frame or None if not tracking
+        """
+        if self.mean is None:
+            return None
+        return tuple(self.mean[0, 4:8])
     def drop_track(self):
         self.location_history.clear()
+        self.mean = self.covariance = self._prediction = None
     def update_track(self, x, y, w, h):
+        """
+        Adds a matched box to the track and corrects the Kalman state
+        using the prediction the costs were computed from.
+        """
         self.location_history.appendleft((x, y, w, h))
-        
+        box = np.array([[x, y, w, h]], dtype=np.float64)
+        if self.mean is None:
+            self.mean, self.covariance = self.kalman.initiate(box)
+        else:
+            lost_track_frames = 0 if self._prediction is None else self._prediction[0]
+            self.mean, self.covariance = self.kalman.update(*self._predict(lost_track_frames), box)
+        self._prediction = None
+
+
+
+class MultiObjectTracker:
+    """
+    Tracks many objects at once.
+    Tracks and detections are held as arrays so the cost between every
+    track and detection is computed in one pass. Each track carries a
+    Kalman state, detections outside a track's gate are rejected before
+    assignment, and the rest are assigned with the Hungarian algorithm.
+    Unmatched detections start new tracks and tracks that are not seen
+    for max_lost frames are dropped.
+    """
+    def __init__(self, max_lost = 5, min_hits = 2, cost = 'iou', max_cost = None,
+                 order = 1, gate_threshold = GATE_THRESHOLD) -> None:
+        """
+        New multi-object tracker
+        :param max_lost: frames a track can go unmatched before it is dropped
+        :param min_hits: matches needed before a track is reported
+        :param cost: 'iou' for 1 - IoU cost or 'location' for L1 box distance
+        divided by the predicted box's w + h, so both are unitless
+        :param max_cost: assignments above this cost are rejected, defaults
+        to 0.8 for iou (IoU of at least 0.2) and 1.0 for location (L1
+        distance of at most one box width plus height)
+        :param order: Kalman motion model, 1 for constant velocity and
+        2 for constant acceleration
+        :param gate_threshold: maximum squared Mahalanobis distance, None
+        disables gating
+        """
+        if cost not in ('iou', 'location'):
+            raise Exception("no cost type")
+        self.max_lost = max_lost
+        self.min_hits = min_hits
+        self.cost = cost
+        self.max_cost = MAX_COST[cost] if max_cost is None else max_cost
+        self.gate_threshold = gate_threshold
+
+        self.kalman = KalmanBoxFilter(order)
+        self.mean = np.empty((0, self.kalman.dim), dtype=np.float64)
+        self.covariance = np.empty((0, self.kalman.dim, self.kalman.dim), dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.hits = np.empty(0, dtype=np.int64)
+        self.lost = np.empty(0, dtype=np.int64)
+        self.next_id = 0
+
+    @property
+    def boxes(self):
+        """Current box of every track as an array of shape (N, 4)"""
+        return self.mean[:, :4]
+
+    def predict(self):
+        """
+        Predicts where every track will be in the next frame without
+        changing the tracks
+        :return: array of shape (N, 4) in x, y, w, h format
+        """
+        mean, _ = self.kalman.predict(self.mean, self.covariance)
+        return mean[:, :4]
+
+    @timed('tracker.cost_matrix')
+    def cost_matrix(self, predictions, detections):
+        """
+        Cost between every predicted track and every detection
+        :param predictions: array of shape (N, 4)
+        :param detections: array of shape (M, 4)
+        :return: array of shape (N, M)
+        """
+        if self.cost == 'iou':
+            return 1 - iou_matrix(predictions, detections)
+        #pixel distance relative to box size, predictions are at least 1x1
+        return l1_matrix(predictions, detections) / (predictions[:, 2:3] + predictions[:, 3:4])
+
+    @timed('tracker.assign')
+    def assign(self, cost):
+        """
+        Minimum cost assignment of detections to tracks
+        :param cost: cost matrix of shape (N, M), np.inf marks gated pairs
+        :return: matched track indices, matched detection indices
+        """
+        if cost.size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        #linear_sum_assignment needs finite costs
+        finite = np.where(np.isfinite(cost), cost, self.max_cost + 1e6)
+        rows, cols = linear_sum_assignment(finite)
+        keep = finite[rows, cols] <= self.max_cost
+        return rows[keep], cols[keep]
+
+    @timed('tracker.update')
+    def update(self, point_sets):
+        """
+        Matches a frame of detections to the tracks
+        :param point_sets: list of detections with a 'box' entry or an
+        array of x, y, w, h rows
+        :return: ids and boxes of confirmed tracks seen this frame as an
+        int array of shape (K,) and a float array of shape (K, 4)
+        """
+        detections = boxes_to_array(point_sets)
+        self.mean, self.covariance = self.kalman.predict(self.mean, self.covariance)
+        predictions = np.maximum(self.mean[:, :4], (-np.inf, -np.inf, 1, 1))
+
+        cost = self.cost_matrix(predictions, detections)
+        if self.gate_threshold is not None and cost.size > 0:
+            distance = self.kalman.gating_distance(self.mean, self.covariance, detections)
+            cost[distance > self.gate_threshold] = np.inf
+        rows, cols = self.assign(cost)
+
+        #matched tracks
+        if len(rows) > 0:
+            self.mean[rows], self.covariance[rows] = self.kalman.update(
+                self.mean[rows], self.covariance[rows], detections[cols])
+        self.hits[rows] += 1
+        self.lost += 1
+        self.lost[rows] = 0
 
-      
\ No newline at end of file
+        #track death
+        self._select(self.lost <= self.max_lost)
+
+        #track birth from unmatched detections
+        unmatched = np.ones(len(detections), dtype=bool)
+        unmatched[cols] = False
+        born = detections[unmatched]
+        count = len(born)
+        if count > 0:
+            mean, covariance = self.kalman.initiate(born)
+            self.mean = np.concatenate((self.mean, mean))
+            self.covariance = np.concatenate((self.covariance, covariance))
+            self.ids = np.concatenate((self.ids, np.arange(self.next_id, self.next_id + count)))
+            self.hits = np.concatenate((self.hits, np.ones(count, dtype=np.int64)))
+            self.lost = np.concatenate((self.lost, np.zeros(count, dtype=np.int64)))
+            self.next_id += count
+
+        confirmed = (self.lost == 0) & (self.hits >= self.min_hits)
+        return self.ids[confirmed], self.boxes[confirmed]
+
+    def _select(self, mask):
+        """Keeps only the tracks selected by a boolean mask"""
+        self.mean = self.mean[mask]
+        self.covariance = self.covariance[mask]
+        self.ids = self.ids[mask]
+        self.hits = self.hits[mask]
+        self.lost = self.lost[mask]
+
+    def get_track(self, track_id):
+        """
+        Box of a single track
+        :param track_id: id returned by update
+        :return: x, y, w, h tuple or None if the track was dropped
+        """
+        index = np.flatnonzero(self.ids == track_id)
+        if index.size == 0:
+            return None
+        return tuple(self.boxes[index[0]])
+
+    def get_velocity(self, track_id):
+        """
+        Velocity of a single track
+        :param track_id: id returned by update
+        :return: x, y, w, h change per frame or None if the track was dropped
+        """
+        index = np.flatnonzero(self.ids == track_id)
+        if index.size == 0:
+            return None
+        return tuple(self.mean[index[0], 4:8])
+
+    def drop_track(self, track_id = None):
+        """
+        Drops one track or all tracks
+        :param track_id: id of the track to drop, None drops all
+        """
+        if track_id is None:
+            self._select(np.zeros(len(self.ids), dtype=bool))
+        else:
+            self._select(self.ids != track_id)
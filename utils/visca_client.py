@@ -0,0 +1,368 @@
+import asyncio
+import struct
+import time
+from collections import deque
+
+
+
+#VISCA over IP payload types
+VISCA_COMMAND = 0x0100
+VISCA_INQUIRY = 0x0110
+VISCA_REPLY = 0x0111
+CONTROL_COMMAND = 0x0200
+CONTROL_REPLY = 0x0201
+
+#error codes in VISCA error replies (90 6y ee ff)
+ERROR_SYNTAX = 0x02
+ERROR_BUFFER_FULL = 0x03
+ERROR_CANCELED = 0x04
+ERROR_NO_SOCKET = 0x05
+ERROR_NOT_EXECUTABLE = 0x41
+
+#errors that mean the camera is busy and the command can be retried
+BUSY_ERRORS = (ERROR_BUFFER_FULL, ERROR_NOT_EXECUTABLE)
+
+HEADER = struct.Struct('>HHI')
+
+def pack(payload_type, sequence, payload):
+    """
+    Wraps a VISCA payload in the VISCA over IP header
+    :param payload_type: one of the payload type constants
+    :param sequence: 32 bit sequence number
+    :param payload: VISCA bytes
+    :return: datagram bytes
+    """
+    return HEADER.pack(payload_type, len(payload), sequence) + bytes(payload)
+
+def unpack(datagram):
+    """
+    Splits a VISCA over IP datagram
+    :param datagram: received bytes
+    :return: payload type, sequence number and payload, or None if malformed
+    """
+    if len(datagram) < HEADER.size:
+        return None
+    payload_type, length, sequence = HEADER.unpack_from(datagram)
+    return payload_type, sequence, datagram[HEADER.size:HEADER.size + length]
+
+
+
+class CommandError(Exception):
+    """Raised when the camera rejects a command"""
+    def __init__(self, code) -> None:
+        super().__init__("VISCA error 0x{:02x}".format(code))
+        self.code = code
+
+
+
+class Superseded(Exception):
+    """Raised for a command replaced by a newer one for the same function before it was resent"""
+
+
+
+class InFlight:
+    """State of one command waiting for replies"""
+    def __init__(self, sequence, payload_type, payload, key, loop) -> None:
+        self.sequence = sequence
+        self.payload_type = payload_type
+        self.payload = payload
+        self.key = key
+        self.sent_at = 0.0
+        self.first_sent_at = 0.0
+        self.attempts = 0
+        self.ack = loop.create_future()
+        self.completion = loop.create_future()
+        self.timer = None
+        self.retry_at_busy = False
+
+
+
+class VISCAClient:
+    """
+    Asynchronous VISCA over IP client.
+    Commands are wrapped with sequence numbers and tracked until the
+    camera replies. Commands that time out or find the camera busy are
+    resent, and a new command for the same function replaces one that
+    is still waiting to be resent instead of queueing behind it.
+    """
+    def __init__(self, ip_address, port_number = 52381, timeout = 0.2, retries = 3,
+                 busy_delay = 0.02, history = 256, completion_timeout = 5.0) -> None:
+        """
+        New VISCA over IP client
+        :param ip_address: camera ip address
+        :param port_number: camera VISCA over IP port
+        :param timeout: seconds to wait for an ACK before resending
+        :param retries: resends before a command fails
+        :param busy_delay: seconds to wait before resending to a busy camera
+        :param history: number of round trip times kept for statistics
+        :param completion_timeout: seconds to wait for Completion after the
+        ACK, moves can take much longer than a round trip
+        """
+        self.ip_address = ip_address
+        self.port_number = port_number
+        self.timeout = timeout
+        self.retries = retries
+        self.busy_delay = busy_delay
+        self.completion_timeout = completion_timeout
+        self.transport = None
+        self.loop = None
+        self.sequence = 0
+        self.in_flight = {}
+        self._by_key = {}
+        self.ack_times = deque(maxlen=history)
+        self.completion_times = deque(maxlen=history)
+        self.counts = {'sent': 0, 'acked': 0, 'completed': 0, 'retries': 0,
+                       'coalesced': 0, 'busy': 0, 'errors': 0, 'timeouts': 0}
+
+    async def connect(self, local_address = None):
+        """
+        Opens the UDP endpoint and resets the camera sequence number
+        :param local_address: optional (host, port) to bind to
+        """
+        self.loop = asyncio.get_running_loop()
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _ClientProtocol(self),
+            local_addr=local_address,
+            remote_addr=(self.ip_address, self.port_number))
+        await self.reset_sequence()
+
+    def close(self):
+        """Closes the endpoint and fails all commands in flight"""
+        for command in list(self.in_flight.values()):
+            self._finish(command, ConnectionError("client closed"))
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def reset_sequence(self):
+        """Resets the sequence number on the camera and the client"""
+        self.sequence = 0
+        try:
+            await self.send(b'\x01', payload_type=CONTROL_COMMAND, wait='ack')
+        except asyncio.TimeoutError:
+            #cameras that ignore control commands still accept VISCA
+            pass
+        self.sequence = 0
+
+    def submit(self, payload, payload_type = VISCA_COMMAND, key = None):
+        """
+        Sends a command without waiting for it
+        :param payload: VISCA bytes
+        :param payload_type: one of the payload type constants
+        :param key: commands with the same key replace each other while
+        waiting to be resent, e.g. successive pan/tilt drive commands
+        :return: InFlight with ack and completion futures
+        """
+        if key is not None:
+            waiting = self._by_key.get(key)
+            if waiting is not None and waiting.retry_at_busy:
+                #camera is busy, resend the newest command instead
+                waiting.payload = bytes(payload)
+                self.counts['coalesced'] += 1
+                return waiting
+
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        command = InFlight(self.sequence, payload_type, bytes(payload), key, self.loop)
+        self.in_flight[command.sequence] = command
+        if key is not None:
+            self._by_key[key] = command
+        self._transmit(command)
+        command.first_sent_at = command.sent_at
+        return command
+
+    async def send(self, payload, payload_type = VISCA_COMMAND, key = None, wait = 'completion'):
+        """
+        Sends a command and waits for the camera
+        :param payload: VISCA bytes
+        :param payload_type: one of the payload type constants
+        :param key: coalescing key, see submit
+        :param wait: 'ack' or 'completion'
+        :return: round trip time in seconds, raises asyncio.TimeoutError,
+        CommandError or Superseded
+        """
+        command = self.submit(payload, payload_type, key)
+        future = command.ack if wait == 'ack' or payload_type == CONTROL_COMMAND else command.completion
+        return await asyncio.shield(future)
+
+    def _transmit(self, command):
+        command.attempts += 1
+        command.sent_at = time.monotonic()
+        command.retry_at_busy = False
+        self.transport.sendto(pack(command.payload_type, command.sequence, command.payload))
+        self.counts['sent'] += 1
+        if command.timer is not None:
+            command.timer.cancel()
+        command.timer = self.loop.call_later(self.timeout, self._timed_out, command)
+
+    def _retry(self, command):
+        if command.sequence not in self.in_flight:
+            return
+        if command.key is not None and self._by_key.get(command.key) is not command:
+            #a newer command for the same function was sent, never resend stale ones
+            self.counts['coalesced'] += 1
+            self._finish(command, Superseded())
+            return
+        if command.attempts > self.retries:
+            self.counts['timeouts'] += 1
+            self._finish(command, asyncio.TimeoutError())
+            return
+        self.counts['retries'] += 1
+        self._transmit(command)
+
+    def _timed_out(self, command):
+        command.timer = None
+        if not command.ack.done():
+            self._retry(command)
+        elif not command.completion.done():
+            #ACK arrived but completion did not
+            self.counts['timeouts'] += 1
+            self._finish(command, asyncio.TimeoutError())
+
+    def _finish(self, command, error = None):
+        if command.timer is not None:
+            command.timer.cancel()
+            command.timer = None
+        self.in_flight.pop(command.sequence, None)
+        if command.key is not None and self._by_key.get(command.key) is command:
+            del self._by_key[command.key]
+        for future in (command.ack, command.completion):
+            if not future.done():
+                if error is None:
+                    future.set_result(time.monotonic() - command.first_sent_at)
+                else:
+                    future.set_exception(error)
+                    #mark retrieved so unawaited fire and forget commands stay quiet
+                    future.exception()
+
+    def datagram_received(self, datagram):
+        """
+        Matches a reply to the command in flight
+        :param datagram: received bytes
+        """
+        message = unpack(datagram)
+        if message is None:
+            return
+        payload_type, sequence, payload = message
+        command = self.in_flight.get(sequence)
+        if command is None:
+            return
+        now = time.monotonic()
+
+        if payload_type == CONTROL_REPLY:
+            self._finish(command)
+            return
+        if payload_type != VISCA_REPLY or len(payload) < 3:
+            return
+
+        kind = payload[1] & 0xf0
+        if kind == 0x40:
+            if not command.ack.done():
+                rtt = now - command.first_sent_at
+                self.ack_times.append(rtt)
+                self.counts['acked'] += 1
+                command.ack.set_result(rtt)
+            if command.timer is not None:
+                command.timer.cancel()
+            command.timer = self.loop.call_later(self.completion_timeout, self._timed_out, command)
+        elif kind == 0x50:
+            if not command.ack.done():
+                #inquiries answer with completion only
+                command.ack.set_result(now - command.first_sent_at)
+            self.completion_times.append(now - command.first_sent_at)
+            self.counts['completed'] += 1
+            self._finish(command)
+        elif kind == 0x60:
+            code = payload[2]
+            if code in BUSY_ERRORS and command.attempts <= self.retries:
+                self.counts['busy'] += 1
+                command.retry_at_busy = True
+                if command.timer is not None:
+                    command.timer.cancel()
+                command.timer = self.loop.call_later(self.busy_delay, self._retry, command)
+            else:
+                self.counts['errors'] += 1
+                self._finish(command, CommandError(code))
+
+    def stats(self):
+        """
+        Counters and round trip times
+        :return: dict of statistics, times in seconds
+        """
+        stats = dict(self.counts)
+        stats['in_flight'] = len(self.in_flight)
+        for name, times in (('ack', self.ack_times), ('completion', self.completion_times)):
+            if len(times) > 0:
+                ordered = sorted(times)
+                stats[name + '_p50'] = ordered[len(ordered) // 2]
+                stats[name + '_p99'] = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        return stats
+
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        self.client.datagram_received(data)
+
+    def error_received(self, exc):
+        self.client.counts['errors'] += 1
+
+
+
+class LocalCamera(asyncio.DatagramProtocol):
+    """
+    Stand-in VISCA over IP camera for testing without hardware.
+    Answers every command with ACK and Completion, and can add delay,
+    report busy or drop packets.
+    """
+    def __init__(self, delay = 0.0, busy = 0, drop = 0) -> None:
+        """
+        New stand-in camera
+        :param delay: seconds between ACK and Completion
+        :param busy: number of commands to answer with buffer full first
+        :param drop: number of datagrams to ignore first
+        """
+        self.delay = delay
+        self.busy = busy
+        self.drop = drop
+        self.transport = None
+        self.received = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        message = unpack(data)
+        if message is None:
+            return
+        payload_type, sequence, payload = message
+        if self.drop > 0:
+            self.drop -= 1
+            return
+        self.received.append((payload_type, sequence, bytes(payload)))
+        if payload_type == CONTROL_COMMAND:
+            self.transport.sendto(pack(CONTROL_REPLY, sequence, b'\x01'), addr)
+            return
+        if self.busy > 0:
+            self.busy -= 1
+            self.transport.sendto(pack(VISCA_REPLY, sequence, bytes((0x90, 0x60, ERROR_BUFFER_FULL, 0xff))), addr)
+            return
+        if payload_type == VISCA_COMMAND:
+            self.transport.sendto(pack(VISCA_REPLY, sequence, b'\x90\x41\xff'), addr)
+        completion = pack(VISCA_REPLY, sequence, b'\x90\x51\xff')
+        asyncio.get_running_loop().call_later(self.delay, self.transport.sendto, completion, addr)
+
+    @classmethod
+    async def start(cls, host = '127.0.0.1', port = 0, **kwargs):
+        """
+        Starts a stand-in camera on the running event loop
+        :param host: address to listen on
+        :param port: port to listen on, 0 picks a free port
+        :return: camera protocol and its (host, port)
+        """
+        loop = asyncio.get_running_loop()
+        transport, camera = await loop.create_datagram_endpoint(
+            lambda: cls(**kwargs), local_addr=(host, port))
+        return camera, transport.get_extra_info('sockname')